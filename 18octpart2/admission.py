@@ -0,0 +1,72 @@
+"""Ограничение скорости публикаций клиента: маркерные корзины сообщений и байт.
+
+Корзина пополняется со скоростью rate маркеров в секунду и хранит не больше
+capacity маркеров, поэтому клиент может опубликовать всплеск до capacity
+сообщений (байт), а в среднем - не быстрее rate. Пополнение считается лениво
+при проверке, так что лимит стоит пары арифметических операций на публикацию
+и не требует таймеров.
+"""
+from typing import Optional
+
+RATE = 'rate'
+BYTES = 'bytes'
+
+
+class TokenBucket:
+    """Маркерная корзина.
+
+    Запрос больше емкости проходит, когда корзина полна, и уводит ее в
+    минус - иначе такой пакет не прошел бы никогда; перерасход покрывается
+    следующими пополнениями (как перерасход байтового кредита подписки).
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, now: float = 0.0):
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def allows(self, amount: float) -> bool:
+        return self.tokens >= min(amount, self.capacity)
+
+    def take(self, amount: float):
+        self.tokens -= amount
+
+    def wait_time(self, amount: float) -> float:
+        """Через сколько секунд allows(amount) станет верным."""
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+
+class PublishLimiter:
+    """Лимиты публикаций одного соединения: сообщений и байт в секунду."""
+
+    __slots__ = ('messages', 'bytes')
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None,
+                 bytes_rate: Optional[float] = None, bytes_burst: Optional[float] = None,
+                 now: float = 0.0):
+        self.messages = TokenBucket(rate, burst, now) if rate else None
+        self.bytes = TokenBucket(bytes_rate, bytes_burst, now) if bytes_rate else None
+
+    def admit(self, count: int, size: int, now: float) -> Optional[tuple[str, float]]:
+        """Списывает публикацию count сообщений размером size байт.
+
+        Возвращает None, если она пропущена, иначе причину (RATE или BYTES) и
+        через сколько секунд ее имеет смысл повторить; отказ ничего не списывает.
+        """
+        checks = ((RATE, self.messages, count), (BYTES, self.bytes, size))
+        for reason, bucket, amount in checks:
+            if bucket is not None:
+                bucket.refill(now)
+                if not bucket.allows(amount):
+                    return reason, bucket.wait_time(amount)
+        for _, bucket, amount in checks:
+            if bucket is not None:
+                bucket.take(amount)
+        return None
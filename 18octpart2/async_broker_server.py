@@ -1,138 +1,2147 @@
+import argparse
 import asyncio
+import heapq
+import itertools
 import json
+import math
+import struct
+import time
 from collections import defaultdict, deque
+from typing import Callable, Iterable, Optional
+
+import framing
+from admission import BYTES, PublishLimiter
+from consumer_groups import ConsumerGroup, Lease
+from message_filters import FilterIndex, MessageFilter, message_fields
+from metrics import BrokerMetrics, render_prometheus, serve_metrics
+from profiler import DEFAULT_INTERVAL, MAX_SECONDS, SamplingProfiler
+from replication import Follower, ReplicaSet, parse_address
+from retention import RetentionPolicy, TopicStats
+from storage import SegmentLog
+from topic_trie import TopicTrie, is_pattern, matches
+from topics import (MAX_PRIORITY, MessageLog, PriorityIndex, StoredMessage, Subscription,
+                    splice_data, splice_items, starts_json)
+from tracing import TraceStore
+from transport import STREAMS, TRANSPORTS, run, start_server
+
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_DISCONNECT)
+
+
+class ClientOutbox:
+    """Ограниченная очередь исходящих кадров соединения со своей задачей записи.
+
+    Публикация только ставит кадры в очередь, поэтому медленный потребитель
+    копит данные в своей очереди и не тормозит издателя и других подписчиков.
+    К рассылкам применяется политика переполнения, ответы на собственные
+    запросы клиента не отбрасываются никогда.
+
+    Задача записи просыпается не чаще раза за итерацию цикла событий и
+    отправляет все накопленные кадры одним writelines (порциями не больше
+    write_threshold байт). drain() ждется, только когда буфер транспорта
+    выше его верхней отметки, поэтому мелкие сообщения не стоят по
+    системному вызову и переключению задачи каждое.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, maxsize: int = 1000,
+                 overflow: str = OVERFLOW_DROP_OLDEST, write_threshold: int = 64 * 1024):
+        self.writer = writer
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.write_threshold = write_threshold
+        self.dropped = 0
+        self.binary = False
+        # Соединение согласовало сжатие: сжатые издателями сообщения уходят
+        # как хранятся, большие пакеты get_batch сжимаются целиком.
+        self.compression = False
+        # Рассылки без потерь (ведомые узлы): при заполненной очереди подписка
+        # отстает и догоняет досылкой бэклога вместо отбрасывания кадров.
+        self.lossless = False
+        # Вызывается, когда очередь опустела; возвращает True, если добавил
+        # новые кадры (так брокер постепенно досылает бэклог подписок).
+        self.on_idle: Optional[Callable[[], bool]] = None
+        # Метрики брокера: доставки, отбрасывания и время ожидания drain().
+        self.metrics: Optional[BrokerMetrics] = None
+        self._frames: deque = deque()
+        self._pushes = 0
+        self._closed = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def full(self) -> bool:
+        return self._pushes >= self.maxsize
+
+    @property
+    def pending_replies(self) -> int:
+        """Ответы на запросы клиента, еще не записанные в сокет."""
+        return len(self._frames) - self._pushes
+
+    def put(self, data: bytes, droppable: bool = False,
+            message: Optional[StoredMessage] = None) -> bool:
+        """Ставит кадр в очередь; message - сообщение топика в кадре, для метрик."""
+        if self._closed:
+            return False
+
+        if droppable and self.full:
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                self._count_drop(message)
+                return False
+            if self.overflow == OVERFLOW_DISCONNECT:
+                self._count_drop(message)
+                self._abort()
+                return False
+            self._drop_oldest_push()
+
+        self._frames.append((data, droppable, message))
+        if droppable:
+            self._pushes += 1
+        if message is not None and message.trace is not None:
+            message.trace.queued(self.writer, time.monotonic())
+        self._wakeup.set()
+        return True
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _drop_oldest_push(self):
+        for index, (_, droppable, message) in enumerate(self._frames):
+            if droppable:
+                del self._frames[index]
+                self._pushes -= 1
+                self._count_drop(message)
+                return
+
+    def _count_drop(self, message: Optional[StoredMessage]):
+        self.dropped += 1
+        if self.metrics is not None and message is not None:
+            self.metrics.dropped(message)
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while True:
+                    while self._frames:
+                        await self._flush()
+                    if self.on_idle is None or not self.on_idle():
+                        break
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Соединение разорвано: handle_client увидит EOF и выполнит очистку.
+            self._abort()
+
+    async def _flush(self):
+        """Отправляет накопленные кадры одним writelines и при необходимости ждет drain()."""
+        transport = self.writer.transport
+        if transport.is_closing():
+            raise ConnectionResetError('Connection is closing')
+
+        frames = self._frames
+        metrics = self.metrics
+        now = time.monotonic() if metrics is not None else 0.0
+        batch = []
+        size = 0
+        while frames and size < self.write_threshold:
+            data, droppable, message = frames.popleft()
+            if droppable:
+                self._pushes -= 1
+            if message is not None and metrics is not None:
+                metrics.sent(message, now)
+                if message.trace is not None:
+                    message.trace.written(self.writer, now)
+            batch.append(data)
+            size += len(data)
+        self.writer.writelines(batch)
+
+        if transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+            started = time.monotonic()
+            await self.writer.drain()
+            if metrics is not None:
+                metrics.drain_time.observe(time.monotonic() - started)
+
+    def _abort(self):
+        self._closed = True
+        self._frames.clear()
+        self._pushes = 0
+        transport = self.writer.transport
+        if transport is not None and not transport.is_closing():
+            transport.abort()
+
+    async def close(self):
+        self._closed = True
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
 
 
 class AsyncMessageBroker:
-    def __init__(self):
-        self.queues = defaultdict(deque)
-        self.subscribers = defaultdict(set)
+    # Сколько ждать первый запрос соединения сверх лимита, чтобы ответить на него ошибкой.
+    REJECT_TIMEOUT = 1.0
+
+    def __init__(self, outbox_size: int = 1000, overflow: str = OVERFLOW_DROP_OLDEST,
+                 max_frame_size: int = framing.DEFAULT_MAX_FRAME_SIZE,
+                 max_batch_size: int = 1000,
+                 retention: Optional[RetentionPolicy] = None,
+                 topic_retention: Optional[dict[str, RetentionPolicy]] = None,
+                 global_retention: Optional[RetentionPolicy] = None,
+                 retention_interval: float = 1.0,
+                 storage: Optional[SegmentLog] = None,
+                 replay_chunk: int = 100,
+                 visibility_timeout: float = 30.0,
+                 max_in_flight: int = 10,
+                 leader: Optional[tuple[str, int]] = None,
+                 min_replicas: int = 0,
+                 replica_timeout: float = 5.0,
+                 allow_admin: bool = False,
+                 replica_hosts: Iterable[str] = (),
+                 high_water_messages: Optional[int] = None,
+                 high_water_bytes: Optional[int] = None,
+                 compress_min_size: Optional[int] = framing.DEFAULT_COMPRESS_MIN_SIZE,
+                 priority_topics: Optional[Iterable[str]] = None,
+                 priority_step: float = 1.0,
+                 max_connections: Optional[int] = None,
+                 max_client_in_flight: Optional[int] = None,
+                 publish_rate: Optional[float] = None,
+                 publish_burst: Optional[float] = None,
+                 publish_bytes_rate: Optional[float] = None,
+                 publish_bytes_burst: Optional[float] = None,
+                 max_traces: int = 0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+
+        self.queues: defaultdict[str, MessageLog] = defaultdict(MessageLog)
+        self.topic_stats = defaultdict(TopicStats)
+        self.subscribers: defaultdict[str, dict[asyncio.StreamWriter, Subscription]] = \
+            defaultdict(dict)
         self.writer_topics = defaultdict(set)
+        # Подписки по шаблонам: дерево шаблонов и шаблоны каждого соединения.
+        # Для каждого подходящего топика шаблон создает обычную Subscription,
+        # поэтому публикация не перебирает шаблоны.
+        self.patterns = TopicTrie()
+        self.writer_patterns = defaultdict(set)
+        # Подписки с фильтром по топикам, проиндексированные по значениям полей.
+        self.filter_index: dict[str, FilterIndex] = {}
+        self.outboxes: dict[asyncio.StreamWriter, ClientOutbox] = {}
+        self.outbox_size = outbox_size
+        self.overflow = overflow
+        self.max_frame_size = max_frame_size
+        self.max_batch_size = max_batch_size
+        self.topic_ids: dict[str, int] = {}
+        self.topic_names: dict[int, str] = {}
+        self.retention = retention or RetentionPolicy()
+        self.topic_retention = topic_retention or {}
+        self.global_retention = global_retention or RetentionPolicy()
+        self.retention_interval = retention_interval
+        self.storage = storage
+        self.replay_chunk = replay_chunk
+        # Объем топика, выше которого издатели получают в ответе slow_down.
+        self.high_water_messages = high_water_messages
+        self.high_water_bytes = high_water_bytes
+        # Порог сжатия, который брокер сообщает клиентам при согласовании;
+        # None или 0 - брокер отказывает в сжатии.
+        self.compress_min_size = compress_min_size
+        # Приоритетные топики: get и досылка бэклога идут в порядке приоритета
+        # с учетом возраста (PriorityIndex), ступень - priority_step секунд.
+        self.priority_topics = set(priority_topics or ())
+        self.priority_step = priority_step
+        self.priority_index: defaultdict[str, PriorityIndex] = \
+            defaultdict(lambda: PriorityIndex(self.priority_step))
+        # Контроль допуска: лимит соединений, неотвеченных запросов соединения
+        # и скорости публикаций (маркерные корзины PublishLimiter на соединение).
+        self.max_connections = max_connections
+        self.max_client_in_flight = max_client_in_flight
+        self.publish_limits = (publish_rate, publish_burst, publish_bytes_rate,
+                               publish_bytes_burst)
+        self.rate_limited = bool(publish_rate or publish_bytes_rate)
+        self.publish_limiters: dict[asyncio.StreamWriter, PublishLimiter] = {}
+        # Соединения соседних процессов брокера (ShardedBroker): контроль
+        # допуска их не касается - клиентов ограничивает процесс, к которому
+        # они подключены, а сосед обслуживает запросы всех его клиентов разом.
+        self.peers: set[asyncio.StreamWriter] = set()
+        self.visibility_timeout = visibility_timeout
+        self.max_in_flight = max_in_flight
+        # Группы потребителей топика и группа, в которой состоит соединение
+        # (не больше одной на топик, поэтому ack достаточно топика и смещения).
+        self.groups: defaultdict[str, dict[str, ConsumerGroup]] = defaultdict(dict)
+        self.writer_groups: defaultdict[asyncio.StreamWriter, dict[str, ConsumerGroup]] = \
+            defaultdict(dict)
+        # Куча сроков аренды всех групп; ее обслуживает одна задача _lease_loop.
+        self._leases: list[Lease] = []
+        self._leases_compact_at = 1024
+        self._lease_wakeup = asyncio.Event()
+        # Отложенные публикации - куча (срок, номер, топик, данные, ttl, приоритет) - и
+        # сроки жизни сообщений - куча (срок, номер, сообщение). Обе обслуживает
+        # одна задача _timer_loop; номер сохраняет порядок публикаций с равным сроком.
+        self._delayed: list[tuple] = []
+        self._expiries: list[tuple] = []
+        self._expiries_compact_at = 1024
+        self._timer_sequence = itertools.count()
+        self._timer_wakeup = asyncio.Event()
+        # Репликация: на лидере - подтверждения ведомых, на ведомом - задача
+        # получения потока от лидера.
+        self.replicas = ReplicaSet(min_replicas, replica_timeout)
+        self.follower = Follower(self, *leader) if leader else None
+        self._follower_task: Optional[asyncio.Task] = None
+        # promote и follow меняют роль узла (follow еще и обрезает топики),
+        # а REPLICATE отдает ведомому все топики, поэтому по умолчанию
+        # клиенты их выполнять не могут. Репликацию можно разрешить и
+        # только адресам ведомых.
+        self.allow_admin = allow_admin
+        self.replica_hosts = frozenset(replica_hosts)
+        # Все хранимые сообщения в порядке публикации - для глобальных лимитов.
+        # Забранные get сообщения удаляются отсюда лениво (флаг removed).
+        self._all_messages: deque = deque()
+        self.total_messages = 0
+        self.total_bytes = 0
+        self.evicted = 0
+        self.metrics = BrokerMetrics()
+        # Трассы сообщений, опубликованных с флагом trace; None - трассировка выключена.
+        self.traces = TraceStore(max_traces) if max_traces else None
+        # Выборочный профилировщик, запущенный действием profile, и задача его остановки.
+        self.profiler: Optional[SamplingProfiler] = None
+        self._profile_task: Optional[asyncio.Task] = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self):
+        """Восстанавливает топики из хранилища и запускает фоновые задачи брокера."""
+        if self.storage is not None:
+            self._recover()
+            self._tasks.append(asyncio.create_task(self.storage.run()))
+        if self._has_age_limits():
+            self._tasks.append(asyncio.create_task(self._retention_loop()))
+        self._tasks.append(asyncio.create_task(self._lease_loop()))
+        self._tasks.append(asyncio.create_task(self._timer_loop()))
+        if self.replicas.min_replicas > 0:
+            self._tasks.append(asyncio.create_task(self._replication_loop()))
+        if self.follower is not None:
+            self._follower_task = asyncio.create_task(self.follower.run())
+
+    async def stop(self):
+        await self._stop_following()
+        if self._profile_task is not None:
+            self._profile_task.cancel()
+            await asyncio.wait([self._profile_task])
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks.clear()
+
+        if self.storage is not None:
+            self.storage.close()
+
+    def _recover(self):
+        wall_now, now = time.time(), time.monotonic()
+        recovered = self.storage.recover()
+        for record in recovered:
+            message = StoredMessage(record.topic, self._topic_id(record.topic), record.offset,
+                                    None, size=record.size,
+                                    created=now - max(0.0, wall_now - record.timestamp),
+                                    location=(record.segment, record.position))
+            self._store(message)
+        for topic, next_offset in self.storage.next_offsets().items():
+            queue = self.queues[topic]
+            queue.next_offset = max(queue.next_offset, next_offset)
+        for topic in list(self.queues):
+            self._enforce_retention(topic)
+        print(f"Восстановлено сообщений из хранилища: {len(recovered)}")
 
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         addr = writer.get_extra_info('peername')
+        if writer not in self.peers and not self.admit_connection():
+            await self._reject_connection(reader, writer)
+            print(f"Отказано в подключении {addr}: достигнут лимит соединений")
+            return
         print(f"Клиент подключен: {addr}")
+        self.add_connection(writer)
 
         try:
-            while True:
-                data = await reader.readline()
-                if not data:
-                    break
-
-                try:
-                    message = json.loads(data.decode())
-                except json.JSONDecodeError as exc:
-                    await self._send(writer, {
-                        'status': 'error',
-                        'message': f"Invalid JSON: {exc.msg}"
-                    })
-                    continue
-
-                await self.process_message(message, writer)
+            first = await reader.read(1)
+            if first == framing.PREFACE[:1]:
+                preface = first + await reader.readexactly(len(framing.PREFACE) - 1)
+                if preface != framing.PREFACE:
+                    raise ValueError(f"Unsupported protocol preface: {preface!r}")
+                self.start_binary(writer)
+                await self._serve_binary(reader, writer)
+            elif first:
+                await self._serve_json(reader, writer, first)
         except asyncio.CancelledError:
             raise
+        except asyncio.IncompleteReadError:
+            pass
         except Exception as exc:
             print(f"Ошибка обработки клиента {addr}: {exc}")
         finally:
             await self._cleanup_writer(writer)
             print(f"Клиент отключен: {addr}")
 
-    async def process_message(self, message: dict, writer: asyncio.StreamWriter):
+    def add_connection(self, writer: asyncio.StreamWriter) -> ClientOutbox:
+        """Заводит очередь исходящих кадров нового соединения (потоки или протокол)."""
+        outbox = ClientOutbox(writer, self.outbox_size, self.overflow)
+        outbox.on_idle = lambda: self._replay(writer)
+        outbox.metrics = self.metrics
+        self.outboxes[writer] = outbox
+        self.metrics.connections += 1
+        if self.rate_limited and writer not in self.peers:
+            self.publish_limiters[writer] = PublishLimiter(*self.publish_limits,
+                                                           now=time.monotonic())
+        return outbox
+
+    def admit_connection(self) -> bool:
+        """Есть ли место для нового соединения; отказ учитывается в метриках.
+
+        Как неблокирующий acquire семафора в oct4/semaphore_demo.py: соединение
+        сверх лимита не ждет освобождения места, а сразу получает отказ.
+        """
+        if self.max_connections is None:
+            return True
+        peers = sum(1 for writer in self.peers if writer in self.outboxes)
+        if len(self.outboxes) - peers < self.max_connections:
+            return True
+        self.metrics.throttle('connections')
+        return False
+
+    def rejection(self, head: bytes) -> bytes:
+        """Ответ соединению сверх лимита - строка JSON с ошибкой.
+
+        Бинарный клиент получает ее вместо PREFACE, клиент JSON - как ответ на
+        свой первый запрос head (с его id, если запрос успел прийти целиком).
+        """
+        reply = {'status': 'error', 'message': 'Too many connections'}
+        if head[:1] == b'{':
+            try:
+                request_id = json.loads(head).get('id')
+            except (ValueError, AttributeError):
+                request_id = None
+            if request_id is not None:
+                reply['id'] = request_id
+        return self._encode(reply)
+
+    async def _reject_connection(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter):
+        head = b''
+        try:
+            head = await asyncio.wait_for(reader.read(1), self.REJECT_TIMEOUT)
+            if head == b'{':
+                head += await asyncio.wait_for(reader.readline(), self.REJECT_TIMEOUT)
+        except (asyncio.TimeoutError, ValueError, ConnectionError):
+            pass
+        try:
+            writer.write(self.rejection(head))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def start_binary(self, writer: asyncio.StreamWriter):
+        """Клиент прислал PREFACE: дальше соединение работает бинарными кадрами."""
+        outbox = self.outboxes[writer]
+        outbox.binary = True
+        outbox.put(framing.PREFACE)
+
+    async def _serve_json(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                          first: bytes = b''):
+        data = first + await reader.readline()
+        while data:
+            await self.handle_line(data, writer)
+            data = await reader.readline()
+
+    async def handle_line(self, data: bytes, writer: asyncio.StreamWriter):
+        # Отметка приема для трасс берется до разбора JSON.
+        received = time.monotonic() if self.traces is not None else None
+        try:
+            message = json.loads(data)
+        except (json.JSONDecodeError, UnicodeDecodeError) as exc:
+            self._send(writer, {
+                'status': 'error',
+                'message': f"Invalid JSON: {getattr(exc, 'msg', exc)}"
+            })
+        else:
+            await self.process_message(message, writer, received)
+
+    async def _serve_binary(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while True:
+            action, topic_id, request_id, payload = await framing.read_frame(
+                reader, self.max_frame_size)
+            await self.process_frame(action, topic_id, request_id, payload, writer)
+
+    async def process_message(self, message: dict, writer: asyncio.StreamWriter,
+                              received: float | None = None):
+        """Выполняет запрос JSON; received - отметка приема, если брокер ведет трассы."""
         action = message.get('action')
         topic = message.get('topic')
+        request_id = message.get('id')
+        if self.max_client_in_flight is not None and not self._admit_request(writer,
+                                                                              request_id):
+            return
 
         if action == 'publish':
-            await self._handle_publish(topic, message.get('message'), writer)
+            data = json.dumps(message.get('message')).encode()
+            await self._handle_publish(topic, data, writer, request_id, message.get('delay'),
+                                       message.get('ttl'), message.get('priority'),
+                                       received if message.get('trace') else None)
         elif action == 'subscribe':
-            await self._handle_subscribe(topic, writer)
+            position = self._position(message.get('offset', 'earliest'))
+            credit = None
+            if message.get('credit') is not None:
+                credit = (message['credit'], message.get('credit_bytes'))
+            await self._handle_subscribe(topic, writer, request_id, position, credit,
+                                         message.get('filter'))
         elif action == 'unsubscribe':
-            await self._handle_unsubscribe(topic, writer)
+            await self._handle_unsubscribe(topic, writer, request_id)
         elif action == 'get':
-            await self._handle_get(topic, writer)
+            await self._handle_get(topic, writer, request_id, message.get('offset'))
+        elif action == 'publish_batch':
+            messages = message.get('messages')
+            if not isinstance(messages, list):
+                self._send(writer, {
+                    'status': 'error',
+                    'message': 'messages must be a list'
+                }, request_id)
+                return
+            items = [json.dumps(item).encode() for item in messages]
+            await self._handle_publish_batch(topic, items, writer, request_id,
+                                             message.get('delay'), message.get('ttl'),
+                                             message.get('priority'),
+                                             received if message.get('trace') else None)
+        elif action == 'get_batch':
+            await self._handle_get_batch(topic, message.get('max_messages'),
+                                         message.get('max_bytes'), writer, request_id,
+                                         message.get('offset'))
+        elif action == 'stats':
+            self._handle_stats(writer, request_id)
+        elif action == 'join':
+            self._handle_join(topic, message.get('group'), writer, request_id,
+                              message.get('visibility_timeout'), message.get('max_in_flight'),
+                              self._position(message.get('offset', 'earliest')))
+        elif action == 'leave':
+            self._handle_leave(topic, writer, request_id)
+        elif action in ('ack', 'nack'):
+            offsets = message.get('offsets')
+            if offsets is None:
+                offsets = [message.get('offset')]
+            self._handle_settle(action, topic, offsets, writer, request_id)
+        elif action == 'credit':
+            self._handle_credit(topic, message.get('messages'), message.get('bytes'), writer,
+                                request_id)
+        elif action == 'trace':
+            self._handle_trace(topic, message.get('offset'), writer, request_id)
+        elif action == 'profile':
+            self._handle_profile(message.get('seconds'), message.get('interval'), writer,
+                                 request_id)
+        elif action == 'promote':
+            await self._handle_promote(writer, request_id)
+        elif action == 'compress':
+            self._send(writer, {
+                'status': 'error',
+                'message': 'Compression requires binary framing'
+            }, request_id)
+        elif action == 'follow':
+            await self._handle_follow(message.get('host'), message.get('port'), writer,
+                                      request_id)
         else:
-            await self._send(writer, {
+            self._send(writer, {
                 'status': 'error',
                 'message': f"Unknown action: {action}"
-            })
+            }, request_id)
+
+    def _admit_request(self, writer: asyncio.StreamWriter, request_id: int | None) -> bool:
+        """Не превышен ли лимит запросов соединения, ответ на которые еще не отправлен.
 
-    async def _handle_publish(self, topic: str, payload, writer: asyncio.StreamWriter):
+        В работе считаются ответы, ждущие записи в сокет (клиент не читает их
+        быстрее, чем шлет запросы), и публикации, ждущие подтверждения ведомых.
+        """
+        outbox = self.outboxes.get(writer)
+        if outbox is None:
+            return False
+        if writer in self.peers:
+            return True
+        in_flight = outbox.pending_replies + self.replicas.waiting(writer)
+        if in_flight < self.max_client_in_flight:
+            return True
+        self.metrics.throttle('in_flight')
+        self._send(writer, {
+            'status': 'error',
+            'message': 'Too many requests in flight',
+            'limit': self.max_client_in_flight
+        }, request_id)
+        return False
+
+    def _admit_publish(self, topic: str, count: int, size: int, writer: asyncio.StreamWriter,
+                       request_id: int | None = None) -> bool:
+        """Списывает публикацию с маркерных корзин соединения или отвечает отказом."""
+        limiter = self.publish_limiters.get(writer)
+        if limiter is None:
+            return True
+        refused = limiter.admit(count, size, time.monotonic())
+        if refused is None:
+            return True
+        reason, retry_after = refused
+        self.metrics.throttle(reason, count)
+        self._send(writer, {
+            'status': 'error',
+            'message': ('Publish byte rate limit exceeded' if reason == BYTES
+                        else 'Publish rate limit exceeded'),
+            'topic': topic,
+            'retry_after': round(retry_after, 3)
+        }, request_id)
+        return False
+
+    @staticmethod
+    def _position(value) -> int:
+        if value == 'earliest':
+            return framing.FROM_EARLIEST
+        if value == 'latest':
+            return framing.FROM_LATEST
+        return value
+
+    async def process_frame(self, action: int, topic_id: int, request_id: int,
+                            payload: bytes, writer: asyncio.StreamWriter):
+        """Выполняет бинарный запрос; неразборная нагрузка - ошибка только этого кадра."""
+        received = time.monotonic() if self.traces is not None else None
+        try:
+            await self._process_frame(action, topic_id, request_id, payload, writer, received)
+        except (struct.error, ValueError) as exc:
+            # Заголовок кадра цел, поэтому поток не сбит и соединение остается.
+            self._send(writer, {
+                'status': 'error',
+                'message': f"Malformed frame payload: {exc}"
+            }, request_id)
+
+    async def _process_frame(self, action: int, topic_id: int, request_id: int,
+                             payload: bytes, writer: asyncio.StreamWriter,
+                             received: float | None = None):
+        if action & framing.COMPRESSED:
+            # Пакет, сжатый целиком: его приходится распаковать, чтобы разобрать.
+            action &= ~framing.COMPRESSED
+            wire_size = len(payload)
+            payload = self._decompressed(payload, writer, request_id)
+            if payload is None:
+                return
+            self.metrics.batch_compressed(len(payload), wire_size)
+        # Подтверждения ведомых - не запросы: на них не отвечают.
+        if (self.max_client_in_flight is not None and action != framing.REPLICA_ACK
+                and not self._admit_request(writer, request_id)):
+            return
+        delay = ttl = priority = message_filter = traced = None
+        if action & framing.OPTIONS:
+            action &= ~framing.OPTIONS
+            if action == framing.SUBSCRIBE:
+                (length,) = framing.ITEM_LENGTH.unpack_from(payload)
+                start = framing.ITEM_LENGTH.size
+                message_filter = json.loads(payload[start:start + length])
+                payload = payload[start + length:]
+            else:
+                delay, ttl, priority, flags = framing.PUBLISH_OPTIONS.unpack_from(payload)
+                delay, ttl = delay or None, ttl or None
+                if priority == framing.NO_PRIORITY:
+                    priority = None
+                if flags & framing.PUBLISH_TRACE:
+                    traced = received
+                payload = payload[framing.PUBLISH_OPTIONS.size:]
+        if action == framing.BIND:
+            self._handle_bind(payload.decode(), writer, request_id)
+            return
+        if action == framing.STATS:
+            self._handle_stats(writer, request_id)
+            return
+        if action == framing.COMPRESS:
+            self._handle_compress(payload.decode(), writer, request_id)
+            return
+        if action == framing.REPLICATE:
+            self._handle_replicate(json.loads(payload or b'{}'), writer, request_id)
+            return
+        if action == framing.PROFILE:
+            seconds, interval = framing.PROFILE_OPTIONS.unpack(payload)
+            self._handle_profile(seconds, interval or None, writer, request_id)
+            return
+        if action == framing.PROMOTE:
+            await self._handle_promote(writer, request_id)
+            return
+        if action == framing.FOLLOW:
+            host, _, port = payload.decode(errors='replace').rpartition(':')
+            await self._handle_follow(host, port, writer, request_id)
+            return
+
+        topic = self.topic_names.get(topic_id)
         if topic is None:
-            await self._send(writer, {'status': 'error', 'message': 'Topic is required'})
+            self._send(writer, {
+                'status': 'error',
+                'message': f"Unknown topic id: {topic_id}"
+            }, request_id)
             return
 
-        self.queues[topic].append(payload)
+        if action == framing.PUBLISH:
+            items = self._checked_payloads(topic, [payload], writer, request_id)
+            if items is None:
+                return
+            await self._handle_publish(topic, items[0], writer, request_id, delay, ttl,
+                                       priority, traced)
+        elif action == framing.SUBSCRIBE:
+            position = framing.FROM_EARLIEST
+            credit = None
+            if payload:
+                position = framing.OFFSET.unpack_from(payload)[0]
+            if len(payload) > framing.OFFSET.size:
+                credit = framing.CREDIT_GRANT.unpack_from(payload, framing.OFFSET.size)
+            await self._handle_subscribe(topic, writer, request_id, position, credit,
+                                         message_filter)
+        elif action == framing.UNSUBSCRIBE:
+            await self._handle_unsubscribe(topic, writer, request_id)
+        elif action == framing.GET:
+            offset = framing.OFFSET.unpack(payload)[0] if payload else None
+            await self._handle_get(topic, writer, request_id, offset)
+        elif action == framing.PUBLISH_BATCH:
+            items = self._checked_payloads(topic, framing.unpack_items(payload), writer,
+                                           request_id)
+            if items is None:
+                return
+            await self._handle_publish_batch(topic, items, writer, request_id, delay, ttl,
+                                             priority, traced)
+        elif action == framing.GET_BATCH:
+            max_messages, max_bytes = framing.BATCH_LIMITS.unpack_from(payload)
+            offset = None
+            if len(payload) > framing.BATCH_LIMITS.size:
+                offset = framing.OFFSET.unpack_from(payload, framing.BATCH_LIMITS.size)[0]
+            await self._handle_get_batch(topic, max_messages, max_bytes or None,
+                                         writer, request_id, offset)
+        elif action == framing.JOIN:
+            visibility_timeout, max_in_flight, position = \
+                framing.GROUP_OPTIONS.unpack_from(payload)
+            group = payload[framing.GROUP_OPTIONS.size:].decode()
+            self._handle_join(topic, group, writer, request_id, visibility_timeout or None,
+                              max_in_flight or None, position)
+        elif action == framing.CREDIT:
+            messages, max_bytes = framing.CREDIT_GRANT.unpack(payload)
+            self._handle_credit(topic, messages, max_bytes, writer, request_id)
+        elif action == framing.LEAVE:
+            self._handle_leave(topic, writer, request_id)
+        elif action in (framing.ACK, framing.NACK):
+            self._handle_settle(framing.ACTION_NAMES[action], topic,
+                                framing.unpack_offsets(payload), writer, request_id)
+        elif action == framing.TRACE:
+            self._handle_trace(topic, framing.OFFSET.unpack(payload)[0], writer, request_id)
+        elif action == framing.REPLICA_ACK:
+            self._handle_replica_ack(topic, framing.OFFSET.unpack(payload)[0], writer)
+        else:
+            self._send(writer, {
+                'status': 'error',
+                'message': f"Unknown action code: {action}"
+            }, request_id)
+
+    def _checked_payloads(self, topic: str, items: list[bytes], writer: asyncio.StreamWriter,
+                          request_id: int | None = None) -> Optional[list[bytes]]:
+        """Проверяет данные бинарной публикации или отвечает ошибкой и возвращает None.
+
+        Данные вставляются в строки JSON-подписчиков как есть, и брокер их не
+        разбирает: проверяется только первый значащий байт документа. Перевод
+        строки в JSON может быть только пробельным символом вне строк, так что
+        он заменяется пробелом, и строка рассылки не рвется.
+
+        Сжатые данные хранятся как есть и здесь не распаковываются:
+        проверяются только согласование сжатия и заголовок, а распаковывает
+        их доставка клиентам без сжатия (StoredMessage.plain).
+        """
+        checked = []
+        for data in items:
+            if framing.is_compressed(data):
+                if not self._valid_compressed(data, writer, request_id):
+                    return None
+                checked.append(data)
+                continue
+            if not starts_json(data):
+                self._send(writer, {
+                    'status': 'error',
+                    'message': 'Message payload must be a JSON document',
+                    'topic': topic
+                }, request_id)
+                return None
+            checked.append(data.replace(b'\n', b' ') if b'\n' in data else data)
+        return checked
+
+    def _valid_compressed(self, data: bytes, writer: asyncio.StreamWriter,
+                          request_id: int | None = None) -> bool:
+        """Проверяет заголовок сжатых данных, не распаковывая их."""
+        if not self._negotiated(writer, request_id):
+            return False
+        try:
+            length = framing.raw_size(data)
+        except ValueError as exc:
+            self._send_compression_error(exc, writer, request_id)
+            return False
+        if length > self.max_frame_size:
+            self._send_compression_error(
+                f"{length} bytes exceed limit {self.max_frame_size}", writer, request_id)
+            return False
+        return True
+
+    def _decompressed(self, data: bytes, writer: asyncio.StreamWriter,
+                      request_id: int | None = None) -> Optional[bytes]:
+        """Распакованный пакет клиента или None после ответа с ошибкой."""
+        if not self._negotiated(writer, request_id):
+            return None
+        try:
+            return framing.decompress(data, self.max_frame_size)
+        except (ValueError, framing.FrameTooLarge) as exc:
+            self._send_compression_error(exc, writer, request_id)
+            return None
+
+    def _negotiated(self, writer: asyncio.StreamWriter, request_id: int | None = None) -> bool:
+        """Сжатые данные принимаются только от соединений, согласовавших сжатие."""
+        outbox = self.outboxes.get(writer)
+        if outbox is not None and outbox.compression:
+            return True
+        self._send(writer, {
+            'status': 'error',
+            'message': 'Compressed data requires negotiated compression'
+        }, request_id)
+        return False
+
+    def _send_compression_error(self, error, writer: asyncio.StreamWriter,
+                                request_id: int | None = None):
+        self._send(writer, {'status': 'error', 'message': f"Invalid compressed data: {error}"},
+                   request_id)
+
+    def _topic_id(self, topic: str) -> int:
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            topic_id = self._next_topic_id()
+            self.topic_ids[topic] = topic_id
+            self.topic_names[topic_id] = topic
+            # Новый топик: подписываем на него владельцев подходящих шаблонов.
+            if self.patterns and not is_pattern(topic):
+                start = self.queues[topic].next_offset
+                for pattern, writer in self.patterns.match(topic):
+                    self._attach(topic, writer, pattern, start)
+        return topic_id
 
-        await self._send(writer, {'status': 'published', 'topic': topic})
-        await self._push_to_subscribers(topic, payload)
+    def _next_topic_id(self) -> int:
+        return len(self.topic_ids) + 1
+
+    def _handle_bind(self, topic: str, writer: asyncio.StreamWriter,
+                     request_id: int | None = None):
+        topic_id = self._topic_id(topic)
+        self._send(writer, {'status': 'bound', 'topic': topic, 'topic_id': topic_id}, request_id)
+
+    def _handle_compress(self, codec: str, writer: asyncio.StreamWriter,
+                         request_id: int | None = None):
+        """Согласует сжатие: с этого момента соединению можно слать сжатые данные."""
+        if codec != framing.COMPRESSION_ZLIB or not self.compress_min_size:
+            self._send(writer, {
+                'status': 'error',
+                'message': f"Unsupported compression: {codec}"
+            }, request_id)
+            return
+        self.outboxes[writer].compression = True
+        self._send(writer, {
+            'status': 'ok',
+            'compression': codec,
+            'min_size': self.compress_min_size
+        }, request_id)
 
-    async def _handle_subscribe(self, topic: str, writer: asyncio.StreamWriter):
+    async def _handle_publish(self, topic: str, data: bytes, writer: asyncio.StreamWriter,
+                              request_id: int | None = None, delay: float | None = None,
+                              ttl: float | None = None, priority: int | None = None,
+                              traced: float | None = None):
+        """Публикует сообщение; delay и ttl - задержка доставки и время жизни, с.
+
+        Отложенное сообщение попадает в топик (и получает смещение) через delay
+        секунд, сообщение с ttl перестает доставляться через ttl секунд после
+        попадания в топик. priority (0 - самый срочный) принимают только
+        приоритетные топики. traced - отметка приема трассируемой публикации.
+        """
         if topic is None:
-            await self._send(writer, {'status': 'error', 'message': 'Topic is required'})
+            self._send(writer, {'status': 'error', 'message': 'Topic is required'}, request_id)
+            return
+        if is_pattern(topic):
+            self._send_pattern_error(writer, request_id)
+            return
+        if self._reject_on_follower(writer, request_id):
+            return
+        if not self._valid_publish_options(topic, delay, ttl, priority, writer, request_id):
+            return
+        if not self._admit_publish(topic, 1, len(data), writer, request_id):
             return
+        if delay:
+            self._schedule_delayed(topic, [data], delay, ttl, priority, traced)
+            self._send(writer, {'status': 'scheduled', 'topic': topic, 'delay': delay},
+                       request_id)
+            return
+
+        message = self._append(topic, data, ttl, priority)
+
+        reply = {'status': 'published', 'topic': topic}
+        if self._above_high_water(topic):
+            reply['slow_down'] = True
+        if traced is not None:
+            reply['trace'] = self.traces.start(message, traced, time.monotonic()).as_dict()
+        self._acknowledge(topic, message.offset, writer, reply, request_id)
+        self._push_to_subscribers(topic, message)
+        self._dispatch_groups(topic)
+
+    async def _handle_publish_batch(self, topic: str, items: list[bytes],
+                                    writer: asyncio.StreamWriter,
+                                    request_id: int | None = None, delay: float | None = None,
+                                    ttl: float | None = None, priority: int | None = None,
+                                    traced: float | None = None):
+        if topic is None:
+            self._send(writer, {'status': 'error', 'message': 'Topic is required'}, request_id)
+            return
+        if is_pattern(topic):
+            self._send_pattern_error(writer, request_id)
+            return
+        if self._reject_on_follower(writer, request_id):
+            return
+        if not self._valid_publish_options(topic, delay, ttl, priority, writer, request_id):
+            return
+        if not self._admit_publish(topic, len(items), sum(map(len, items)), writer,
+                                   request_id):
+            return
+        if delay:
+            self._schedule_delayed(topic, items, delay, ttl, priority, traced)
+            self._send(writer, {'status': 'scheduled', 'topic': topic, 'count': len(items),
+                                'delay': delay}, request_id)
+            return
+
+        messages = [self._append(topic, data, ttl, priority) for data in items]
+
+        reply = {'status': 'published', 'topic': topic, 'count': len(messages)}
+        if self._above_high_water(topic):
+            reply['slow_down'] = True
+        if traced is not None:
+            now = time.monotonic()
+            reply['traces'] = [self.traces.start(message, traced, now).as_dict()
+                               for message in messages]
+        if messages:
+            self._acknowledge(topic, messages[-1].offset, writer, reply, request_id)
+        else:
+            self._send(writer, reply, request_id)
+        for message in messages:
+            self._push_to_subscribers(topic, message)
+        self._dispatch_groups(topic)
+
+    def _above_high_water(self, topic: str) -> bool:
+        """Топик выше отметки: издателю пора притормозить, пока не сработало вытеснение."""
+        stats = self.topic_stats[topic]
+        return ((self.high_water_messages is not None
+                 and stats.messages > self.high_water_messages)
+                or (self.high_water_bytes is not None and stats.bytes > self.high_water_bytes))
+
+    @staticmethod
+    def _valid_timing(delay, ttl) -> bool:
+        def seconds(value) -> bool:
+            return (isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and math.isfinite(value))
+
+        return ((delay is None or (seconds(delay) and delay >= 0))
+                and (ttl is None or (seconds(ttl) and ttl > 0)))
+
+    def _valid_publish_options(self, topic: str, delay, ttl, priority,
+                               writer: asyncio.StreamWriter,
+                               request_id: int | None = None) -> bool:
+        """Проверяет параметры публикации; на неверные отвечает ошибкой."""
+        if not self._valid_timing(delay, ttl):
+            self._send(writer, {
+                'status': 'error',
+                'message': 'delay must be a non-negative and ttl a positive number of seconds'
+            }, request_id)
+            return False
+        if priority is None:
+            return True
+        if topic not in self.priority_topics:
+            self._send(writer, {
+                'status': 'error',
+                'message': f"Topic {topic} is not a priority topic"
+            }, request_id)
+            return False
+        if (not isinstance(priority, int) or isinstance(priority, bool)
+                or not 0 <= priority <= MAX_PRIORITY):
+            self._send(writer, {
+                'status': 'error',
+                'message': f"priority must be an integer from 0 to {MAX_PRIORITY}"
+            }, request_id)
+            return False
+        return True
+
+    def _schedule_delayed(self, topic: str, items: list[bytes], delay: float,
+                          ttl: float | None = None, priority: int | None = None,
+                          traced: float | None = None):
+        """Откладывает публикацию: смещения сообщения получат, когда попадут в топик.
+
+        traced - отметка приема трассируемой публикации: трасса заводится,
+        когда сообщение попадает в топик, и отсчитывается от приема.
+        """
+        entry = (time.monotonic() + delay, next(self._timer_sequence), topic, items, ttl,
+                 priority, traced)
+        delayed = self._delayed
+        heapq.heappush(delayed, entry)
+        self.topic_stats[topic].delayed += len(items)
+        if delayed[0] is entry:
+            self._timer_wakeup.set()
+
+    def _schedule_expiry(self, message: StoredMessage, ttl: float):
+        expiries = self._expiries
+        if len(expiries) >= self._expiries_compact_at:
+            # Забранные и вытесненные сообщения остаются в куче до своего
+            # срока; когда таких становится много, куча перестраивается.
+            expiries[:] = [item for item in expiries if not item[2].removed]
+            heapq.heapify(expiries)
+            self._expiries_compact_at = max(2 * len(expiries), 1024)
+
+        message.expires = message.created + ttl
+        entry = (message.expires, next(self._timer_sequence), message)
+        heapq.heappush(expiries, entry)
+        if expiries[0] is entry:
+            self._timer_wakeup.set()
+
+    async def _timer_loop(self):
+        """Выпускает отложенные публикации и удаляет истекшие сообщения.
+
+        Одна задача на все сроки: она спит до ближайшего из них, а публикация,
+        ставящая более ранний срок, будит ее. Поэтому миллионы ожидающих
+        сообщений стоят по элементу кучи, а не по задаче или таймеру цикла.
+        """
+        delayed, expiries = self._delayed, self._expiries
+        while True:
+            now = time.monotonic()
+            released = set()
+            while delayed and delayed[0][0] <= now:
+                _, _, topic, items, ttl, priority, traced = heapq.heappop(delayed)
+                self.topic_stats[topic].delayed -= len(items)
+                for data in items:
+                    message = self._append(topic, data, ttl, priority)
+                    if traced is not None:
+                        self.traces.start(message, traced, time.monotonic())
+                    self._push_to_subscribers(topic, message)
+                released.add(topic)
+            for topic in released:
+                self._dispatch_groups(topic)
+
+            expired = set()
+            while expiries and expiries[0][0] <= now:
+                message = heapq.heappop(expiries)[2]
+                if not message.removed:
+                    expired.add(message.topic)
+            for topic in expired:
+                self._drop_expired(topic, now)
+
+            self._timer_wakeup.clear()
+            deadlines = [heap[0][0] for heap in (delayed, expiries) if heap]
+            timeout = min(deadlines) - now if deadlines else None
+            try:
+                await asyncio.wait_for(self._timer_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _drop_expired(self, topic: str, now: float):
+        """Удаляет истекшие сообщения из головы топика.
+
+        Топик удаляет сообщения только с головы, поэтому истекшее сообщение за
+        живым остается в памяти до своей очереди, но уже не доставляется.
+        """
+        queue = self.queues[topic]
+        stats = self.topic_stats[topic]
+        while queue and queue[0].expired(now):
+            self._pop(topic)
+            stats.expired += 1
+
+    def _append(self, topic: str, data: bytes, ttl: float | None = None,
+                priority: int | None = None) -> StoredMessage:
+        offset = self.queues[topic].next_offset
+        message = StoredMessage(topic, self._topic_id(topic), offset, data)
+        if priority is not None:
+            message.priority = priority
+        if ttl is not None:
+            self._schedule_expiry(message, ttl)
+        if self.storage is not None:
+            self.storage.append(topic, data, offset)
+        self._store(message)
+        self.metrics.published(topic, message.size, framing.raw_size(data))
+        self._enforce_retention(topic)
+        return message
+
+    def _store(self, message: StoredMessage):
+        topic = message.topic
+        self.queues[topic].append(message)
+        if topic in self.priority_topics:
+            self.priority_index[topic].push(message)
+        if not self.global_retention.unlimited:
+            self._all_messages.append(message)
+
+        stats = self.topic_stats[topic]
+        stats.messages += 1
+        stats.bytes += message.size
+        self.total_messages += 1
+        self.total_bytes += message.size
+
+    def _pop(self, topic: str) -> StoredMessage:
+        message = self.queues[topic][0]
+        self._take(topic, message)
+        return message
+
+    def _take(self, topic: str, message: StoredMessage):
+        """Удаляет сообщение топика, в том числе из середины (приоритетные топики).
+
+        Журнал топика сокращается только с головы, поэтому сообщение из
+        середины лишь помечается удаленным и освобождается, когда до него
+        дойдет голова. В голове журнала удаленных сообщений не остается.
+        """
+        message.removed = True
+        stats = self.topic_stats[topic]
+        stats.messages -= 1
+        stats.bytes -= message.size
+        self.total_messages -= 1
+        self.total_bytes -= message.size
+
+        queue = self.queues[topic]
+        while queue and queue[0].removed:
+            queue.popleft()
+            if self.storage is not None:
+                self.storage.advance_head(topic)
+
+    def _take_by_priority(self, topic: str, limit: int, max_bytes: int | None,
+                          now: float) -> list[StoredMessage]:
+        """Забирает до limit самых срочных сообщений приоритетного топика.
+
+        Как и в get_batch, первое сообщение отдается даже сверх max_bytes;
+        встреченные истекшие сообщения удаляются.
+        """
+        index = self.priority_index[topic]
+        stats = self.topic_stats[topic]
+        messages = []
+        size = 0
+        while len(messages) < limit:
+            message = index.peek()
+            if message is None:
+                break
+            if message.expired(now):
+                self._take(topic, index.pop())
+                stats.expired += 1
+                continue
+            size += message.size
+            if messages and max_bytes is not None and size > max_bytes:
+                break
+            self._take(topic, index.pop())
+            messages.append(message)
+        return messages
+
+    def _evict(self, topic: str):
+        message = self._pop(topic)
+        stats = self.topic_stats[topic]
+        stats.evicted += 1
+        stats.evicted_bytes += message.size
+        self.evicted += 1
+
+    def _policy_for(self, topic: str) -> RetentionPolicy:
+        return self.topic_retention.get(topic, self.retention)
+
+    def _has_age_limits(self) -> bool:
+        policies = [self.retention, self.global_retention, *self.topic_retention.values()]
+        return any(policy.max_age is not None for policy in policies)
+
+    def _enforce_retention(self, topic: str, now: Optional[float] = None):
+        """Вытесняет самые старые сообщения: сначала по лимитам топика, затем глобальным.
+
+        Очереди упорядочены по времени публикации, поэтому вытеснение всегда
+        идет с головы и стоит O(1) на сообщение.
+        """
+        policy = self._policy_for(topic)
+        queue = self.queues[topic]
+        stats = self.topic_stats[topic]
+        if not policy.unlimited:
+            if policy.max_age is not None and now is None:
+                now = time.monotonic()
+            while queue and (policy.exceeded(stats.messages, stats.bytes)
+                             or policy.expired(queue[0].created, now)):
+                self._evict(topic)
+
+        self._enforce_global_retention(now)
+
+    def _enforce_global_retention(self, now: Optional[float] = None):
+        policy = self.global_retention
+        if not policy.unlimited:
+            if policy.max_age is not None and now is None:
+                now = time.monotonic()
+            messages = self._all_messages
+            while messages:
+                oldest = messages[0]
+                if oldest.removed:
+                    messages.popleft()
+                    continue
+                if not (policy.exceeded(self.total_messages, self.total_bytes)
+                        or policy.expired(oldest.created, now)):
+                    break
+                # Более старые сообщения этого топика уже удалены, значит
+                # oldest находится в голове своей очереди.
+                messages.popleft()
+                self._evict(oldest.topic)
+
+        self._compact_all_messages()
+
+    def _compact_all_messages(self):
+        messages = self._all_messages
+        if len(messages) > 2 * self.total_messages + 1024:
+            self._all_messages = deque(message for message in messages if not message.removed)
 
-        self.subscribers[topic].add(writer)
+    async def _retention_loop(self):
+        while True:
+            await asyncio.sleep(self.retention_interval)
+            now = time.monotonic()
+            for topic in list(self.queues):
+                if self.queues[topic]:
+                    self._enforce_retention(topic, now)
+            self._enforce_global_retention(now)
+
+    async def _handle_subscribe(self, topic: str, writer: asyncio.StreamWriter,
+                                request_id: int | None = None,
+                                position: int = framing.FROM_EARLIEST,
+                                credit: Optional[tuple[int, Optional[int]]] = None,
+                                message_filter: Optional[dict] = None):
+        """Подписывает с заданной позиции: смещения, самого старого или только новых.
+
+        Бэклог не копируется: у подписки есть курсор, и задача записи
+        соединения досылает сообщения порциями по мере отправки предыдущих.
+        credit - начальный кредит (сообщений, байт): с ним брокер рассылает
+        подписке только то, что разрешил подписчик. message_filter - фильтр по
+        полям сообщений (message_filters): остальные сообщения подписчику не
+        отправляются.
+        """
+        if topic is None:
+            self._send(writer, {'status': 'error', 'message': 'Topic is required'}, request_id)
+            return
+        if not self._valid_offset(position, (framing.FROM_EARLIEST, framing.FROM_LATEST)):
+            self._send_offset_error(writer, request_id)
+            return
+        if is_pattern(topic):
+            if credit is not None or message_filter is not None:
+                self._send(writer, {
+                    'status': 'error',
+                    'message': 'Credit and filters apply only to concrete topics'
+                }, request_id)
+                return
+            self._subscribe_pattern(topic, writer, request_id, position)
+            return
+        if credit is not None and not self._valid_credit(*credit):
+            self._send_credit_error(writer, request_id)
+            return
+        compiled = None
+        if message_filter is not None:
+            try:
+                compiled = MessageFilter(message_filter)
+            except ValueError as exc:
+                self._send(writer, {'status': 'error', 'message': f"Invalid filter: {exc}"},
+                           request_id)
+                return
+
+        queue = self.queues[topic]
+        if position == framing.FROM_LATEST:
+            start = queue.next_offset
+        elif position == framing.FROM_EARLIEST:
+            start = queue.first_offset
+        else:
+            start = max(position, queue.first_offset)
+
+        subscription = Subscription(writer, topic, start)
+        if credit is not None:
+            subscription.grant(*credit)
+        previous = self.subscribers[topic].get(writer)
+        if previous is not None:
+            subscription.sources |= previous.sources
+            self._unindex_filter(previous)
+        if compiled is not None:
+            subscription.filter = compiled
+            subscription.live = start == queue.next_offset
+            self.filter_index.setdefault(topic, FilterIndex()).add(subscription)
+        self.subscribers[topic][writer] = subscription
         self.writer_topics[writer].add(topic)
 
-        await self._send(writer, {'status': 'subscribed', 'topic': topic})
+        self._send(writer, {'status': 'subscribed', 'topic': topic, 'offset': start}, request_id)
 
-        if self.queues[topic]:
-            for message in list(self.queues[topic]):
-                await self._send(writer, {
-                    'type': 'message',
-                    'topic': topic,
-                    'data': message
-                })
+        if start < queue.next_offset:
+            self.outboxes[writer].wake()
 
-    async def _handle_unsubscribe(self, topic: str, writer: asyncio.StreamWriter):
+    async def _handle_unsubscribe(self, topic: str, writer: asyncio.StreamWriter,
+                                  request_id: int | None = None):
         if topic is None:
-            await self._send(writer, {'status': 'error', 'message': 'Topic is required'})
+            self._send(writer, {'status': 'error', 'message': 'Topic is required'}, request_id)
+            return
+
+        if is_pattern(topic):
+            self.patterns.remove(topic, writer)
+            self.writer_patterns.get(writer, set()).discard(topic)
+            for matched in list(self.writer_topics.get(writer, ())):
+                self._detach(matched, writer, topic)
+        else:
+            self._detach(topic, writer, topic)
+
+        self._send(writer, {'status': 'unsubscribed', 'topic': topic}, request_id)
+
+    def _subscribe_pattern(self, pattern: str, writer: asyncio.StreamWriter,
+                           request_id: int | None = None,
+                           position: int = framing.FROM_EARLIEST):
+        """Подписывает на все существующие и будущие топики, подходящие под шаблон."""
+        if position not in (framing.FROM_EARLIEST, framing.FROM_LATEST):
+            self._send(writer, {
+                'status': 'error',
+                'message': 'Wildcard subscriptions accept only earliest or latest offsets'
+            }, request_id)
             return
 
-        self.subscribers[topic].discard(writer)
-        if writer in self.writer_topics:
+        self.patterns.add(pattern, writer)
+        self.writer_patterns[writer].add(pattern)
+        self._send(writer, {'status': 'subscribed', 'topic': pattern}, request_id)
+
+        backlog = False
+        for topic in list(self.topic_ids):
+            if is_pattern(topic) or not matches(pattern, topic):
+                continue
+            queue = self.queues[topic]
+            start = queue.first_offset if position == framing.FROM_EARLIEST else queue.next_offset
+            self._attach(topic, writer, pattern, start)
+            backlog = backlog or start < queue.next_offset
+
+        if backlog:
+            self.outboxes[writer].wake()
+
+    def _attach(self, topic: str, writer: asyncio.StreamWriter, source: str, start: int):
+        subscription = self.subscribers[topic].get(writer)
+        if subscription is not None:
+            subscription.sources.add(source)
+            return
+
+        self.subscribers[topic][writer] = Subscription(writer, topic, start, source)
+        self.writer_topics[writer].add(topic)
+        outbox = self.outboxes.get(writer)
+        if outbox is not None and outbox.binary:
+            # Бинарный клиент не привязывал этот топик сам: сообщаем ему id
+            # до первой рассылки, ответ с нулевым id запроса.
+            self._send(writer, {'status': 'bound', 'topic': topic,
+                                'topic_id': self._topic_id(topic)})
+
+    def _detach(self, topic: str, writer: asyncio.StreamWriter, source: str):
+        subscription = self.subscribers[topic].get(writer)
+        if subscription is None:
+            return
+        subscription.sources.discard(source)
+        if not subscription.sources:
+            del self.subscribers[topic][writer]
             self.writer_topics[writer].discard(topic)
+            self._unindex_filter(subscription)
+
+    def _unindex_filter(self, subscription: Subscription):
+        if subscription.filter is None:
+            return
+        index = self.filter_index[subscription.topic]
+        index.remove(subscription)
+        if not index:
+            del self.filter_index[subscription.topic]
+
+    def _handle_credit(self, topic: str, messages: int, max_bytes: int | None,
+                       writer: asyncio.StreamWriter, request_id: int | None = None):
+        """Пополняет кредит подписки и досылает то, что ждало за курсором."""
+        if not self._valid_credit(messages, max_bytes):
+            self._send_credit_error(writer, request_id)
+            return
+        subscription = self.subscribers.get(topic, {}).get(writer)
+        if subscription is None:
+            self._send(writer, {
+                'status': 'error',
+                'message': f"Not subscribed to topic {topic}"
+            }, request_id)
+            return
+
+        subscription.grant(messages, max_bytes)
+        self._send(writer, {
+            'status': 'credited',
+            'topic': topic,
+            'messages': subscription.credit_messages,
+            'bytes': subscription.credit_bytes
+        }, request_id)
+        if subscription.has_credit and (subscription.next_offset < self.queues[topic].next_offset
+                                        or subscription.pending):
+            self.outboxes[writer].wake()
+
+    @staticmethod
+    def _valid_credit(messages, max_bytes) -> bool:
+        return (isinstance(messages, int) and messages >= 0
+                and (max_bytes is None or (isinstance(max_bytes, int) and max_bytes >= 0)))
+
+    def _send_credit_error(self, writer: asyncio.StreamWriter, request_id: int | None = None):
+        self._send(writer, {
+            'status': 'error',
+            'message': 'Credit must be a non-negative number of messages and bytes'
+        }, request_id)
+
+    def _send_pattern_error(self, writer: asyncio.StreamWriter, request_id: int | None = None):
+        self._send(writer, {
+            'status': 'error',
+            'message': 'Wildcard patterns are only allowed in subscribe and unsubscribe'
+        }, request_id)
+
+    async def _handle_get(self, topic: str, writer: asyncio.StreamWriter,
+                          request_id: int | None = None, offset: int | None = None):
+        """Без offset забирает сообщение из головы очереди, с offset - читает не удаляя."""
+        if topic is None:
+            self._send(writer, {'status': 'error', 'message': 'Topic is required'}, request_id)
+            return
+        if is_pattern(topic):
+            self._send_pattern_error(writer, request_id)
+            return
+        if offset is not None and not self._valid_offset(offset):
+            self._send_offset_error(writer, request_id)
+            return
+        if offset is None and (self._reject_on_follower(writer, request_id)
+                               or self._reject_unreplicated_get(writer, request_id)):
+            return
+
+        queue = self.queues[topic]
+        now = time.monotonic()
+        if offset is None and topic in self.priority_topics:
+            taken = self._take_by_priority(topic, 1, None, now)
+            message = taken[0] if taken else None
+        elif offset is None:
+            self._drop_expired(topic, now)
+            message = self._pop(topic) if queue else None
+        else:
+            # Истекшие и забранные по приоритету пропускаются, но не дальше
+            # max_batch_size сообщений.
+            candidates = itertools.islice(queue.iter_from(offset), self.max_batch_size)
+            message = next((message for message in candidates
+                            if not message.removed and not message.expired(now)), None)
+        self._send_data(writer, topic, message, request_id)
 
-        await self._send(writer, {'status': 'unsubscribed', 'topic': topic})
+    async def _handle_get_batch(self, topic: str, max_messages: int | None,
+                                max_bytes: int | None, writer: asyncio.StreamWriter,
+                                request_id: int | None = None, offset: int | None = None):
+        """Забирает до max_messages сообщений, пока их суммарный размер не превысит max_bytes.
 
-    async def _handle_get(self, topic: str, writer: asyncio.StreamWriter):
+        Первое сообщение отдается всегда, даже если оно само больше бюджета,
+        иначе такой топик невозможно было бы вычитать. С offset сообщения
+        читаются начиная с этого смещения и остаются в топике.
+        """
         if topic is None:
-            await self._send(writer, {'status': 'error', 'message': 'Topic is required'})
+            self._send(writer, {'status': 'error', 'message': 'Topic is required'}, request_id)
+            return
+        if is_pattern(topic):
+            self._send_pattern_error(writer, request_id)
+            return
+        if offset is not None and not self._valid_offset(offset):
+            self._send_offset_error(writer, request_id)
+            return
+        if offset is None and (self._reject_on_follower(writer, request_id)
+                               or self._reject_unreplicated_get(writer, request_id)):
+            return
+
+        limit = min(max_messages or self.max_batch_size, self.max_batch_size)
+        queue = self.queues[topic]
+        now = time.monotonic()
+        if offset is None and topic in self.priority_topics:
+            self._send_batch(writer, topic, self._take_by_priority(topic, limit, max_bytes, now),
+                             request_id)
             return
+        if offset is None:
+            self._drop_expired(topic, now)
+        candidates = queue if offset is None else queue.read_from(offset, limit)
+        messages = []
+        # Сколько сообщений с головы прочитано, включая пропущенные истекшие.
+        scanned = 0
+        size = 0
+        for message in candidates:
+            if message.removed or message.expired(now):
+                scanned += 1
+                continue
+            size += message.size
+            if len(messages) >= limit or (messages and max_bytes is not None and size > max_bytes):
+                break
+            messages.append(message)
+            scanned += 1
 
-        message = self.queues[topic].popleft() if self.queues[topic] else None
-        await self._send(writer, {
+        if offset is None:
+            stats = self.topic_stats[topic]
+            for _ in range(scanned):
+                if self._pop(topic).expired(now):
+                    stats.expired += 1
+        self._send_batch(writer, topic, messages, request_id)
+
+    @staticmethod
+    def _valid_offset(offset, positions: tuple[int, ...] = ()) -> bool:
+        """Смещение - неотрицательное целое или одна из допустимых позиций."""
+        return (isinstance(offset, int) and not isinstance(offset, bool)
+                and (offset >= 0 or offset in positions))
+
+    def _send_offset_error(self, writer: asyncio.StreamWriter, request_id: int | None = None):
+        self._send(writer, {
+            'status': 'error',
+            'message': 'Offset must be a non-negative integer'
+        }, request_id)
+
+    def _handle_stats(self, writer: asyncio.StreamWriter, request_id: int | None = None):
+        self._send(writer, {
             'status': 'ok',
+            'messages': self.total_messages,
+            'bytes': self.total_bytes,
+            'evicted': self.evicted,
+            'delayed': sum(stats.delayed for stats in self.topic_stats.values()),
+            'role': self.role,
+            'replicas': len(self.replicas),
+            'offsets': self.replication_positions(),
+            'clients': len(self.outboxes),
+            'connections': self.metrics.connections,
+            'errors': self.metrics.errors,
+            'traces': len(self.traces) if self.traces is not None else None,
+            'profiling': self.profiler is not None,
+            'admission': {
+                'max_connections': self.max_connections,
+                'max_client_in_flight': self.max_client_in_flight,
+                'throttled': dict(self.metrics.throttled),
+                'throttled_messages': self.metrics.throttled_messages
+            },
+            'topics': {
+                topic: {**stats.as_dict(), **self.metrics.counters(topic),
+                        'subscribers': len(self.subscribers.get(topic, ())),
+                        'filtered_subscribers': len(self.filter_index.get(topic, ())),
+                        'priority': topic in self.priority_topics}
+                for topic, stats in self.topic_stats.items()
+            },
+            'compression': {'min_size': self.compress_min_size,
+                            **self.metrics.compression()},
+            'latency': {
+                'deliver_seconds': self.metrics.deliver_latency.as_dict(),
+                'drain_seconds': self.metrics.drain_time.as_dict()
+            },
+            'groups': {
+                topic: {name: group.stats(self.queues[topic]) for name, group in groups.items()}
+                for topic, groups in self.groups.items() if groups
+            }
+        }, request_id)
+
+    def _handle_trace(self, topic: str, offset, writer: asyncio.StreamWriter,
+                      request_id: int | None = None):
+        """Отвечает трассой сообщения topic/offset, опубликованного с флагом trace."""
+        if self.traces is None:
+            self._send(writer, {'status': 'error', 'message': 'Tracing is disabled'},
+                       request_id)
+            return
+        if topic is None or not self._valid_offset(offset):
+            self._send(writer, {
+                'status': 'error',
+                'message': 'Trace requires a topic and a non-negative integer offset'
+            }, request_id)
+            return
+        trace = self.traces.get(topic, offset)
+        if trace is None:
+            self._send(writer, {'status': 'error', 'message': 'No trace for this message',
+                                'topic': topic, 'offset': offset}, request_id)
+            return
+        self._send(writer, {'status': 'ok', 'topic': topic, 'trace': trace.as_dict()},
+                   request_id)
+
+    def _handle_profile(self, seconds, interval, writer: asyncio.StreamWriter,
+                        request_id: int | None = None):
+        """Запускает выборочный профилировщик на seconds секунд; отчет придет ответом.
+
+        Ответ отправляет отдельная задача, поэтому соединение тем временем
+        продолжает обслуживать другие запросы. Как promote и follow, доступен
+        только с --allow-admin.
+        """
+        if self._reject_admin(writer, request_id):
+            return
+
+        def positive(value) -> bool:
+            return (isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and 0 < value < math.inf)
+
+        if interval is None:
+            interval = DEFAULT_INTERVAL
+        if not positive(seconds) or seconds > MAX_SECONDS or not positive(interval):
+            self._send(writer, {
+                'status': 'error',
+                'message': f'Profile needs 0 < seconds <= {MAX_SECONDS:g} and a positive interval'
+            }, request_id)
+            return
+        if self.profiler is not None:
+            self._send(writer, {'status': 'error', 'message': 'Profiler is already running'},
+                       request_id)
+            return
+        self.profiler = SamplingProfiler(interval=interval)
+        self.profiler.start()
+        self._profile_task = asyncio.create_task(self._finish_profile(seconds, writer,
+                                                                      request_id))
+
+    async def _finish_profile(self, seconds: float, writer: asyncio.StreamWriter,
+                              request_id: int | None):
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            report = self.profiler.stop()
+            self.profiler = None
+            self._profile_task = None
+        self._send(writer, {'status': 'ok', 'profile': report}, request_id)
+
+    def _handle_join(self, topic: str, name: str, writer: asyncio.StreamWriter,
+                     request_id: int | None = None, visibility_timeout: float | None = None,
+                     max_in_flight: int | None = None,
+                     position: int = framing.FROM_EARLIEST):
+        """Добавляет соединение в группу; позиция учитывается только при создании группы."""
+        if topic is None or not name:
+            self._send(writer, {
+                'status': 'error',
+                'message': 'Topic and group are required'
+            }, request_id)
+            return
+        if is_pattern(topic):
+            self._send_pattern_error(writer, request_id)
+            return
+        if not self._valid_offset(position, (framing.FROM_EARLIEST, framing.FROM_LATEST)):
+            self._send_offset_error(writer, request_id)
+            return
+        if self._reject_on_follower(writer, request_id):
+            return
+
+        group = self.groups[topic].get(name)
+        if group is None:
+            queue = self.queues[topic]
+            if position == framing.FROM_LATEST:
+                start = queue.next_offset
+            elif position == framing.FROM_EARLIEST:
+                start = queue.first_offset
+            else:
+                start = max(position, queue.first_offset)
+            group = ConsumerGroup(name, topic, start,
+                                  visibility_timeout or self.visibility_timeout)
+            self.groups[topic][name] = group
+        elif visibility_timeout:
+            group.visibility_timeout = visibility_timeout
+
+        current = self.writer_groups[writer].get(topic)
+        if current is not None and current is not group:
+            self._leave_group(current, writer)
+        group.join(writer, max_in_flight or self.max_in_flight)
+        self.writer_groups[writer][topic] = group
+
+        self._send(writer, {
+            'status': 'joined',
+            'topic': topic,
+            'group': name,
+            'offset': group.next_offset,
+            'members': len(group.members)
+        }, request_id)
+        self._dispatch_group(group)
+
+    def _handle_leave(self, topic: str, writer: asyncio.StreamWriter,
+                      request_id: int | None = None):
+        group = self.writer_groups.get(writer, {}).pop(topic, None)
+        if group is None:
+            self._send(writer, {
+                'status': 'error',
+                'message': f"Not a member of any group for topic {topic}"
+            }, request_id)
+            return
+
+        self._leave_group(group, writer)
+        self._send(writer, {'status': 'left', 'topic': topic, 'group': group.name}, request_id)
+
+    def _handle_settle(self, action: str, topic: str, offsets: list,
+                       writer: asyncio.StreamWriter, request_id: int | None = None):
+        """ack подтверждает обработку сообщений, nack сразу возвращает их группе."""
+        group = self.writer_groups.get(writer, {}).get(topic)
+        if group is None:
+            self._send(writer, {
+                'status': 'error',
+                'message': f"Not a member of any group for topic {topic}"
+            }, request_id)
+            return
+
+        settle = group.ack if action == 'ack' else group.nack
+        unknown = [offset for offset in offsets if not settle(writer, offset)]
+
+        reply = {
+            'status': f"{action}ed",
             'topic': topic,
-            'data': message
-        })
+            'group': group.name,
+            'count': len(offsets) - len(unknown)
+        }
+        if unknown:
+            reply['unknown'] = unknown
+        self._send(writer, reply, request_id)
+        self._dispatch_group(group)
+
+    def _leave_group(self, group: ConsumerGroup, writer: asyncio.StreamWriter):
+        group.leave(writer)
+        self._dispatch_group(group)
+
+    def _dispatch_groups(self, topic: str):
+        groups = self.groups.get(topic)
+        if groups:
+            for group in groups.values():
+                self._dispatch_group(group)
+
+    def _dispatch_group(self, group: ConsumerGroup):
+        """Раздает сообщения по кругу участникам, у которых есть место для аренды.
+
+        Кадр рассылки общий с обычными подписчиками: участник узнает группу по
+        топику, а сообщение - по смещению.
+        """
+        queue = self.queues[group.topic]
+        now = None
+        while True:
+            member = group.next_member()
+            if member is None:
+                return
+            if now is None:
+                now = time.monotonic()
+            found = group.next_message(queue, now)
+            if found is None:
+                return
+
+            message, attempt = found
+            lease = group.lease(message, attempt, member, now)
+            self._schedule_lease(lease)
+            outbox = self.outboxes.get(member.writer)
+            if outbox is not None:
+                outbox.put(message.frame(outbox.binary, outbox.compression), message=message)
+
+    def _schedule_lease(self, lease: Lease):
+        leases = self._leases
+        if len(leases) >= self._leases_compact_at:
+            # Подтвержденные аренды остаются в куче до своего срока; когда
+            # таких становится много, куча перестраивается из активных.
+            leases[:] = [item for item in leases if item.active]
+            heapq.heapify(leases)
+            self._leases_compact_at = max(2 * len(leases), 1024)
+
+        heapq.heappush(leases, lease)
+        if leases[0] is lease:
+            self._lease_wakeup.set()
+
+    async def _lease_loop(self):
+        """Возвращает группам сообщения с истекшей арендой; спит до ближайшего срока."""
+        leases = self._leases
+        while True:
+            now = time.monotonic()
+            expired = set()
+            while leases and leases[0].deadline <= now:
+                lease = heapq.heappop(leases)
+                if lease.active:
+                    lease.group.release(lease)
+                    expired.add(lease.group)
+            for group in expired:
+                self._dispatch_group(group)
+
+            self._lease_wakeup.clear()
+            timeout = leases[0].deadline - now if leases else None
+            try:
+                await asyncio.wait_for(self._lease_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    @property
+    def role(self) -> str:
+        return 'follower' if self.follower is not None else 'leader'
+
+    def _reject_on_follower(self, writer: asyncio.StreamWriter,
+                            request_id: int | None = None) -> bool:
+        """Ведомый только читает: изменения принимает лидер."""
+        if self.follower is None:
+            return False
+        self._send(writer, {
+            'status': 'error',
+            'message': 'Read-only follower, send changes to the leader',
+            'leader': self.follower.address
+        }, request_id)
+        return True
+
+    def _reject_unreplicated_get(self, writer: asyncio.StreamWriter,
+                                 request_id: int | None = None) -> bool:
+        """Лидер с ведомыми не отдает сообщения get без offset.
+
+        Забор сообщения ведомым не передается, и после переключения забранное
+        вернулось бы в очередь; с репликацией читают по смещению или группой.
+        """
+        if self.replicas.min_replicas <= 0 and not self.replicas:
+            return False
+        self._send(writer, {
+            'status': 'error',
+            'message': 'Destructive get is not replicated, read by offset or join a group'
+        }, request_id)
+        return True
+
+    def _reject_admin(self, writer: asyncio.StreamWriter,
+                      request_id: int | None = None) -> bool:
+        if self.allow_admin:
+            return False
+        self._send(writer, {
+            'status': 'error',
+            'message': 'Admin actions are disabled on this broker'
+        }, request_id)
+        return True
+
+    def _reject_replica(self, writer: asyncio.StreamWriter,
+                        request_id: int | None = None) -> bool:
+        """Реплицироваться могут адреса из replica_hosts или любой узел с allow_admin."""
+        peer = writer.get_extra_info('peername')
+        if self.allow_admin or (peer and peer[0] in self.replica_hosts):
+            return False
+        self._send(writer, {
+            'status': 'error',
+            'message': 'Replication is not allowed from this address'
+        }, request_id)
+        return True
+
+    def _acknowledge(self, topic: str, offset: int, writer: asyncio.StreamWriter,
+                     reply: dict, request_id: int | None = None):
+        """Отвечает издателю сразу или когда сообщение получат min_replicas ведомых."""
+        if self.replicas.min_replicas > 0 and self.replicas.replicated(topic) <= offset:
+            self.replicas.wait(topic, offset, writer, reply, request_id, time.monotonic())
+        else:
+            self._send(writer, reply, request_id)
+
+    def replication_positions(self) -> dict[str, int]:
+        return {topic: self.queues[topic].next_offset
+                for topic in self.topic_ids if not is_pattern(topic)}
+
+    def _handle_replicate(self, positions: dict, writer: asyncio.StreamWriter,
+                          request_id: int | None = None):
+        """Подключает ведомого: все топики с его позиций, без потерь при отставании."""
+        if self._reject_replica(writer, request_id):
+            return
+        outbox = self.outboxes[writer]
+        outbox.lossless = True
+        # Ведомый хранит сообщения в том же виде, что и лидер.
+        outbox.compression = True
+        self.replicas.add(writer)
+        self._send(writer, {
+            'status': 'replicating',
+            'offsets': self.replication_positions()
+        }, request_id)
+
+        self.patterns.add('#', writer)
+        self.writer_patterns[writer].add('#')
+        for topic in list(self.topic_ids):
+            if is_pattern(topic):
+                continue
+            queue = self.queues[topic]
+            start = max(min(positions.get(topic, 0), queue.next_offset), queue.first_offset)
+            self._attach(topic, writer, '#', start)
+        outbox.wake()
+
+    def _handle_replica_ack(self, topic: str, next_offset: int, writer: asyncio.StreamWriter):
+        # Подтверждения принимаются только от подключенных через REPLICATE
+        # ведомых (record игнорирует остальные соединения).
+        for pending in self.replicas.record(writer, topic, next_offset):
+            self._send(pending.writer, pending.reply, pending.request_id)
+
+    async def _replication_loop(self):
+        interval = min(self.replicas.timeout / 4, 0.1)
+        while True:
+            await asyncio.sleep(interval)
+            for pending in self.replicas.expired(time.monotonic()):
+                self._send(pending.writer, {
+                    'status': 'error',
+                    'topic': pending.topic,
+                    'message': 'Not enough replicas acknowledged the message'
+                }, pending.request_id)
+
+    def apply_replicated(self, topic: str, offset: int, data: bytes):
+        """Добавляет на ведомом сообщение лидера с тем же смещением."""
+        queue = self.queues[topic]
+        if offset < queue.next_offset:
+            return
+        if offset > queue.next_offset:
+            # Лидер уже вытеснил сообщения между нашими: начинаем топик заново.
+            while queue:
+                self._evict(topic)
+            queue.next_offset = offset
+
+        message = self._append(topic, data)
+        self._push_to_subscribers(topic, message)
+
+    def truncate_to_leader(self, offsets: dict[str, int]):
+        for topic in self.replication_positions():
+            self._truncate(topic, offsets.get(topic, 0))
+
+    def _truncate(self, topic: str, offset: int):
+        removed = self.queues[topic].truncate(offset)
+        if not removed:
+            return
+
+        stats = self.topic_stats[topic]
+        for message in removed:
+            if message.removed:
+                continue
+            message.removed = True
+            stats.messages -= 1
+            stats.bytes -= message.size
+            self.total_messages -= 1
+            self.total_bytes -= message.size
+        if self.storage is not None:
+            self.storage.truncate(topic, offset)
+        for subscription in self.subscribers.get(topic, {}).values():
+            subscription.next_offset = min(subscription.next_offset, offset)
+        for group in self.groups.get(topic, {}).values():
+            group.next_offset = min(group.next_offset, offset)
+        print(f"Топик {topic}: отброшено {len(removed)} сообщений, которых нет у лидера")
 
-    async def _push_to_subscribers(self, topic: str, payload):
-        if topic not in self.subscribers:
+    async def _handle_promote(self, writer: asyncio.StreamWriter, request_id: int | None = None):
+        if self._reject_admin(writer, request_id):
+            return
+        await self._stop_following()
+        print("Узел назначен лидером")
+        self._send(writer, {'status': 'promoted', 'role': self.role}, request_id)
+
+    async def _handle_follow(self, host: str, port, writer: asyncio.StreamWriter,
+                             request_id: int | None = None):
+        if self._reject_admin(writer, request_id):
+            return
+        try:
+            port = int(port)
+        except (TypeError, ValueError):
+            port = None
+        if not host or not port:
+            self._send(writer, {'status': 'error', 'message': 'Host and port are required'},
+                       request_id)
             return
 
-        dead_writers = []
-        for sub_writer in list(self.subscribers[topic]):
+        await self._stop_following()
+        self.follower = Follower(self, host, port)
+        self._follower_task = asyncio.create_task(self.follower.run())
+        self._send(writer, {
+            'status': 'following',
+            'role': self.role,
+            'leader': self.follower.address
+        }, request_id)
+
+    async def _stop_following(self):
+        task, self._follower_task, self.follower = self._follower_task, None, None
+        if task is not None:
+            task.cancel()
             try:
-                await self._send(sub_writer, {
-                    'type': 'message',
-                    'topic': topic,
-                    'data': payload
-                })
-            except Exception:
-                dead_writers.append(sub_writer)
+                await task
+            except asyncio.CancelledError:
+                pass
 
-        for writer in dead_writers:
-            await self._cleanup_writer(writer)
+    def _push_to_subscribers(self, topic: str, message: StoredMessage):
+        subscriptions = self.subscribers.get(topic)
+        if not subscriptions:
+            return
+
+        for subscription in list(subscriptions.values()):
+            # Отстающий подписчик получит сообщение при досылке бэклога,
+            # иначе нарушился бы порядок; в приоритетном топике - пока у
+            # подписки есть неразосланный бэклог.
+            pending = subscription.pending
+            if (subscription.filter is not None or subscription.next_offset != message.offset
+                    or (pending and pending.peek())):
+                continue
+            self._deliver(subscription, message)
+
+        # Фильтры проверяются только у подписок, которые индекс отобрал по
+        # значениям полей; отфильтрованное сообщение в соединение не попадает.
+        index = self.filter_index.get(topic)
+        if index:
+            for subscription in index.match(message_fields(message)):
+                if subscription.live and not self._deliver(subscription, message):
+                    # Не поместилось: подписка отстала и дочитает топик досылкой.
+                    subscription.live = False
+                    subscription.next_offset = message.offset
+
+    def _deliver(self, subscription: Subscription, message: StoredMessage) -> bool:
+        outbox = self.outboxes.get(subscription.writer)
+        if outbox is None or (outbox.lossless and outbox.full):
+            return False
+        # Без кредита сообщение остается в топике до следующей выдачи.
+        if subscription.credit_messages is not None and not subscription.take(message.size):
+            return False
+        outbox.put(message.frame(outbox.binary, outbox.compression), droppable=True,
+                   message=message)
+        subscription.next_offset = message.offset + 1
+        return True
+
+    def _replay(self, writer: asyncio.StreamWriter) -> bool:
+        """Досылает следующую порцию бэклога отстающих подписок соединения."""
+        outbox = self.outboxes.get(writer)
+        if outbox is None:
+            return False
+
+        # Бюджет общий для всех топиков соединения: порция не должна
+        # переполнить очередь, иначе политика переполнения отбросит бэклог.
+        chunk = budget = min(self.replay_chunk, outbox.maxsize)
+        now = time.monotonic()
+        for topic in self.writer_topics.get(writer, ()):
+            subscription = self.subscribers[topic].get(writer)
+            queue = self.queues[topic]
+            if subscription is None or subscription.live or not subscription.has_credit:
+                continue
+            if topic in self.priority_topics:
+                budget = self._replay_priority(subscription, outbox, budget, now)
+            elif subscription.next_offset < queue.next_offset:
+                for message in queue.read_from(subscription.next_offset, budget):
+                    # Истекшие и отфильтрованные сообщения пропускаются, но
+                    # тоже тратят бюджет порции.
+                    if not message.expired(now) and subscription.accepts(message):
+                        if not subscription.take(message.size):
+                            break
+                        outbox.put(message.frame(outbox.binary, outbox.compression),
+                                   droppable=True, message=message)
+                    subscription.next_offset = message.offset + 1
+                    budget -= 1
+            pending = subscription.pending
+            if (subscription.filter is not None and subscription.next_offset == queue.next_offset
+                    and not (pending and pending.peek())):
+                # Фильтрованная подписка догнала топик: дальше ей рассылает индекс.
+                subscription.live = True
+            if budget <= 0:
+                break
+        return budget < chunk
+
+    def _replay_priority(self, subscription: Subscription, outbox: ClientOutbox, budget: int,
+                         now: float) -> int:
+        """Досылает бэклог приоритетного топика: сначала более срочные сообщения.
+
+        Весь бэклог за курсором переносится в pending подписки, поэтому
+        отстающий подписчик получает его в порядке приоритета, а не публикации.
+        Возвращает остаток бюджета порции.
+        """
+        queue = self.queues[subscription.topic]
+        pending = subscription.pending
+        if pending is None:
+            pending = subscription.pending = PriorityIndex(self.priority_step)
+        if subscription.next_offset < queue.next_offset:
+            backlog = queue.read_from(subscription.next_offset,
+                                      queue.next_offset - subscription.next_offset)
+            for message in backlog:
+                if not message.removed and subscription.accepts(message):
+                    pending.push(message)
+            subscription.next_offset = queue.next_offset
+
+        while budget > 0:
+            message = pending.peek()
+            if message is None:
+                break
+            # Истекшие сообщения пропускаются, но тоже тратят бюджет порции.
+            if not message.expired(now):
+                if not subscription.take(message.size):
+                    break
+                outbox.put(message.frame(outbox.binary, outbox.compression),
+                           droppable=True, message=message)
+            pending.pop()
+            budget -= 1
+        return budget
 
-    async def _send(self, writer: asyncio.StreamWriter, payload: dict):
-        data = json.dumps(payload).encode() + b"\n"
-        writer.write(data)
-        await writer.drain()
+    @staticmethod
+    def _encode(payload: dict) -> bytes:
+        return json.dumps(payload).encode() + b"\n"
+
+    def _send(self, writer: asyncio.StreamWriter, payload: dict,
+              request_id: int | None = None, droppable: bool = False):
+        """Ставит ответ в очередь соединения; request_id возвращается клиенту как есть."""
+        outbox = self.outboxes.get(writer)
+        if outbox is None:
+            return False
+
+        if payload.get('status') == 'error':
+            self.metrics.error(payload.get('topic'))
+        if outbox.binary:
+            topic_id = self.topic_ids.get(payload.get('topic'), 0)
+            data = framing.encode_frame(framing.REPLY, topic_id, json.dumps(payload).encode(),
+                                        request_id or 0)
+        else:
+            if request_id is not None:
+                payload['id'] = request_id
+            data = self._encode(payload)
+        return outbox.put(data, droppable)
+
+    def _send_data(self, writer: asyncio.StreamWriter, topic: str,
+                   message: StoredMessage | None, request_id: int | None = None):
+        """Ответ на get: данные сообщения вставляются в кадр без повторного разбора."""
+        outbox = self.outboxes.get(writer)
+        if outbox is None:
+            return False
+
+        if message is None:
+            return self._send(writer, {
+                'status': 'ok',
+                'topic': topic,
+                'offset': self.queues[topic].next_offset,
+                'data': None
+            }, request_id)
+
+        if outbox.binary:
+            body = message.data if outbox.compression else message.plain
+            data = framing.encode_frame(framing.DATA, message.topic_id,
+                                        framing.OFFSET.pack(message.offset) + body,
+                                        request_id or 0)
+        else:
+            head = {'status': 'ok', 'topic': topic, 'offset': message.offset}
+            if request_id is not None:
+                head['id'] = request_id
+            data = splice_data(head, message.plain)
+        self.metrics.delivered(topic, 1, message.size)
+        return outbox.put(data)
+
+    def _send_batch(self, writer: asyncio.StreamWriter, topic: str,
+                    messages: list[StoredMessage], request_id: int | None = None):
+        outbox = self.outboxes.get(writer)
+        if outbox is None:
+            return False
+
+        first_offset = messages[0].offset if messages else self.queues[topic].next_offset
+        if outbox.binary:
+            action = framing.DATA_BATCH
+            if outbox.compression:
+                body = framing.pack_items([message.data for message in messages])
+                compressed = None
+                if self.compress_min_size and len(body) >= self.compress_min_size:
+                    compressed = framing.compress(body)
+                if compressed is not None:
+                    self.metrics.batch_compressed(len(body), len(compressed))
+                    action |= framing.COMPRESSED
+                    body = compressed
+            else:
+                body = framing.pack_items([message.plain for message in messages])
+            data = framing.encode_frame(action, self._topic_id(topic),
+                                        framing.OFFSET.pack(first_offset) + body,
+                                        request_id or 0)
+        else:
+            items = [message.plain for message in messages]
+            head = {'status': 'ok', 'topic': topic, 'offset': first_offset}
+            if request_id is not None:
+                head['id'] = request_id
+            data = splice_items(head, items)
+        if messages:
+            self.metrics.delivered(topic, len(messages), sum(message.size for message in messages))
+        return outbox.put(data)
 
     async def _cleanup_writer(self, writer: asyncio.StreamWriter):
         topics = self.writer_topics.pop(writer, set())
         for topic in topics:
-            self.subscribers[topic].discard(writer)
+            subscription = self.subscribers[topic].pop(writer, None)
+            if subscription is not None:
+                self._unindex_filter(subscription)
+        for pattern in self.writer_patterns.pop(writer, set()):
+            self.patterns.remove(pattern, writer)
+        self.replicas.remove(writer)
+        self.publish_limiters.pop(writer, None)
+        for group in self.writer_groups.pop(writer, {}).values():
+            self._leave_group(group, writer)
+
+        outbox = self.outboxes.pop(writer, None)
+        if outbox is not None:
+            await outbox.close()
 
         if not writer.is_closing():
             writer.close()
@@ -142,19 +2151,139 @@ class AsyncMessageBroker:
                 pass
 
 
-async def main(host: str = 'localhost', port: int = 8888):
-    broker = AsyncMessageBroker()
-    server = await asyncio.start_server(broker.handle_client, host, port)
+async def main(host: str = 'localhost', port: int = 8888,
+               metrics_port: Optional[int] = None, transport: str = STREAMS,
+               **broker_options):
+    broker = AsyncMessageBroker(**broker_options)
+    await broker.start()
+    server = await start_server(broker, host, port, transport)
 
     addr = server.sockets[0].getsockname()
     print(f"Async broker запущен на {addr}")
 
-    async with server:
-        await server.serve_forever()
+    metrics_server = None
+    if metrics_port is not None:
+        # Метрики отдаются только локально: порт не предназначен для клиентов.
+        metrics_server = await serve_metrics(lambda: render_prometheus(broker),
+                                             '127.0.0.1', metrics_port)
+        print(f"Метрики Prometheus: http://127.0.0.1:{metrics_port}/metrics")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        await broker.stop()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Асинхронный брокер сообщений')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--metrics-port', type=int,
+                        help='локальный порт HTTP-метрик в формате Prometheus')
+    parser.add_argument('--transport', choices=TRANSPORTS, default=STREAMS,
+                        help='сетевой слой: потоки asyncio или asyncio.Protocol')
+    add_broker_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def add_broker_arguments(parser: argparse.ArgumentParser):
+    """Параметры AsyncMessageBroker; их переводит в аргументы broker_options."""
+    parser.add_argument('--data-dir', help='каталог журнала сегментов (по умолчанию - только память)')
+    parser.add_argument('--fsync-interval', type=float, default=0.05,
+                        help='интервал группового fsync журнала, с')
+    parser.add_argument('--outbox-size', type=int, default=1000,
+                        help='сколько кадров держать в очереди отправки соединения')
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=OVERFLOW_DROP_OLDEST,
+                        help='что делать с рассылкой, когда очередь соединения полна')
+    parser.add_argument('--retention-messages', type=int,
+                        help='сколько сообщений хранить в каждом топике')
+    parser.add_argument('--retention-bytes', type=int,
+                        help='сколько байт данных хранить в каждом топике')
+    parser.add_argument('--retention-age', type=float,
+                        help='сколько секунд хранить сообщения')
+    parser.add_argument('--retention-global-messages', type=int,
+                        help='сколько сообщений хранить во всех топиках вместе')
+    parser.add_argument('--retention-global-bytes', type=int,
+                        help='сколько байт данных хранить во всех топиках вместе')
+    parser.add_argument('--retention-interval', type=float, default=1.0,
+                        help='как часто проверять возраст сообщений, с')
+    parser.add_argument('--follow', metavar='HOST:PORT',
+                        help='запустить ведомым узлом лидера HOST:PORT')
+    parser.add_argument('--min-replicas', type=int, default=0,
+                        help='сколько ведомых должны получить сообщение до ответа издателю')
+    parser.add_argument('--replica-timeout', type=float, default=5.0,
+                        help='сколько ждать подтверждения ведомых, с')
+    parser.add_argument('--allow-admin', action='store_true',
+                        help='разрешить клиентам promote, follow и репликацию с любого адреса')
+    parser.add_argument('--replica-host', dest='replica_hosts', action='append', default=[],
+                        metavar='HOST', help='адрес, с которого разрешена репликация')
+    parser.add_argument('--high-water-messages', type=int,
+                        help='сообщений в топике, после которых издатели получают slow_down')
+    parser.add_argument('--high-water-bytes', type=int,
+                        help='байт в топике, после которых издатели получают slow_down')
+    parser.add_argument('--compress-min-size', type=int,
+                        default=framing.DEFAULT_COMPRESS_MIN_SIZE,
+                        help='порог сжатия для согласовавших его клиентов, байт (0 - выкл.)')
+    parser.add_argument('--priority-topic', action='append', default=[], metavar='TOPIC',
+                        help='приоритетный топик (можно указать несколько раз)')
+    parser.add_argument('--priority-step', type=float, default=1.0,
+                        help='на сколько секунд уровень приоритета откладывает сообщение')
+    parser.add_argument('--max-connections', type=int,
+                        help='сколько клиентов может быть подключено одновременно')
+    parser.add_argument('--max-client-in-flight', type=int,
+                        help='сколько неотвеченных запросов может быть у одного клиента')
+    parser.add_argument('--publish-rate', type=float,
+                        help='сообщений в секунду, которые может публиковать клиент')
+    parser.add_argument('--publish-burst', type=float,
+                        help='сколько сообщений клиент может опубликовать всплеском')
+    parser.add_argument('--publish-bytes-rate', type=float,
+                        help='байт в секунду, которые может публиковать клиент')
+    parser.add_argument('--publish-bytes-burst', type=float,
+                        help='сколько байт клиент может опубликовать всплеском')
+    parser.add_argument('--max-traces', type=int, default=0,
+                        help='сколько последних трасс сообщений хранить (0 - без трассировки)')
+
+
+def broker_options(args: argparse.Namespace) -> dict:
+    options = {
+        'outbox_size': args.outbox_size,
+        'overflow': args.overflow,
+        'retention': RetentionPolicy(args.retention_messages, args.retention_bytes,
+                                     args.retention_age),
+        'global_retention': RetentionPolicy(args.retention_global_messages,
+                                            args.retention_global_bytes),
+        'retention_interval': args.retention_interval,
+        'min_replicas': args.min_replicas,
+        'replica_timeout': args.replica_timeout,
+        'allow_admin': args.allow_admin,
+        'replica_hosts': args.replica_hosts,
+        'high_water_messages': args.high_water_messages,
+        'high_water_bytes': args.high_water_bytes,
+        'compress_min_size': args.compress_min_size,
+        'priority_topics': args.priority_topic,
+        'priority_step': args.priority_step,
+        'max_connections': args.max_connections,
+        'max_client_in_flight': args.max_client_in_flight,
+        'publish_rate': args.publish_rate,
+        'publish_burst': args.publish_burst,
+        'publish_bytes_rate': args.publish_bytes_rate,
+        'publish_bytes_burst': args.publish_bytes_burst,
+        'max_traces': args.max_traces
+    }
+    if args.data_dir:
+        options['storage'] = SegmentLog(args.data_dir, fsync_interval=args.fsync_interval)
+    if args.follow:
+        options['leader'] = parse_address(args.follow)
+    return options
 
 
 if __name__ == '__main__':
+    arguments = parse_args()
     try:
-        asyncio.run(main())
+        run(main(arguments.host, arguments.port, arguments.metrics_port, arguments.transport,
+                 **broker_options(arguments)))
     except KeyboardInterrupt:
         print("\nОстановка брокера")
@@ -1,26 +1,116 @@
 import asyncio
 import contextlib
+import itertools
 import json
 from typing import Callable, Awaitable, Optional, Union
 
+import framing
+from transport import PROTOCOL, STREAMS, ClientProtocol
+
 
 class AsyncMessageClient:
     Handler = Callable[[dict], Union[Awaitable[None], None]]
 
-    def __init__(self, host: str = 'localhost', port: int = 8888):
+    DISCONNECTED = {'status': 'disconnected'}
+
+    def __init__(self, host: str = 'localhost', port: int = 8888, binary: bool = False,
+                 max_frame_size: int = framing.DEFAULT_MAX_FRAME_SIZE,
+                 request_timeout: Optional[float] = None, ordered_replies: bool = False,
+                 write_threshold: int = 64 * 1024, transport: str = STREAMS,
+                 compression: bool = False):
         self.host = host
         self.port = port
+        self.binary = binary
+        self.max_frame_size = max_frame_size
+        self.request_timeout = request_timeout
+        # Брокер не возвращает id запросов (как SimpleBroker из oct18) и
+        # отвечает строго по порядку: ответ без id закрывает самый старый запрос.
+        self.ordered_replies = ordered_replies
+        # STREAMS - StreamReader/StreamWriter, PROTOCOL - разбор ответов прямо
+        # в data_received (transport.ClientProtocol).
+        self.transport = transport
+        # Запросы, отправленные за одну итерацию цикла событий, уходят одним
+        # writelines; раньше - если накопилось write_threshold байт.
+        self.write_threshold = write_threshold
+        # Сжатие zlib согласуется при подключении (только в бинарном режиме):
+        # сообщения и пакеты от порога брокера min_size и больше уходят сжатыми.
+        self.compression = compression
+        self._compress_min_size: Optional[int] = None
+        self._write_buffer: list[bytes] = []
+        self._write_size = 0
+        self._flush_scheduled = False
         self.reader: Optional[asyncio.StreamReader] = None
         self.writer: Optional[asyncio.StreamWriter] = None
-        self._response_queue: asyncio.Queue = asyncio.Queue()
+        # Ответы сопоставляются с запросами по id, поэтому на одном соединении
+        # одновременно может выполняться сколько угодно запросов.
+        self._pending: dict[int, asyncio.Future] = {}
+        self._request_ids = itertools.count(1)
+        self._connected = False
         self._handlers: list[AsyncMessageClient.Handler] = []
         self._listen_task: Optional[asyncio.Task] = None
+        self._topic_ids: dict[str, int] = {}
+        self._topic_names: dict[int, str] = {}
+        self._bindings: dict[str, asyncio.Future] = {}
+        # Смещение следующего ожидаемого сообщения по каждому топику подписки:
+        # передав его в subscribe после переподключения, клиент продолжит
+        # чтение с того же места.
+        self.positions: dict[str, int] = {}
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
 
     async def connect(self):
-        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
-        self._listen_task = asyncio.create_task(self._listen())
+        """Открывает соединение; объект можно подключать повторно после разрыва.
+
+        Id топиков и буфер записи относятся к соединению и сбрасываются,
+        а positions сохраняются - по ним подписки восстанавливаются с места разрыва.
+        """
+        self._topic_ids.clear()
+        self._topic_names.clear()
+        self._bindings.clear()
+        self._write_buffer = []
+        self._write_size = 0
+        self._compress_min_size = None
+        if self.transport == PROTOCOL:
+            loop = asyncio.get_running_loop()
+            _, protocol = await loop.create_connection(lambda: ClientProtocol(self),
+                                                       self.host, self.port)
+            self.writer = protocol.writer
+            await protocol.ready
+            self._connected = True
+            self._listen_task = protocol.task
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            if self.binary:
+                self.writer.write(framing.PREFACE)
+                await self.writer.drain()
+                preface = await self.reader.readexactly(len(framing.PREFACE))
+                if preface[:1] == b'{':
+                    raise self._refusal(preface + await self.reader.readline())
+                if preface != framing.PREFACE:
+                    raise ConnectionError(f'Broker rejected binary framing: {preface!r}')
+            self._connected = True
+            self._listen_task = asyncio.create_task(self._listen())
+
+        if self.binary and self.compression:
+            # Брокер без сжатия ответит ошибкой - тогда соединение работает без него.
+            response = await self._send_request({'action': 'compress',
+                                                 'codec': framing.COMPRESSION_ZLIB})
+            if response.get('status') == 'ok':
+                self._compress_min_size = response['min_size']
+
+    @staticmethod
+    def _refusal(line: bytes) -> ConnectionError:
+        """Брокер вместо PREFACE ответил строкой JSON с ошибкой (например, лимит соединений)."""
+        try:
+            message = json.loads(line).get('message')
+        except (ValueError, AttributeError):
+            message = line
+        return ConnectionError(f'Broker refused connection: {message}')
 
     async def disconnect(self):
+        self._flush_writes()
         if self.writer and not self.writer.is_closing():
             self.writer.close()
             await self.writer.wait_closed()
@@ -30,56 +120,430 @@ class AsyncMessageClient:
             with contextlib.suppress(asyncio.CancelledError):
                 await self._listen_task
 
+    async def wait_closed(self):
+        """Ждет, пока соединение с брокером не закроется."""
+        if self._listen_task is not None:
+            await asyncio.wait([self._listen_task])
+
     def add_handler(self, handler: Handler) -> None:
         self._handlers.append(handler)
 
-    async def publish(self, topic: str, message):
+    async def publish(self, topic: str, message, timeout: Optional[float] = None,
+                      delay: Optional[float] = None, ttl: Optional[float] = None,
+                      priority: Optional[int] = None, trace: bool = False):
+        """Публикует сообщение; delay и ttl - задержка доставки и время жизни, с.
+
+        Отложенную публикацию брокер подтверждает статусом 'scheduled' и
+        добавляет в топик через delay секунд; сообщение с ttl перестает
+        доставляться через ttl секунд после попадания в топик. priority (0 -
+        самый срочный) допускается только в приоритетных топиках брокера.
+        С trace брокер, ведущий трассы, вернет в ответе начало трассы
+        сообщения, а полную трассу с доставками отдаст trace().
+        """
         request = {
             'action': 'publish',
             'topic': topic,
             'message': message
         }
-        return await self._send_request(request)
-
-    async def subscribe(self, topic: str):
-        request = {'action': 'subscribe', 'topic': topic}
-        return await self._send_request(request)
-
-    async def unsubscribe(self, topic: str):
+        return await self._send_request(
+            self._with_publish_options(request, delay, ttl, priority, trace), timeout)
+
+    async def subscribe(self, topic: str, offset: Union[int, str] = 'earliest',
+                        timeout: Optional[float] = None, credit: Optional[int] = None,
+                        credit_bytes: Optional[int] = None, filter: Optional[dict] = None):
+        """Подписывается на топик начиная со смещения offset, 'earliest' или 'latest'.
+
+        topic может быть шаблоном вида orders.*.created или orders.# - тогда
+        offset допускается только 'earliest' или 'latest'. С credit брокер
+        пришлет не больше credit сообщений (и примерно credit_bytes байт),
+        пока кредит не пополнят вызовом credit(). С filter брокер пришлет
+        только подходящие сообщения, например
+        {'category': 'clothing', 'price': {'gte': 10, 'lt': 100}}.
+        """
+        request = {'action': 'subscribe', 'topic': topic, 'offset': offset}
+        if credit is not None:
+            request['credit'] = credit
+            request['credit_bytes'] = credit_bytes
+        if filter is not None:
+            request['filter'] = filter
+        return await self._send_request(request, timeout)
+
+    async def credit(self, topic: str, messages: int, max_bytes: Optional[int] = None,
+                     timeout: Optional[float] = None):
+        """Разрешает брокеру разослать по подписке еще messages сообщений и max_bytes байт."""
+        request = {'action': 'credit', 'topic': topic, 'messages': messages, 'bytes': max_bytes}
+        return await self._send_request(request, timeout)
+
+    async def unsubscribe(self, topic: str, timeout: Optional[float] = None):
         request = {'action': 'unsubscribe', 'topic': topic}
-        return await self._send_request(request)
+        return await self._send_request(request, timeout)
 
-    async def get(self, topic: str):
+    async def get(self, topic: str, offset: Optional[int] = None,
+                  timeout: Optional[float] = None):
+        """Без offset забирает сообщение из очереди, с offset - читает его, не удаляя."""
         request = {'action': 'get', 'topic': topic}
-        return await self._send_request(request)
-
-    async def _send_request(self, payload: dict):
+        if offset is not None:
+            request['offset'] = offset
+        return await self._send_request(request, timeout)
+
+    async def publish_batch(self, topic: str, messages: list, timeout: Optional[float] = None,
+                            delay: Optional[float] = None, ttl: Optional[float] = None,
+                            priority: Optional[int] = None, trace: bool = False):
+        """Публикует несколько сообщений одним кадром и получает одно подтверждение."""
+        request = {
+            'action': 'publish_batch',
+            'topic': topic,
+            'messages': list(messages)
+        }
+        return await self._send_request(
+            self._with_publish_options(request, delay, ttl, priority, trace), timeout)
+
+    @staticmethod
+    def _with_publish_options(request: dict, delay: Optional[float], ttl: Optional[float],
+                              priority: Optional[int], trace: bool = False) -> dict:
+        for name, value in (('delay', delay), ('ttl', ttl), ('priority', priority)):
+            if value is not None:
+                request[name] = value
+        if trace:
+            request['trace'] = True
+        return request
+
+    async def trace(self, topic: str, offset: int, timeout: Optional[float] = None):
+        """Трасса сообщения, опубликованного с trace: прием, запись в топик и доставки."""
+        request = {'action': 'trace', 'topic': topic, 'offset': offset}
+        return await self._send_request(request, timeout)
+
+    async def profile(self, seconds: float, interval: Optional[float] = None,
+                      timeout: Optional[float] = None):
+        """Профилирует брокер seconds секунд выборками раз в interval секунд.
+
+        Ответ с отчетом приходит по окончании профилирования, поэтому
+        request_timeout отсчитывается от его конца.
+        """
+        request = {'action': 'profile', 'seconds': seconds, 'interval': interval}
+        if timeout is None and self.request_timeout is not None:
+            timeout = seconds + self.request_timeout
+        return await self._send_request(request, timeout)
+
+    async def get_batch(self, topic: str, max_messages: int = 100,
+                        max_bytes: Optional[int] = None, offset: Optional[int] = None,
+                        timeout: Optional[float] = None):
+        """Забирает до max_messages сообщений (и не больше max_bytes данных) за один запрос."""
+        request = {
+            'action': 'get_batch',
+            'topic': topic,
+            'max_messages': max_messages,
+            'max_bytes': max_bytes
+        }
+        if offset is not None:
+            request['offset'] = offset
+        return await self._send_request(request, timeout)
+
+    async def stats(self, timeout: Optional[float] = None):
+        """Возвращает размеры топиков и счетчики вытеснения брокера."""
+        return await self._send_request({'action': 'stats'}, timeout)
+
+    async def promote(self, timeout: Optional[float] = None):
+        """Назначает узел, к которому подключен клиент, лидером репликации."""
+        return await self._send_request({'action': 'promote'}, timeout)
+
+    async def follow(self, host: str, port: int, timeout: Optional[float] = None):
+        """Делает узел ведомым лидера host:port."""
+        request = {'action': 'follow', 'host': host, 'port': port}
+        return await self._send_request(request, timeout)
+
+    async def join(self, topic: str, group: str, visibility_timeout: Optional[float] = None,
+                   max_in_flight: Optional[int] = None, offset: Union[int, str] = 'earliest',
+                   timeout: Optional[float] = None):
+        """Вступает в группу потребителей топика.
+
+        Брокер выдает участнику не больше max_in_flight сообщений сразу; каждое
+        нужно подтвердить ack (или вернуть nack) за visibility_timeout секунд,
+        иначе оно будет доставлено другому участнику.
+        """
+        request = {
+            'action': 'join',
+            'topic': topic,
+            'group': group,
+            'visibility_timeout': visibility_timeout,
+            'max_in_flight': max_in_flight,
+            'offset': offset
+        }
+        return await self._send_request(request, timeout)
+
+    async def leave(self, topic: str, timeout: Optional[float] = None):
+        return await self._send_request({'action': 'leave', 'topic': topic}, timeout)
+
+    async def ack(self, topic: str, offsets: Union[int, list[int]],
+                  timeout: Optional[float] = None):
+        """Подтверждает обработку одного или нескольких сообщений группы."""
+        return await self._settle('ack', topic, offsets, timeout)
+
+    async def nack(self, topic: str, offsets: Union[int, list[int]],
+                   timeout: Optional[float] = None):
+        """Возвращает сообщения группе для немедленной повторной доставки."""
+        return await self._settle('nack', topic, offsets, timeout)
+
+    async def _settle(self, action: str, topic: str, offsets: Union[int, list[int]],
+                      timeout: Optional[float] = None):
+        if isinstance(offsets, int):
+            offsets = [offsets]
+        request = {'action': action, 'topic': topic, 'offsets': list(offsets)}
+        return await self._send_request(request, timeout)
+
+    async def _send_request(self, payload: dict, timeout: Optional[float] = None):
+        """Отправляет запрос и ждет ответ с тем же id; таймаут действует на один запрос."""
         if not self.writer:
             raise ConnectionError('Client is not connected')
+        if not self._connected:
+            return dict(self.DISCONNECTED)
+
+        request_id = next(self._request_ids)
+        if self.binary:
+            data = await self._encode_frame(payload, request_id)
+            if not self._connected:
+                # Соединение оборвалось, пока привязывался топик.
+                return dict(self.DISCONNECTED)
+        else:
+            data = json.dumps({**payload, 'id': request_id}).encode() + b"\n"
+        # Ожидание регистрируется перед самой записью: ошибку соединения получит
+        # тот, кто уже ждет ответа, а порядок ожиданий совпадет с порядком запросов.
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._write(data)
+            transport = self.writer.transport
+            if transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+                await self.writer.drain()
+            return await asyncio.wait_for(future, timeout or self.request_timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def _write(self, data: bytes):
+        self._write_buffer.append(data)
+        self._write_size += len(data)
+        if self._write_size >= self.write_threshold:
+            self._flush_writes()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush_writes)
+
+    def _flush_writes(self):
+        self._flush_scheduled = False
+        if not self._write_buffer:
+            return
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.writelines(self._write_buffer)
+        self._write_buffer = []
+        self._write_size = 0
+
+    async def _encode_frame(self, payload: dict, request_id: int) -> bytes:
+        action = framing.ACTION_CODES[payload['action']]
+        if action == framing.BIND:
+            return framing.encode_frame(action, 0, payload['topic'].encode(), request_id)
+        if action in (framing.STATS, framing.PROMOTE):
+            return framing.encode_frame(action, 0, b'', request_id)
+        if action == framing.COMPRESS:
+            return framing.encode_frame(action, 0, payload['codec'].encode(), request_id)
+        if action == framing.FOLLOW:
+            address = f"{payload['host']}:{payload['port']}".encode()
+            return framing.encode_frame(action, 0, address, request_id)
+        if action == framing.PROFILE:
+            body = framing.PROFILE_OPTIONS.pack(payload['seconds'], payload['interval'] or 0)
+            return framing.encode_frame(action, 0, body, request_id)
+
+        topic_id = await self._bind(payload['topic'])
+        body = b''
+        if action == framing.PUBLISH:
+            body = json.dumps(payload.get('message')).encode()
+            action, body = self._with_options(action, payload, self._compress(body) or body)
+        elif action == framing.PUBLISH_BATCH:
+            # Большие сообщения сжимаются по отдельности (так брокер их и хранит),
+            # а пакет, набравший порог из мелких, - еще и целиком.
+            items = [json.dumps(item).encode() for item in payload['messages']]
+            action, body = self._with_options(action, payload, framing.pack_items(
+                [self._compress(item) or item for item in items]))
+            compressed = self._compress(body)
+            if compressed is not None:
+                action |= framing.COMPRESSED
+                body = compressed
+        elif action == framing.GET_BATCH:
+            body = framing.BATCH_LIMITS.pack(payload['max_messages'] or 0,
+                                             payload['max_bytes'] or 0)
+            if payload.get('offset') is not None:
+                body += framing.OFFSET.pack(payload['offset'])
+        elif action == framing.GET and payload.get('offset') is not None:
+            body = framing.OFFSET.pack(payload['offset'])
+        elif action == framing.TRACE:
+            body = framing.OFFSET.pack(payload['offset'])
+        elif action == framing.SUBSCRIBE:
+            body = framing.OFFSET.pack(self._position_code(payload.get('offset', 'earliest')))
+            if payload.get('credit') is not None:
+                body += framing.CREDIT_GRANT.pack(payload['credit'],
+                                                  payload.get('credit_bytes') or 0)
+            if payload.get('filter') is not None:
+                spec = json.dumps(payload['filter']).encode()
+                action |= framing.OPTIONS
+                body = framing.ITEM_LENGTH.pack(len(spec)) + spec + body
+        elif action == framing.CREDIT:
+            body = framing.CREDIT_GRANT.pack(payload['messages'], payload['bytes'] or 0)
+        elif action == framing.JOIN:
+            body = framing.GROUP_OPTIONS.pack(payload['visibility_timeout'] or 0,
+                                              payload['max_in_flight'] or 0,
+                                              self._position_code(payload['offset']))
+            body += payload['group'].encode()
+        elif action in (framing.ACK, framing.NACK):
+            body = framing.pack_offsets(payload['offsets'])
+        return framing.encode_frame(action, topic_id, body, request_id)
+
+    @staticmethod
+    def _with_options(action: int, payload: dict, body: bytes) -> tuple[int, bytes]:
+        """Публикация с задержкой, сроком жизни, приоритетом или трассой: флаг OPTIONS."""
+        delay, ttl, priority = payload.get('delay'), payload.get('ttl'), payload.get('priority')
+        flags = framing.PUBLISH_TRACE if payload.get('trace') else 0
+        if not delay and not ttl and priority is None and not flags:
+            return action, body
+        options = framing.PUBLISH_OPTIONS.pack(
+            delay or 0, ttl or 0, framing.NO_PRIORITY if priority is None else priority, flags)
+        return action | framing.OPTIONS, options + body
+
+    def _compress(self, data: bytes) -> Optional[bytes]:
+        """Сжатые данные, если сжатие согласовано, данные не меньше порога и сжались."""
+        if self._compress_min_size is None or len(data) < self._compress_min_size:
+            return None
+        return framing.compress(data)
+
+    @staticmethod
+    def _position_code(offset: Union[int, str]) -> int:
+        if offset == 'earliest':
+            return framing.FROM_EARLIEST
+        if offset == 'latest':
+            return framing.FROM_LATEST
+        return offset
+
+    async def _bind(self, topic: str) -> int:
+        """Получает у брокера числовой идентификатор топика для бинарных кадров.
+
+        Параллельные запросы к новому топику ждут один и тот же bind, поэтому
+        их кадры уходят в порядке вызова.
+        """
+        topic_id = self._topic_ids.get(topic)
+        if topic_id is not None:
+            return topic_id
+
+        binding = self._bindings.get(topic)
+        if binding is None:
+            binding = asyncio.ensure_future(self._send_request({'action': 'bind', 'topic': topic}))
+            self._bindings[topic] = binding
+        try:
+            response = await asyncio.shield(binding)
+        finally:
+            if binding.done():
+                self._bindings.pop(topic, None)
 
-        data = json.dumps(payload).encode() + b"\n"
-        self.writer.write(data)
-        await self.writer.drain()
-        return await self._response_queue.get()
+        if response.get('status') != 'bound':
+            raise ConnectionError(f'Failed to bind topic {topic!r}: {response}')
+        topic_id = response['topic_id']
+        self._topic_ids[topic] = topic_id
+        self._topic_names[topic_id] = topic
+        return topic_id
 
     async def _listen(self):
+        error = None
         try:
-            while True:
-                data = await self.reader.readline()
-                if not data:
-                    break
-
-                message = json.loads(data.decode())
-                if message.get('type') == 'message':
-                    await self._dispatch_push(message)
-                else:
-                    await self._response_queue.put(message)
+            if self.binary:
+                await self._listen_binary()
+            else:
+                await self._listen_json()
         except asyncio.CancelledError:
             raise
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as exc:
+            # Поток не разобран (JSON, кадр) или упал обработчик: читать дальше
+            # с середины нельзя, соединение закрывается.
+            error = exc
+            self.writer.close()
         finally:
-            await self._response_queue.put({'status': 'disconnected'})
+            self._connection_lost(error)
+
+    def _connection_lost(self, error: Optional[Exception] = None):
+        """Завершает ждущие ответа запросы: DISCONNECTED или ошибкой разбора потока."""
+        self._connected = False
+        for future in self._pending.values():
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(dict(self.DISCONNECTED))
+            else:
+                future.set_exception(error)
+
+    def _resolve(self, request_id: Optional[int], response: dict):
+        future = self._pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    async def _listen_json(self):
+        while True:
+            data = await self.reader.readline()
+            if not data:
+                break
+            await self._handle_line(data)
+
+    async def _listen_binary(self):
+        while True:
+            await self._handle_frame(*await framing.read_frame(self.reader, self.max_frame_size))
+
+    async def _handle_line(self, data: bytes):
+        message = json.loads(data)
+        if message.get('type') == 'message':
+            await self._dispatch_push(message)
+        else:
+            request_id = message.get('id')
+            if request_id is None and self.ordered_replies and self._pending:
+                request_id = next(iter(self._pending))
+            self._resolve(request_id, message)
+
+    async def _handle_frame(self, action: int, topic_id: int, request_id: int, payload: bytes):
+        if action == framing.REPLY:
+            response = json.loads(payload)
+            if response.get('status') == 'bound':
+                # Брокер сообщает id топиков, найденных по шаблону подписки.
+                self._topic_ids[response['topic']] = response['topic_id']
+                self._topic_names[response['topic_id']] = response['topic']
+            self._resolve(request_id, response)
+            return
+
+        topic = self._topic_names.get(topic_id)
+        (offset,) = framing.OFFSET.unpack_from(payload)
+        body = payload[framing.OFFSET.size:]
+        if action & framing.COMPRESSED:
+            action &= ~framing.COMPRESSED
+            body = framing.decompress(body, self.max_frame_size)
+        if action == framing.DATA_BATCH:
+            data = [json.loads(framing.decompress(item, self.max_frame_size))
+                    for item in framing.unpack_items(body)]
+        else:
+            data = json.loads(framing.decompress(body, self.max_frame_size))
+
+        if action == framing.MESSAGE:
+            await self._dispatch_push({
+                'type': 'message',
+                'topic': topic,
+                'offset': offset,
+                'data': data
+            })
+        else:
+            self._resolve(request_id, {
+                'status': 'ok',
+                'topic': topic,
+                'offset': offset,
+                'data': data
+            })
 
     async def _dispatch_push(self, message: dict):
+        if 'offset' in message:
+            self.positions[message['topic']] = message['offset'] + 1
         for handler in self._handlers:
             result = handler(message)
             if asyncio.iscoroutine(result):
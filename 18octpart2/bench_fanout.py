@@ -0,0 +1,112 @@
+"""Бенчмарк: процессорное время на одну публикацию в зависимости от числа подписчиков.
+
+Брокер работает в том же процессе, а подписчики подменены "пустыми" писателями,
+поэтому в замер попадает только работа брокера: разбор, кодирование кадра и
+постановка его в очереди подписчиков. Для сравнения выводится стоимость
+старого подхода, когда json.dumps вызывался заново для каждого подписчика.
+
+    python bench_fanout.py [--publishes N] [--widths 1,10,100,500]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from async_broker_server import AsyncMessageBroker, ClientOutbox
+
+
+class _NullTransport:
+    def is_closing(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def get_write_buffer_limits(self):
+        return 0, 64 * 1024
+
+    def abort(self):
+        pass
+
+
+class _NullWriter:
+    """Писатель, который отбрасывает данные: измеряем брокер, а не сокеты."""
+
+    transport = _NullTransport()
+
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return True
+
+    def get_extra_info(self, name):
+        return None
+
+
+def _sample_payload(idx: int) -> dict:
+    return {
+        'id': idx,
+        'text': f'Message #{idx}',
+        'tags': ['news', 'sport', 'weather'],
+        'meta': {'source': 'bench', 'size': 'small'},
+    }
+
+
+async def _measure_broker(width: int, publishes: int) -> float:
+    broker = AsyncMessageBroker(outbox_size=publishes + 1)
+    publisher = _NullWriter()
+    broker.outboxes[publisher] = ClientOutbox(publisher, broker.outbox_size)
+
+    subscribers = [_NullWriter() for _ in range(width)]
+    for writer in subscribers:
+        broker.outboxes[writer] = ClientOutbox(writer, broker.outbox_size)
+        await broker._handle_subscribe('bench', writer)
+
+    start = time.process_time()
+    for idx in range(publishes):
+        request = {'action': 'publish', 'topic': 'bench', 'message': _sample_payload(idx)}
+        await broker.process_message(request, publisher)
+    elapsed = time.process_time() - start
+
+    for writer in [publisher, *subscribers]:
+        await broker._cleanup_writer(writer)
+    return elapsed / publishes
+
+
+def _measure_naive(width: int, publishes: int) -> float:
+    start = time.process_time()
+    for idx in range(publishes):
+        payload = _sample_payload(idx)
+        for _ in range(width):
+            json.dumps({'type': 'message', 'topic': 'bench', 'data': payload}).encode()
+    return (time.process_time() - start) / publishes
+
+
+async def run(widths: list[int], publishes: int):
+    print(f"{'подписчики':>10} | {'общий кадр, мкс':>16} | {'dumps на каждого, мкс':>22}")
+    print('-' * 56)
+    for width in widths:
+        shared = await _measure_broker(width, publishes)
+        naive = _measure_naive(width, publishes)
+        print(f"{width:>10} | {shared * 1e6:>16.1f} | {naive * 1e6:>22.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--publishes', type=int, default=2000)
+    parser.add_argument('--widths', default='1,10,100,500')
+    args = parser.parse_args()
+
+    widths = [int(width) for width in args.widths.split(',')]
+    asyncio.run(run(widths, args.publishes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""Нагрузочный тест брокеров: пропускная способность и задержка доставки.
+
+Брокер запускается в отдельном процессе, издатели и подписчики работают на
+AsyncMessageClient в текущем процессе. Каждый подписчик подписан на все
+топики, издатели публикуют по кругу по топикам, держа до --pipeline
+неподтвержденных запросов. В сообщение вкладывается время отправки, по нему
+подписчики считают задержку от публикации до доставки.
+
+    python bench_load.py [--brokers async,simple] [--producers 4] [--consumers 4]
+                         [--topics 8] [--payload-sizes 100,1000] [--messages 5000]
+                         [--binary] [--transports streams,protocol] [--json results.json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from async_broker_server import AsyncMessageBroker, OVERFLOW_POLICIES
+from async_message_client import AsyncMessageClient
+from transport import STREAMS, TRANSPORTS, run, start_server
+
+BROKERS = ('async', 'simple')
+# SimpleBroker - брокер предыдущей части, он лежит в соседнем каталоге репозитория.
+SIMPLE_BROKER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'oct18')
+PERCENTILES = {'p50': 0.5, 'p99': 0.99, 'p999': 0.999}
+
+
+def _simple_broker_class():
+    """Импортирует SimpleBroker из oct18 или завершает запуск с понятной ошибкой."""
+    if SIMPLE_BROKER_DIR not in sys.path:
+        sys.path.insert(0, SIMPLE_BROKER_DIR)
+    try:
+        from simple_server import SimpleBroker
+    except ImportError as exc:
+        raise SystemExit(f"SimpleBroker не найден в {os.path.normpath(SIMPLE_BROKER_DIR)} "
+                         f"({exc}); запустите с --brokers async") from exc
+    return SimpleBroker
+
+
+async def _serve(kind: str, ready, options: dict, transport: str):
+    if kind == 'simple':
+        broker = _simple_broker_class()()
+        server = await asyncio.start_server(broker.handle_client, 'localhost', 0)
+    else:
+        broker = AsyncMessageBroker(**options)
+        await broker.start()
+        server = await start_server(broker, 'localhost', 0, transport)
+    ready.put(server.sockets[0].getsockname()[1])
+    await server.serve_forever()
+
+
+def _run_broker(kind: str, ready, options: dict, transport: str):
+    # Брокеры печатают каждое подключение - в замере это только мешает.
+    sys.stdout = open(os.devnull, 'w')
+    run(_serve(kind, ready, options, transport))
+
+
+class _Collector:
+    """Счетчики подписчиков: число доставок, байты и задержки в секундах."""
+
+    def __init__(self):
+        self.delivered = 0
+        self.bytes = 0
+        self.latencies: list[float] = []
+        self.last = time.perf_counter()
+
+    def __call__(self, message: dict):
+        data = message['data']
+        self.latencies.append(time.time() - data['ts'])
+        self.delivered += 1
+        self.bytes += len(data['pad'])
+        self.last = time.perf_counter()
+
+
+async def _produce(client: AsyncMessageClient, topics: list[str], index: int, count: int,
+                   pad: str, pipeline: int):
+    in_flight = set()
+    for number in range(count):
+        topic = topics[(index + number) % len(topics)]
+        in_flight.add(asyncio.ensure_future(
+            client.publish(topic, {'ts': time.time(), 'pad': pad})))
+        if len(in_flight) >= pipeline:
+            _, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+    if in_flight:
+        await asyncio.wait(in_flight)
+
+
+def _percentiles(values: list[float]) -> dict:
+    if not values:
+        return {name: None for name in [*PERCENTILES, 'max']}
+    values = sorted(values)
+    result = {name: round(values[min(len(values) - 1, int(len(values) * q))] * 1000, 3)
+              for name, q in PERCENTILES.items()}
+    result['max'] = round(values[-1] * 1000, 3)
+    return result
+
+
+async def run_scenario(kind: str, port: int, producers: int, consumers: int, topics: int,
+                       payload_size: int, messages: int, pipeline: int, binary: bool,
+                       drain_timeout: float, transport: str = STREAMS) -> dict:
+    binary = binary and kind == 'async'
+    names = [f'bench.{index}' for index in range(topics)]
+    collector = _Collector()
+
+    def connect() -> AsyncMessageClient:
+        return AsyncMessageClient(port=port, binary=binary, ordered_replies=kind == 'simple',
+                                  transport=transport)
+
+    subscribers = [connect() for _ in range(consumers)]
+    publishers = [connect() for _ in range(producers)]
+    for client in subscribers:
+        client.add_handler(collector)
+    for client in [*subscribers, *publishers]:
+        await client.connect()
+    for client in subscribers:
+        for name in names:
+            await client.subscribe(name)
+
+    pad = 'x' * payload_size
+    start = time.perf_counter()
+    await asyncio.gather(*(_produce(client, names, index, messages, pad, pipeline)
+                           for index, client in enumerate(publishers)))
+    publish_seconds = time.perf_counter() - start
+
+    expected = producers * messages * consumers
+    while collector.delivered < expected and time.perf_counter() - collector.last < drain_timeout:
+        await asyncio.sleep(0.05)
+    deliver_seconds = max(collector.last - start, 1e-9)
+
+    for client in [*subscribers, *publishers]:
+        await client.disconnect()
+
+    published = producers * messages
+    return {
+        'broker': kind,
+        'protocol': 'binary' if binary else 'json',
+        'transport': transport,
+        'producers': producers,
+        'consumers': consumers,
+        'topics': topics,
+        'payload_size': payload_size,
+        'published': published,
+        'expected_deliveries': expected,
+        'delivered': collector.delivered,
+        'publish_seconds': round(publish_seconds, 4),
+        'publish_msgs_per_sec': round(published / publish_seconds, 1),
+        'publish_mb_per_sec': round(published * payload_size / publish_seconds / 1e6, 3),
+        'deliver_msgs_per_sec': round(collector.delivered / deliver_seconds, 1),
+        'deliver_mb_per_sec': round(collector.bytes / deliver_seconds / 1e6, 3),
+        'latency_ms': _percentiles(collector.latencies),
+    }
+
+
+def run_benchmark(kind: str, broker_options: dict, **scenario) -> dict:
+    ready = multiprocessing.Queue()
+    transport = scenario.get('transport', STREAMS)
+    process = multiprocessing.Process(target=_run_broker, daemon=True,
+                                      args=(kind, ready, broker_options, transport))
+    process.start()
+    try:
+        port = ready.get(timeout=10)
+        return run(run_scenario(kind, port, **scenario))
+    finally:
+        process.terminate()
+        process.join()
+
+
+def _print_table(results: list[dict]):
+    print(f"{'брокер':>7} | {'формат':>6} | {'транспорт':>9} | {'payload':>7} | "
+          f"{'публ., msg/s':>12} | {'MB/s':>7} | {'дост., msg/s':>12} | {'доставлено':>10} | "
+          f"{'p50, мс':>8} | {'p99, мс':>8} | {'p999, мс':>8}")
+    print('-' * 127)
+    for result in results:
+        latency = result['latency_ms']
+        delivered = f"{result['delivered']}/{result['expected_deliveries']}"
+        print(f"{result['broker']:>7} | {result['protocol']:>6} | {result['transport']:>9} | "
+              f"{result['payload_size']:>7} | {result['publish_msgs_per_sec']:>12.0f} | "
+              f"{result['publish_mb_per_sec']:>7.2f} | "
+              f"{result['deliver_msgs_per_sec']:>12.0f} | {delivered:>10} | "
+              f"{latency['p50'] or 0:>8.2f} | {latency['p99'] or 0:>8.2f} | "
+              f"{latency['p999'] or 0:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--brokers', default='async,simple',
+                        help=f"брокеры через запятую: {', '.join(BROKERS)}")
+    parser.add_argument('--producers', type=int, default=4)
+    parser.add_argument('--consumers', type=int, default=4)
+    parser.add_argument('--topics', type=int, default=8)
+    parser.add_argument('--payload-sizes', default='100,1000',
+                        help='размеры полезной нагрузки в байтах через запятую')
+    parser.add_argument('--messages', type=int, default=5000,
+                        help='сообщений на одного издателя')
+    parser.add_argument('--pipeline', type=int, default=32,
+                        help='неподтвержденных публикаций на издателя')
+    parser.add_argument('--binary', action='store_true',
+                        help='бинарные кадры для AsyncMessageBroker')
+    parser.add_argument('--transports', default=STREAMS,
+                        help=f"сетевые слои через запятую: {', '.join(TRANSPORTS)} "
+                             "(SimpleBroker всегда на потоках)")
+    parser.add_argument('--outbox-size', type=int, default=1000)
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICIES[0])
+    parser.add_argument('--drain-timeout', type=float, default=2.0,
+                        help='сколько ждать доставки после последней публикации, с')
+    parser.add_argument('--json', metavar='PATH',
+                        help="записать результаты в JSON-файл ('-' - в stdout вместо таблицы)")
+    args = parser.parse_args()
+
+    kinds = args.brokers.split(',')
+    for kind in kinds:
+        if kind not in BROKERS:
+            parser.error(f"Unknown broker: {kind}")
+    transports = args.transports.split(',')
+    for transport in transports:
+        if transport not in TRANSPORTS:
+            parser.error(f"Unknown transport: {transport}")
+    if 'simple' in kinds:
+        _simple_broker_class()
+
+    broker_options = {'outbox_size': args.outbox_size, 'overflow': args.overflow}
+    results = []
+    for payload_size in (int(size) for size in args.payload_sizes.split(',')):
+        for kind in kinds:
+            for transport in transports if kind == 'async' else [STREAMS]:
+                results.append(run_benchmark(
+                    kind, broker_options, producers=args.producers, consumers=args.consumers,
+                    topics=args.topics, payload_size=payload_size, messages=args.messages,
+                    pipeline=args.pipeline, binary=args.binary,
+                    drain_timeout=args.drain_timeout, transport=transport))
+
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    _print_table(results)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Группы потребителей: распределение сообщений топика с подтверждениями.
+
+Группа читает топик своим курсором и выдает каждое сообщение одному участнику
+в аренду на visibility_timeout секунд. Подтвержденное (ack) сообщение
+считается обработанным; отклоненное (nack), просроченное или выданное
+отключившемуся участнику сообщение доставляется повторно.
+"""
+from collections import deque
+from typing import Optional
+
+from topics import MessageLog, StoredMessage
+
+
+class Lease:
+    """Сообщение, выданное участнику группы до deadline (по time.monotonic)."""
+
+    __slots__ = ('group', 'message', 'member', 'deadline', 'attempt', 'active')
+
+    def __init__(self, group: 'ConsumerGroup', message: StoredMessage, member: 'GroupMember',
+                 deadline: float, attempt: int):
+        self.group = group
+        self.message = message
+        self.member = member
+        self.deadline = deadline
+        self.attempt = attempt
+        # Сбрасывается при ack/nack/истечении; неактивные аренды лениво
+        # удаляются из кучи сроков брокера.
+        self.active = True
+
+    def __lt__(self, other: 'Lease') -> bool:
+        return self.deadline < other.deadline
+
+
+class GroupMember:
+    __slots__ = ('writer', 'max_in_flight', 'leases')
+
+    def __init__(self, writer, max_in_flight: int):
+        self.writer = writer
+        self.max_in_flight = max_in_flight
+        self.leases: dict[int, Lease] = {}
+
+    @property
+    def has_capacity(self) -> bool:
+        return len(self.leases) < self.max_in_flight
+
+
+class ConsumerGroup:
+    def __init__(self, name: str, topic: str, next_offset: int, visibility_timeout: float):
+        self.name = name
+        self.topic = topic
+        self.next_offset = next_offset
+        self.visibility_timeout = visibility_timeout
+        self.members: dict[object, GroupMember] = {}
+        self.pending: dict[int, Lease] = {}
+        # Сообщения, ожидающие повторной доставки, и номер следующей попытки.
+        self.redeliveries: deque[tuple[StoredMessage, int]] = deque()
+        self.acked = 0
+        self.redelivered = 0
+        self._rotation = 0
+
+    def join(self, writer, max_in_flight: int) -> GroupMember:
+        member = self.members.get(writer)
+        if member is None:
+            member = self.members[writer] = GroupMember(writer, max_in_flight)
+        member.max_in_flight = max_in_flight
+        return member
+
+    def leave(self, writer):
+        """Удаляет участника; его неподтвержденные сообщения уходят другим участникам."""
+        member = self.members.pop(writer, None)
+        if member is not None:
+            for lease in sorted(member.leases.values(), key=lambda item: item.message.offset):
+                self.release(lease)
+
+    def next_member(self) -> Optional[GroupMember]:
+        """Следующий по кругу участник со свободной емкостью."""
+        members = list(self.members.values())
+        for step in range(len(members)):
+            member = members[(self._rotation + step) % len(members)]
+            if member.has_capacity:
+                self._rotation = (self._rotation + step + 1) % len(members)
+                return member
+        return None
+
+    def next_message(self, log: MessageLog, now: float) -> Optional[tuple[StoredMessage, int]]:
+        while self.redeliveries:
+            message, attempt = self.redeliveries.popleft()
+            # Забранное get, вытесненное или истекшее сообщение повторно не доставляется.
+            if not message.removed and not message.expired(now):
+                return message, attempt
+
+        while True:
+            found = log.read_from(self.next_offset, 1)
+            if not found:
+                return None
+            message = found[0]
+            self.next_offset = message.offset + 1
+            if not message.removed and not message.expired(now):
+                return message, 1
+
+    def lease(self, message: StoredMessage, attempt: int, member: GroupMember,
+              now: float) -> Lease:
+        lease = Lease(self, message, member, now + self.visibility_timeout, attempt)
+        member.leases[message.offset] = lease
+        self.pending[message.offset] = lease
+        return lease
+
+    def ack(self, writer, offset: int) -> bool:
+        lease = self._member_lease(writer, offset)
+        if lease is None:
+            return False
+        self._finish(lease)
+        self.acked += 1
+        return True
+
+    def nack(self, writer, offset: int) -> bool:
+        lease = self._member_lease(writer, offset)
+        if lease is None:
+            return False
+        self.release(lease)
+        return True
+
+    def release(self, lease: Lease):
+        """Возвращает сообщение из аренды в очередь повторной доставки."""
+        self._finish(lease)
+        self.redeliveries.append((lease.message, lease.attempt + 1))
+        self.redelivered += 1
+
+    def _member_lease(self, writer, offset: int) -> Optional[Lease]:
+        lease = self.pending.get(offset)
+        if lease is None or lease.member.writer is not writer:
+            return None
+        return lease
+
+    def _finish(self, lease: Lease):
+        lease.active = False
+        offset = lease.message.offset
+        lease.member.leases.pop(offset, None)
+        self.pending.pop(offset, None)
+
+    def stats(self, log: MessageLog) -> dict:
+        return {
+            'members': len(self.members),
+            'pending': len(self.pending),
+            'lag': max(log.next_offset - self.next_offset, 0) + len(self.redeliveries),
+            'acked': self.acked,
+            'redelivered': self.redelivered,
+        }
@@ -0,0 +1,212 @@
+"""Бинарный формат кадров с префиксом длины для брокера и клиента.
+
+Клиент, желающий работать в бинарном режиме, сразу после подключения отправляет
+PREFACE, брокер отвечает тем же PREFACE. Клиенты без рукопожатия продолжают
+общаться строками JSON на том же порту: первый байт JSON-строки никогда не
+совпадает с первым байтом PREFACE.
+
+Каждый кадр - это заголовок HEADER (длина полезной нагрузки, код действия,
+идентификатор топика, идентификатор запроса) и непрозрачная полезная нагрузка.
+Брокер возвращает идентификатор запроса в ответе, рассылки идут с нулевым.
+Идентификаторы топиков глобальны для брокера и выдаются действием BIND, поэтому
+один и тот же кадр рассылки подходит всем бинарным подписчикам.
+"""
+import asyncio
+import struct
+import zlib
+from typing import Optional
+
+PREFACE = b'\x00MQB1'
+
+HEADER = struct.Struct('!IBII')
+ITEM_LENGTH = struct.Struct('!I')
+# Нагрузка GET_BATCH: максимум сообщений и байт (0 - без ограничения по байтам).
+BATCH_LIMITS = struct.Struct('!II')
+# Смещение сообщения в топике. Им начинается нагрузка MESSAGE, DATA и DATA_BATCH
+# (для пакета - смещение первого сообщения); необязательным смещением
+# заканчивается нагрузка SUBSCRIBE, GET и GET_BATCH.
+OFFSET = struct.Struct('!q')
+FROM_LATEST = -1
+FROM_EARLIEST = -2
+# Нагрузка JOIN: таймаут видимости в секундах, максимум сообщений в аренде
+# у участника (нули - значения брокера по умолчанию) и начальная позиция
+# группы; за ними следует имя группы. Нагрузка ACK и NACK - подряд идущие OFFSET.
+GROUP_OPTIONS = struct.Struct('!dIq')
+# Нагрузка CREDIT и необязательное продолжение SUBSCRIBE после OFFSET: сколько
+# еще сообщений и байт можно разослать подписке (0 байт - без лимита по байтам).
+CREDIT_GRANT = struct.Struct('!II')
+# Публикация с флагом OPTIONS в коде действия (PUBLISH, PUBLISH_BATCH)
+# начинается с PUBLISH_OPTIONS: задержка доставки и время жизни сообщений
+# в секундах (0 - без задержки / бессрочно), приоритет (NO_PRIORITY - не задан)
+# и флаги публикации (PUBLISH_TRACE - трассировать сообщения, модуль tracing).
+# SUBSCRIBE с флагом OPTIONS начинается с ITEM_LENGTH и JSON-фильтра
+# (message_filters), за ними - обычная нагрузка подписки.
+PUBLISH_OPTIONS = struct.Struct('!ddBB')
+NO_PRIORITY = 0xFF
+PUBLISH_TRACE = 0x01
+OPTIONS = 0x20
+# Нагрузка PROFILE: сколько секунд профилировать и интервал выборки (0 - по умолчанию).
+PROFILE_OPTIONS = struct.Struct('!dd')
+
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Сжатые данные: COMPRESSED_MARK, исходная длина RAW_LENGTH и поток zlib.
+# Данные сообщения - JSON, а JSON не начинается с нулевого байта, поэтому
+# сжатое сообщение распознается по себе самому и в таком виде хранится в
+# топике, на диске и на ведомых узлах. Сжатие пакета целиком помечается
+# флагом COMPRESSED в коде действия (PUBLISH_BATCH, DATA_BATCH): нагрузка
+# пакета сама начинается с длины элемента и может начинаться с нуля.
+# Флаги занимают старшие биты, поэтому коды действий клиента меньше 0x20.
+COMPRESSED_MARK = b'\x00z'
+RAW_LENGTH = struct.Struct('!I')
+COMPRESSED = 0x40
+COMPRESSION_ZLIB = 'zlib'
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+
+# Запросы клиента.
+BIND = 0x01
+PUBLISH = 0x02
+SUBSCRIBE = 0x03
+UNSUBSCRIBE = 0x04
+GET = 0x05
+PUBLISH_BATCH = 0x06
+GET_BATCH = 0x07
+STATS = 0x08
+JOIN = 0x09
+LEAVE = 0x0A
+ACK = 0x0B
+NACK = 0x0C
+# Репликация: ведомый запрашивает поток топиков (нагрузка - JSON с позициями
+# по топикам) и подтверждает получение (нагрузка - OFFSET следующего сообщения).
+REPLICATE = 0x0D
+REPLICA_ACK = 0x0E
+# Администрирование: назначить узел лидером / ведомым (нагрузка - "host:port").
+PROMOTE = 0x0F
+FOLLOW = 0x10
+# Управление потоком: подписчик выдает брокеру кредит на рассылки топика.
+CREDIT = 0x11
+# Согласование сжатия соединения (нагрузка - имя алгоритма, "zlib").
+COMPRESS = 0x12
+# Трасса сообщения (нагрузка - OFFSET) и выборочное профилирование брокера.
+TRACE = 0x13
+PROFILE = 0x14
+
+# Кадры брокера.
+REPLY = 0x80
+MESSAGE = 0x81
+DATA = 0x82
+DATA_BATCH = 0x83
+
+ACTION_NAMES = {
+    BIND: 'bind',
+    PUBLISH: 'publish',
+    SUBSCRIBE: 'subscribe',
+    UNSUBSCRIBE: 'unsubscribe',
+    GET: 'get',
+    PUBLISH_BATCH: 'publish_batch',
+    GET_BATCH: 'get_batch',
+    STATS: 'stats',
+    JOIN: 'join',
+    LEAVE: 'leave',
+    ACK: 'ack',
+    NACK: 'nack',
+    REPLICATE: 'replicate',
+    REPLICA_ACK: 'replica_ack',
+    PROMOTE: 'promote',
+    FOLLOW: 'follow',
+    CREDIT: 'credit',
+    COMPRESS: 'compress',
+    TRACE: 'trace',
+    PROFILE: 'profile',
+}
+ACTION_CODES = {name: code for code, name in ACTION_NAMES.items()}
+
+
+class FrameTooLarge(Exception):
+    pass
+
+
+def encode_frame(action: int, topic_id: int, payload: bytes = b'',
+                 request_id: int = 0) -> bytes:
+    return HEADER.pack(len(payload), action, topic_id, request_id) + payload
+
+
+def pack_items(items: list[bytes]) -> bytes:
+    """Упаковывает несколько нагрузок в одну: каждая с префиксом длины."""
+    return b''.join(ITEM_LENGTH.pack(len(item)) + item for item in items)
+
+
+def unpack_items(payload: bytes) -> list[bytes]:
+    items = []
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        (length,) = ITEM_LENGTH.unpack_from(view, offset)
+        offset += ITEM_LENGTH.size
+        if offset + length > len(view):
+            raise ValueError('Batch item is cut short')
+        items.append(bytes(view[offset:offset + length]))
+        offset += length
+    return items
+
+
+def compress(data: bytes, level: int = COMPRESS_LEVEL) -> Optional[bytes]:
+    """Сжатые данные с меткой или None, если сжатие не уменьшило размер."""
+    compressed = COMPRESSED_MARK + RAW_LENGTH.pack(len(data)) + zlib.compress(data, level)
+    return compressed if len(compressed) < len(data) else None
+
+
+def is_compressed(data: bytes) -> bool:
+    return data[:len(COMPRESSED_MARK)] == COMPRESSED_MARK
+
+
+def raw_size(data: bytes) -> int:
+    """Размер данных после распаковки (для несжатых - их длина)."""
+    if not is_compressed(data):
+        return len(data)
+    if len(data) < len(COMPRESSED_MARK) + RAW_LENGTH.size:
+        raise ValueError('Compressed data header is cut short')
+    return RAW_LENGTH.unpack_from(data, len(COMPRESSED_MARK))[0]
+
+
+def decompress(data: bytes, max_size: int = DEFAULT_MAX_FRAME_SIZE) -> bytes:
+    """Распаковывает данные с меткой, несжатые возвращает как есть.
+
+    Распакованный размер ограничен max_size, чтобы маленький кадр не
+    развернулся в гигабайты. Поврежденные данные дают ValueError.
+    """
+    if not is_compressed(data):
+        return data
+    length = raw_size(data)
+    if length > max_size:
+        raise FrameTooLarge(f"Compressed data of {length} bytes exceeds limit {max_size}")
+    decompressor = zlib.decompressobj()
+    start = len(COMPRESSED_MARK) + RAW_LENGTH.size
+    try:
+        raw = decompressor.decompress(memoryview(data)[start:], length)
+    except zlib.error:
+        raise ValueError('Corrupted compressed data') from None
+    if len(raw) != length or decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError('Corrupted compressed data')
+    return raw
+
+
+def pack_offsets(offsets: list[int]) -> bytes:
+    return b''.join(OFFSET.pack(offset) for offset in offsets)
+
+
+def unpack_offsets(payload: bytes) -> list[int]:
+    return [offset for (offset,) in OFFSET.iter_unpack(payload)]
+
+
+async def read_frame(reader: asyncio.StreamReader,
+                     max_size: int = DEFAULT_MAX_FRAME_SIZE) -> tuple[int, int, int, bytes]:
+    """Читает один кадр; при закрытом соединении бросает IncompleteReadError."""
+    header = await reader.readexactly(HEADER.size)
+    length, action, topic_id, request_id = HEADER.unpack(header)
+    if length > max_size:
+        raise FrameTooLarge(f"Frame of {length} bytes exceeds limit {max_size}")
+
+    payload = await reader.readexactly(length) if length else b''
+    return action, topic_id, request_id, payload
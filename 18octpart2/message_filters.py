@@ -0,0 +1,169 @@
+"""Фильтры подписок по полям сообщений: равенство, списки IN и диапазоны.
+
+Фильтр - JSON-объект: ключ - поле сообщения (путь через точку для вложенных
+объектов), значение - либо значение для сравнения на равенство, либо объект
+с операторами eq, in, gt, gte, lt, lte. Сообщение проходит фильтр, если
+выполнены все условия:
+
+    {"category": "clothing", "size": {"in": ["S", "M"]}, "price": {"gte": 10, "lt": 100}}
+
+Фильтр компилируется один раз при подписке. FilterIndex раскладывает
+фильтрованные подписки топика по значениям их самого избирательного условия
+на равенство или IN, поэтому публикация проверяется только против подписок,
+чье условие совпало со значением поля, и против подписок с одними диапазонами.
+"""
+import json
+import operator
+from typing import Optional
+
+RANGE_OPERATORS = {'gt': operator.gt, 'gte': operator.ge, 'lt': operator.lt, 'lte': operator.le}
+OPERATORS = {'eq', 'in', *RANGE_OPERATORS}
+
+# Значение отсутствующего поля: не равно ничему, включая null.
+MISSING = object()
+
+
+def _is_scalar(value) -> bool:
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _key(value):
+    """Ключ для сравнения на равенство: в JSON true и 1 - разные значения."""
+    return (bool, value) if isinstance(value, bool) else value
+
+
+def lookup(fields: dict, path: tuple[str, ...]):
+    value = fields
+    for name in path:
+        if not isinstance(value, dict):
+            return MISSING
+        value = value.get(name, MISSING)
+    return value
+
+
+def message_fields(message) -> Optional[dict]:
+    """Поля сообщения для фильтров или None, если данные - не JSON-объект."""
+    try:
+        fields = json.loads(message.plain)
+    except ValueError:
+        return None
+    return fields if isinstance(fields, dict) else None
+
+
+class Condition:
+    """Условие на одно поле: допустимые значения (eq, in) и границы диапазона."""
+
+    __slots__ = ('path', 'values', 'bounds')
+
+    def __init__(self, field: str, spec):
+        if not isinstance(field, str) or not field:
+            raise ValueError('field names must be non-empty strings')
+        self.path = tuple(field.split('.'))
+        self.values: Optional[frozenset] = None
+        self.bounds: list[tuple] = []
+
+        if not isinstance(spec, dict):
+            spec = {'eq': spec}
+        unknown = set(spec) - OPERATORS
+        if unknown or not spec:
+            raise ValueError(f"unsupported operators for {field}: {sorted(unknown) or 'none'}")
+        if 'eq' in spec:
+            if not _is_scalar(spec['eq']):
+                raise ValueError(f"{field}: eq expects a scalar value")
+            self.values = frozenset([_key(spec['eq'])])
+        if 'in' in spec:
+            choices = spec['in']
+            if not isinstance(choices, list) or not all(_is_scalar(item) for item in choices):
+                raise ValueError(f"{field}: in expects a list of scalar values")
+            values = frozenset(_key(item) for item in choices)
+            self.values = values if self.values is None else self.values & values
+        for name, compare in RANGE_OPERATORS.items():
+            if name in spec:
+                if not _is_number(spec[name]):
+                    raise ValueError(f"{field}: {name} expects a number")
+                self.bounds.append((compare, spec[name]))
+
+    def matches(self, fields: dict) -> bool:
+        value = lookup(fields, self.path)
+        if self.values is not None and not (_is_scalar(value) and _key(value) in self.values):
+            return False
+        if self.bounds:
+            return _is_number(value) and all(compare(value, limit)
+                                             for compare, limit in self.bounds)
+        return True
+
+
+class MessageFilter:
+    """Скомпилированный фильтр подписки: все условия должны выполняться."""
+
+    __slots__ = ('spec', 'conditions', 'anchor')
+
+    def __init__(self, spec: dict):
+        if not isinstance(spec, dict) or not spec:
+            raise ValueError('filter must be a non-empty object')
+        self.spec = spec
+        self.conditions = [Condition(field, condition) for field, condition in spec.items()]
+        # Условие, по которому подписка индексируется: с наименьшим числом значений.
+        exact = [condition for condition in self.conditions if condition.values is not None]
+        self.anchor: Optional[Condition] = min(
+            exact, key=lambda condition: len(condition.values), default=None)
+
+    def matches(self, fields: Optional[dict]) -> bool:
+        return fields is not None and all(condition.matches(fields)
+                                          for condition in self.conditions)
+
+
+class FilterIndex:
+    """Фильтрованные подписки топика, разложенные по значениям полей."""
+
+    def __init__(self):
+        # Путь поля -> ключ значения -> подписки, у которых это значение допустимо.
+        self._exact: dict[tuple[str, ...], dict[object, set]] = {}
+        # Подписки без условий на равенство проверяются на каждой публикации.
+        self._scan: set = set()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, subscription):
+        anchor = subscription.filter.anchor
+        if anchor is None:
+            self._scan.add(subscription)
+        else:
+            by_value = self._exact.setdefault(anchor.path, {})
+            for key in anchor.values:
+                by_value.setdefault(key, set()).add(subscription)
+        self._size += 1
+
+    def remove(self, subscription):
+        anchor = subscription.filter.anchor
+        if anchor is None:
+            self._scan.discard(subscription)
+        else:
+            by_value = self._exact.get(anchor.path, {})
+            for key in anchor.values:
+                subscriptions = by_value.get(key)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del by_value[key]
+            if not by_value:
+                self._exact.pop(anchor.path, None)
+        self._size -= 1
+
+    def match(self, fields: Optional[dict]) -> list:
+        """Подписки, фильтр которых пропускает сообщение с полями fields."""
+        if fields is None:
+            return []
+        candidates = set(self._scan)
+        for path, by_value in self._exact.items():
+            value = lookup(fields, path)
+            if _is_scalar(value):
+                candidates.update(by_value.get(_key(value), ()))
+        return [subscription for subscription in candidates
+                if subscription.filter.matches(fields)]
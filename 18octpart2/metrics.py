@@ -0,0 +1,259 @@
+"""Метрики брокера: счетчики по топикам, гистограммы и текстовый формат Prometheus.
+
+Счетчики - обычные целые поля, гистограммы - фиксированные корзины, поэтому
+учет события стоит одного-двух сложений (и bisect для гистограммы) и может
+быть включен всегда. Экспорт в текстовом формате Prometheus отдается простым
+HTTP-сервером на отдельном локальном порту.
+"""
+import asyncio
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Iterable, Optional
+
+# Границы корзин задержек в секундах: от 100 мкс до 10 с.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIX = 'mq_'
+
+
+class TopicCounters:
+    """Накопительные счетчики топика с момента запуска брокера."""
+
+    __slots__ = ('published', 'bytes_in', 'raw_bytes_in', 'delivered', 'bytes_out', 'dropped',
+                 'errors')
+
+    def __init__(self):
+        self.published = 0
+        self.bytes_in = 0
+        # Размер опубликованных данных до сжатия; bytes_in - как они хранятся.
+        self.raw_bytes_in = 0
+        self.delivered = 0
+        self.bytes_out = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин (le - включительно)."""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds: Iterable[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        # Последняя корзина - значения больше всех границ (+Inf).
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """Пары (le, число значений не больше le), как в экспорте Prometheus."""
+        result = []
+        total = 0
+        for bound, count in zip((*self.bounds, '+Inf'), self.counts):
+            total += count
+            result.append((bound if isinstance(bound, str) else repr(bound), total))
+        return result
+
+    def as_dict(self) -> dict:
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'buckets': dict(self.cumulative())}
+
+
+class BrokerMetrics:
+    """Счетчики и гистограммы одного брокера."""
+
+    def __init__(self):
+        self.topics: defaultdict[str, TopicCounters] = defaultdict(TopicCounters)
+        # Ошибки без топика (неверный JSON, неизвестное действие и т. п.).
+        self.errors = 0
+        self.connections = 0
+        self.deliver_latency = Histogram()
+        self.drain_time = Histogram()
+        # Пакеты, сжатые целиком (в обе стороны): байты до и после сжатия.
+        self.batch_raw_bytes = 0
+        self.batch_wire_bytes = 0
+        # Отказы контроля допуска по причинам и число неопубликованных из-за них сообщений.
+        self.throttled: defaultdict[str, int] = defaultdict(int)
+        self.throttled_messages = 0
+
+    def published(self, topic: str, size: int, raw_size: Optional[int] = None):
+        counters = self.topics[topic]
+        counters.published += 1
+        counters.bytes_in += size
+        counters.raw_bytes_in += size if raw_size is None else raw_size
+
+    def batch_compressed(self, raw_size: int, wire_size: int):
+        self.batch_raw_bytes += raw_size
+        self.batch_wire_bytes += wire_size
+
+    def delivered(self, topic: str, count: int, size: int):
+        counters = self.topics[topic]
+        counters.delivered += count
+        counters.bytes_out += size
+
+    def sent(self, message, now: float):
+        """Кадр сообщения записан в сокет: доставка и задержка от публикации."""
+        counters = self.topics[message.topic]
+        counters.delivered += 1
+        counters.bytes_out += message.size
+        self.deliver_latency.observe(now - message.created)
+
+    def dropped(self, message):
+        self.topics[message.topic].dropped += 1
+
+    def throttle(self, reason: str, messages: int = 0):
+        self.throttled[reason] += 1
+        self.throttled_messages += messages
+
+    def error(self, topic: Optional[str] = None):
+        if isinstance(topic, str):
+            self.topics[topic].errors += 1
+        else:
+            self.errors += 1
+
+    def counters(self, topic: str) -> dict:
+        counters = self.topics.get(topic) or TopicCounters()
+        return {**counters.as_dict(),
+                'compression_ratio': _ratio(counters.raw_bytes_in, counters.bytes_in)}
+
+    def compression(self) -> dict:
+        """Степень сжатия: хранимых данных сообщений и пакетов, сжатых целиком."""
+        raw = sum(counters.raw_bytes_in for counters in self.topics.values())
+        stored = sum(counters.bytes_in for counters in self.topics.values())
+        return {
+            'payload_raw_bytes': raw,
+            'payload_bytes': stored,
+            'payload_ratio': _ratio(raw, stored),
+            'batch_raw_bytes': self.batch_raw_bytes,
+            'batch_wire_bytes': self.batch_wire_bytes,
+            'batch_ratio': _ratio(self.batch_raw_bytes, self.batch_wire_bytes)
+        }
+
+
+def _ratio(raw: int, compressed: int) -> float:
+    return round(raw / compressed, 3) if compressed else 1.0
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _family(lines: list[str], name: str, kind: str, help_text: str):
+    lines.append(f'# HELP {PREFIX}{name} {help_text}')
+    lines.append(f'# TYPE {PREFIX}{name} {kind}')
+
+
+def _histogram(lines: list[str], name: str, help_text: str, histogram: Histogram):
+    _family(lines, name, 'histogram', help_text)
+    for bound, count in histogram.cumulative():
+        lines.append(f'{PREFIX}{name}_bucket{{le="{bound}"}} {count}')
+    lines.append(f'{PREFIX}{name}_sum {histogram.sum!r}')
+    lines.append(f'{PREFIX}{name}_count {histogram.count}')
+
+
+TOPIC_COUNTERS = (
+    ('published', 'published_total', 'Published messages.'),
+    ('bytes_in', 'published_bytes_total', 'Published payload bytes as stored.'),
+    ('raw_bytes_in', 'published_raw_bytes_total', 'Published payload bytes before compression.'),
+    ('delivered', 'delivered_total', 'Messages written to client connections.'),
+    ('bytes_out', 'delivered_bytes_total', 'Delivered payload bytes.'),
+    ('dropped', 'dropped_total', 'Pushes dropped by the outbox overflow policy.'),
+    ('errors', 'errors_total', 'Error replies.'),
+)
+
+# Причины отказа контроля допуска: лимит соединений, запросов в работе,
+# публикаций и байт в секунду.
+THROTTLE_REASONS = ('connections', 'in_flight', 'rate', 'bytes')
+
+
+def render_prometheus(broker) -> str:
+    """Метрики брокера в текстовом формате Prometheus."""
+    metrics: BrokerMetrics = broker.metrics
+    lines: list[str] = []
+    topics = sorted(set(metrics.topics) | set(broker.topic_stats))
+    labels = {topic: f'{{topic="{_escape(topic)}"}}' for topic in topics}
+
+    for field, name, help_text in TOPIC_COUNTERS:
+        _family(lines, name, 'counter', help_text)
+        for topic in topics:
+            counters = metrics.topics.get(topic)
+            lines.append(f'{PREFIX}{name}{labels[topic]} '
+                         f'{getattr(counters, field) if counters else 0}')
+        if field == 'errors':
+            lines.append(f'{PREFIX}{name}{{topic=""}} {metrics.errors}')
+
+    _family(lines, 'queue_messages', 'gauge', 'Messages stored in the topic.')
+    for topic in topics:
+        stats = broker.topic_stats.get(topic)
+        lines.append(f'{PREFIX}queue_messages{labels[topic]} {stats.messages if stats else 0}')
+    _family(lines, 'queue_bytes', 'gauge', 'Payload bytes stored in the topic.')
+    for topic in topics:
+        stats = broker.topic_stats.get(topic)
+        lines.append(f'{PREFIX}queue_bytes{labels[topic]} {stats.bytes if stats else 0}')
+    _family(lines, 'subscribers', 'gauge', 'Subscriptions of the topic.')
+    for topic in topics:
+        lines.append(f'{PREFIX}subscribers{labels[topic]} '
+                     f'{len(broker.subscribers.get(topic, ()))}')
+
+    _family(lines, 'connected_clients', 'gauge', 'Open client connections.')
+    lines.append(f'{PREFIX}connected_clients {len(broker.outboxes)}')
+    _family(lines, 'connections_total', 'counter', 'Accepted client connections.')
+    lines.append(f'{PREFIX}connections_total {metrics.connections}')
+    _family(lines, 'outbox_frames', 'gauge', 'Frames queued in all client outboxes.')
+    lines.append(f'{PREFIX}outbox_frames {sum(map(len, broker.outboxes.values()))}')
+
+    _family(lines, 'batch_raw_bytes_total', 'counter',
+            'Bytes of whole-batch compressed frames before compression.')
+    lines.append(f'{PREFIX}batch_raw_bytes_total {metrics.batch_raw_bytes}')
+    _family(lines, 'batch_wire_bytes_total', 'counter',
+            'Bytes of whole-batch compressed frames on the wire.')
+    lines.append(f'{PREFIX}batch_wire_bytes_total {metrics.batch_wire_bytes}')
+
+    _family(lines, 'throttled_total', 'counter', 'Requests rejected by admission control.')
+    for reason in THROTTLE_REASONS:
+        lines.append(f'{PREFIX}throttled_total{{reason="{reason}"}} '
+                     f'{metrics.throttled.get(reason, 0)}')
+    _family(lines, 'throttled_messages_total', 'counter',
+            'Messages in publishes rejected by rate limits.')
+    lines.append(f'{PREFIX}throttled_messages_total {metrics.throttled_messages}')
+
+    _histogram(lines, 'deliver_latency_seconds', 'Time from publish to socket write.',
+               metrics.deliver_latency)
+    _histogram(lines, 'drain_seconds', 'Time spent waiting in StreamWriter.drain().',
+               metrics.drain_time)
+    return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(render_text: Callable[[], str], host: str = '127.0.0.1',
+                        port: int = 9100) -> asyncio.AbstractServer:
+    """HTTP-сервер, который на любой GET-запрос отвечает текстом render_text()."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            # Заголовки запроса не нужны: дочитываем их до пустой строки.
+            while (await reader.readline()).strip():
+                pass
+            if request.startswith(b'GET '):
+                status, body = '200 OK', render_text().encode()
+            else:
+                status, body = '405 Method Not Allowed', b''
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode()
+                         + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,279 @@
+"""Пул соединений с брокером с автоматическим переподключением.
+
+PooledMessageClient держит size соединений AsyncMessageClient. Запросы к
+топику всегда идут через одно и то же соединение (crc32 имени топика), так
+что порядок публикаций, подписки и членство в группах топика остаются на
+одном соединении, а разные топики расходятся по разным сокетам. Запросы без
+топика (stats) раздаются по кругу.
+
+При разрыве соединение переподключается с экспоненциальной задержкой со
+случайным разбросом (чтобы клиенты не ломились к брокеру одновременно),
+восстанавливает подписки с последних полученных смещений и группы, а затем
+отправляет публикации, не получившие подтверждения. Таких публикаций
+хранится не больше max_buffered на соединение. Повторная отправка дает
+доставку "хотя бы один раз": сообщение, подтверждение которого потерялось
+вместе с соединением, может быть опубликовано дважды.
+
+    pool = PooledMessageClient(port=8888, size=4)
+    await pool.connect()
+    await asyncio.gather(*(pool.publish(f'orders.{i % 8}', {'n': i}) for i in range(1000)))
+"""
+import asyncio
+import functools
+import itertools
+import random
+import zlib
+from collections import deque
+from typing import Optional, Union
+
+from async_message_client import AsyncMessageClient
+from topic_trie import is_pattern
+
+
+class PoolMember:
+    """Одно соединение пула и состояние, которое нужно восстановить после разрыва."""
+
+    def __init__(self, client: AsyncMessageClient):
+        self.client = client
+        self.ready = asyncio.Event()
+        # Подписки и группы этого соединения: топик -> аргументы запроса.
+        self.subscriptions: dict[str, dict] = {}
+        self.groups: dict[str, dict] = {}
+        # Публикации, ожидающие переподключения, в порядке вызова, и число
+        # отпущенных из очереди, но еще не записанных в соединение.
+        self.buffered: deque[asyncio.Future] = deque()
+        self.resending = 0
+        self.reconnects = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+class PooledMessageClient:
+    BUFFER_FULL = {'status': 'error', 'message': 'Publish buffer is full'}
+
+    def __init__(self, host: str = 'localhost', port: int = 8888, size: int = 4,
+                 max_buffered: int = 1000, reconnect_delay: float = 0.1,
+                 max_reconnect_delay: float = 10.0, request_timeout: Optional[float] = None,
+                 **client_options):
+        self.host = host
+        self.port = port
+        self.max_buffered = max_buffered
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.request_timeout = request_timeout
+        self.members = [
+            PoolMember(AsyncMessageClient(host, port, request_timeout=request_timeout,
+                                          **client_options))
+            for _ in range(size)
+        ]
+        self._rotation = itertools.cycle(self.members)
+        self._closing = False
+
+    @property
+    def positions(self) -> dict[str, int]:
+        """Смещения следующих ожидаемых сообщений по всем подпискам пула."""
+        positions = {}
+        for member in self.members:
+            positions.update(member.client.positions)
+        return positions
+
+    async def connect(self):
+        """Подключает все соединения; ошибка первого подключения пробрасывается."""
+        for member in self.members:
+            await member.client.connect()
+            member.ready.set()
+            member.task = asyncio.create_task(self._maintain(member))
+
+    async def disconnect(self):
+        self._closing = True
+        for member in self.members:
+            if member.task is not None:
+                member.task.cancel()
+                await asyncio.wait([member.task])
+            while member.buffered:
+                waiter = member.buffered.popleft()
+                if not waiter.done():
+                    waiter.set_result(False)
+            if member.client.writer is not None:
+                await member.client.disconnect()
+
+    def add_handler(self, handler: AsyncMessageClient.Handler) -> None:
+        for member in self.members:
+            member.client.add_handler(handler)
+
+    async def publish(self, topic: str, message, timeout: Optional[float] = None,
+                      delay: Optional[float] = None, ttl: Optional[float] = None,
+                      priority: Optional[int] = None, trace: bool = False):
+        return await self._publish(topic, 'publish', message, timeout, delay, ttl, priority,
+                                   trace)
+
+    async def publish_batch(self, topic: str, messages: list, timeout: Optional[float] = None,
+                            delay: Optional[float] = None, ttl: Optional[float] = None,
+                            priority: Optional[int] = None, trace: bool = False):
+        return await self._publish(topic, 'publish_batch', messages, timeout, delay, ttl,
+                                   priority, trace)
+
+    async def subscribe(self, topic: str, offset: Union[int, str] = 'earliest',
+                        timeout: Optional[float] = None, credit: Optional[int] = None,
+                        credit_bytes: Optional[int] = None, filter: Optional[dict] = None):
+        member = self._member_for(topic)
+        options = {'offset': offset, 'credit': credit, 'credit_bytes': credit_bytes,
+                   'filter': filter}
+        response = await self._call(member, 'subscribe', topic, timeout=timeout, **options)
+        # Запоминаем только принятую подписку: запрос, прерванный разрывом,
+        # _call повторит сам, и восстановление не должно его дублировать.
+        if response.get('status') == 'subscribed':
+            member.subscriptions[topic] = options
+        return response
+
+    async def unsubscribe(self, topic: str, timeout: Optional[float] = None):
+        member = self._member_for(topic)
+        member.subscriptions.pop(topic, None)
+        return await self._call(member, 'unsubscribe', topic, timeout=timeout)
+
+    async def credit(self, topic: str, messages: int, max_bytes: Optional[int] = None,
+                     timeout: Optional[float] = None):
+        return await self._call(self._member_for(topic), 'credit', topic, messages, max_bytes,
+                                timeout=timeout)
+
+    async def get(self, topic: str, offset: Optional[int] = None,
+                  timeout: Optional[float] = None):
+        return await self._call(self._member_for(topic), 'get', topic, offset, timeout=timeout)
+
+    async def get_batch(self, topic: str, max_messages: int = 100,
+                        max_bytes: Optional[int] = None, offset: Optional[int] = None,
+                        timeout: Optional[float] = None):
+        return await self._call(self._member_for(topic), 'get_batch', topic, max_messages,
+                                max_bytes, offset, timeout=timeout)
+
+    async def join(self, topic: str, group: str, visibility_timeout: Optional[float] = None,
+                   max_in_flight: Optional[int] = None, offset: Union[int, str] = 'earliest',
+                   timeout: Optional[float] = None):
+        member = self._member_for(topic)
+        options = {'group': group, 'visibility_timeout': visibility_timeout,
+                   'max_in_flight': max_in_flight, 'offset': offset}
+        response = await self._call(member, 'join', topic, timeout=timeout, **options)
+        if response.get('status') == 'joined':
+            member.groups[topic] = options
+        return response
+
+    async def leave(self, topic: str, timeout: Optional[float] = None):
+        member = self._member_for(topic)
+        member.groups.pop(topic, None)
+        return await self._call(member, 'leave', topic, timeout=timeout)
+
+    async def ack(self, topic: str, offsets: Union[int, list[int]],
+                  timeout: Optional[float] = None):
+        return await self._call(self._member_for(topic), 'ack', topic, offsets, timeout=timeout)
+
+    async def nack(self, topic: str, offsets: Union[int, list[int]],
+                   timeout: Optional[float] = None):
+        return await self._call(self._member_for(topic), 'nack', topic, offsets, timeout=timeout)
+
+    async def stats(self, timeout: Optional[float] = None):
+        return await self._call(next(self._rotation), 'stats', timeout=timeout)
+
+    async def trace(self, topic: str, offset: int, timeout: Optional[float] = None):
+        return await self._call(self._member_for(topic), 'trace', topic, offset, timeout=timeout)
+
+    async def profile(self, seconds: float, interval: Optional[float] = None,
+                      timeout: Optional[float] = None):
+        return await self._call(next(self._rotation), 'profile', seconds, interval,
+                                timeout=timeout)
+
+    def _member_for(self, topic: str) -> PoolMember:
+        return self.members[zlib.crc32(topic.encode()) % len(self.members)]
+
+    async def _call(self, member: PoolMember, method: str, *args, timeout=None, **kwargs):
+        """Вызывает метод клиента, дожидаясь соединения, если оно сейчас разорвано."""
+        while True:
+            await asyncio.wait_for(member.ready.wait(), timeout or self.request_timeout)
+            response = await getattr(member.client, method)(*args, timeout=timeout, **kwargs)
+            if response.get('status') != 'disconnected' or self._closing:
+                return response
+
+    async def _publish(self, topic: str, method: str, data, timeout: Optional[float] = None,
+                       delay: Optional[float] = None, ttl: Optional[float] = None,
+                       priority: Optional[int] = None, trace: bool = False):
+        member = self._member_for(topic)
+        send = functools.partial(getattr(member.client, method), delay=delay, ttl=ttl,
+                                 priority=priority, trace=trace)
+        while True:
+            # Пока не отправлены отложенные публикации, новые встают за ними.
+            if member.ready.is_set() and not member.buffered and not member.resending:
+                response = await send(topic, data, timeout)
+                if response.get('status') != 'disconnected' or self._closing:
+                    return response
+            if len(member.buffered) >= self.max_buffered:
+                return dict(self.BUFFER_FULL)
+
+            waiter = asyncio.get_running_loop().create_future()
+            member.buffered.append(waiter)
+            # Очередь отпускается по одной публикации, чтобы сохранить порядок:
+            # следующая отпускается, когда эта уже записана в буфер соединения
+            # (запрос пишется до первого ожидания), а ответы ждутся параллельно.
+            try:
+                if not await asyncio.wait_for(waiter, timeout or self.request_timeout):
+                    return dict(AsyncMessageClient.DISCONNECTED)
+                request = asyncio.ensure_future(send(topic, data, timeout))
+                await asyncio.sleep(0)
+            finally:
+                if waiter.cancelled():
+                    # Таймаут или отмена до переподключения: место в очереди свободно.
+                    if waiter in member.buffered:
+                        member.buffered.remove(waiter)
+                elif waiter.done() and waiter.result():
+                    # Публикация уже отпущена (_release_next): очередь переходит
+                    # к следующей, даже если эту прервали до отправки.
+                    member.resending -= 1
+                    self._release_next(member)
+            response = await request
+            if response.get('status') != 'disconnected' or self._closing:
+                return response
+
+    def _release_next(self, member: PoolMember):
+        while member.buffered and member.ready.is_set():
+            waiter = member.buffered.popleft()
+            if not waiter.done():
+                member.resending += 1
+                waiter.set_result(True)
+                return
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.max_reconnect_delay, self.reconnect_delay * 2 ** attempt)
+        return random.uniform(0, delay)
+
+    async def _maintain(self, member: PoolMember):
+        """Следит за соединением: после разрыва переподключает и восстанавливает состояние."""
+        client = member.client
+        while not self._closing:
+            await client.wait_closed()
+            member.ready.clear()
+            attempt = 0
+            while not self._closing:
+                await asyncio.sleep(self._backoff(attempt))
+                attempt += 1
+                try:
+                    await client.connect()
+                    await self._restore(member)
+                except (OSError, ConnectionError, asyncio.TimeoutError):
+                    # Соединение, открытое до ошибки восстановления, не должно висеть.
+                    if client.writer is not None:
+                        client.writer.close()
+                    continue
+                if client.connected:
+                    break
+            member.reconnects += 1
+            member.ready.set()
+            self._release_next(member)
+
+    async def _restore(self, member: PoolMember):
+        """Подписки продолжаются с последних полученных смещений, группы - вступают заново."""
+        client = member.client
+        for topic, options in list(member.subscriptions.items()):
+            offset = options['offset']
+            if not is_pattern(topic) and topic in client.positions:
+                offset = client.positions[topic]
+            await client.subscribe(topic, offset, self.request_timeout, options['credit'],
+                                   options['credit_bytes'], options['filter'])
+        for topic, options in list(member.groups.items()):
+            await client.join(topic, timeout=self.request_timeout, **options)
@@ -0,0 +1,83 @@
+"""Выборочный профилировщик цикла событий брокера.
+
+Пока профилировщик запущен, фоновый поток каждые interval секунд берет стек
+потока цикла событий из sys._current_frames() и считает, сколько раз
+функция оказалась на вершине стека (собственное время) и где-либо в нем
+(общее время). В отличие от cProfile, код брокера не инструментируется:
+цикл событий лишь изредка уступает GIL потоку выборки, а когда
+профилировщик не запущен, этого потока нет вовсе.
+
+Стеки в отчете записаны в "свернутом" формате (функции от корня через ';'
+и число выборок), который понимают flamegraph.pl и speedscope.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+DEFAULT_INTERVAL = 0.005
+MAX_SECONDS = 60.0
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id: Optional[int] = None, interval: float = DEFAULT_INTERVAL,
+                 max_depth: int = 64):
+        # По умолчанию профилируется поток, создавший профилировщик (поток цикла).
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._self: Counter = Counter()
+        self._total: Counter = Counter()
+        self._stacks: Counter = Counter()
+        self._started = 0.0
+        self._elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='mq-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> dict:
+        """Останавливает поток выборки и возвращает отчет."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._elapsed = time.perf_counter() - self._started
+        return self.report()
+
+    def report(self, limit: int = 30) -> dict:
+        functions = [{'function': name, 'self': count, 'total': self._total[name]}
+                     for name, count in self._self.most_common(limit)]
+        return {
+            'duration': round(self._elapsed, 3),
+            'interval': self.interval,
+            'samples': self.samples,
+            'functions': functions,
+            'cumulative': [{'function': name, 'total': count}
+                           for name, count in self._total.most_common(limit)],
+            'stacks': dict(self._stacks.most_common(limit))
+        }
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._sample(frame)
+
+    def _sample(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:'
+                         f'{code.co_firstlineno})')
+            frame = frame.f_back
+        self.samples += 1
+        self._self[stack[0]] += 1
+        # Рекурсивная функция считается в общем времени выборки один раз.
+        self._total.update(set(stack))
+        self._stacks[';'.join(reversed(stack))] += 1
@@ -0,0 +1,271 @@
+"""Репликация лидер - ведомые и ручное переключение лидера.
+
+Лидер принимает публикации, ведомые подключаются к нему как бинарные клиенты
+действием REPLICATE и получают все топики (в том числе новые) с тех смещений,
+на которых остановились. Ведомый подтверждает полученное кадрами REPLICA_ACK;
+лидер с min_replicas > 0 отвечает издателю только после подтверждения от
+min_replicas ведомых, поэтому при переключении теряется лишь
+неподтвержденный хвост. Ведомые обслуживают подписки и чтение по смещению.
+
+    python replication.py --nodes localhost:8889,localhost:8890
+"""
+import argparse
+import asyncio
+import json
+from collections import defaultdict, deque
+from typing import Optional
+
+import framing
+
+
+class PendingAck:
+    """Ответ издателю, ожидающий подтверждения ведомых."""
+
+    __slots__ = ('topic', 'offset', 'writer', 'reply', 'request_id', 'deadline')
+
+    def __init__(self, topic: str, offset: int, writer, reply: dict,
+                 request_id: Optional[int], deadline: float):
+        self.topic = topic
+        self.offset = offset
+        self.writer = writer
+        self.reply = reply
+        self.request_id = request_id
+        self.deadline = deadline
+
+
+class ReplicaSet:
+    """Подтверждения ведомых на лидере и ответы издателям, которые их ждут."""
+
+    def __init__(self, min_replicas: int = 0, timeout: float = 5.0):
+        self.min_replicas = min_replicas
+        self.timeout = timeout
+        # Для каждого ведомого: смещение следующего еще не полученного сообщения.
+        self.acked: dict[object, dict[str, int]] = {}
+        self._waiting: defaultdict[str, deque[PendingAck]] = defaultdict(deque)
+        # Сколько ответов ждет каждый издатель: учитывается в лимите запросов в работе.
+        self._waiting_by_writer: defaultdict[object, int] = defaultdict(int)
+
+    def __len__(self):
+        return len(self.acked)
+
+    def add(self, writer):
+        self.acked[writer] = {}
+
+    def remove(self, writer):
+        self.acked.pop(writer, None)
+
+    def replicated(self, topic: str) -> int:
+        """Смещение, до которого топик есть у min_replicas ведомых."""
+        if self.min_replicas <= 0:
+            return 1 << 62
+        positions = sorted((acked.get(topic, 0) for acked in self.acked.values()), reverse=True)
+        if len(positions) < self.min_replicas:
+            return 0
+        return positions[self.min_replicas - 1]
+
+    def wait(self, topic: str, offset: int, writer, reply: dict, request_id: Optional[int],
+             now: float):
+        self._waiting[topic].append(
+            PendingAck(topic, offset, writer, reply, request_id, now + self.timeout))
+        self._waiting_by_writer[writer] += 1
+
+    def waiting(self, writer) -> int:
+        return self._waiting_by_writer.get(writer, 0)
+
+    def _released(self, pending: PendingAck) -> PendingAck:
+        count = self._waiting_by_writer[pending.writer] - 1
+        if count:
+            self._waiting_by_writer[pending.writer] = count
+        else:
+            del self._waiting_by_writer[pending.writer]
+        return pending
+
+    def record(self, writer, topic: str, next_offset: int) -> list[PendingAck]:
+        """Учитывает подтверждение ведомого и возвращает ответы, которые можно отправить."""
+        acked = self.acked.get(writer)
+        if acked is None:
+            return []
+        acked[topic] = max(acked.get(topic, 0), next_offset)
+
+        waiting = self._waiting.get(topic)
+        released = []
+        if waiting:
+            replicated = self.replicated(topic)
+            while waiting and waiting[0].offset < replicated:
+                released.append(self._released(waiting.popleft()))
+        return released
+
+    def expired(self, now: float) -> list[PendingAck]:
+        expired = []
+        for waiting in self._waiting.values():
+            # В очереди топика сроки растут вместе со смещениями.
+            while waiting and waiting[0].deadline <= now:
+                expired.append(self._released(waiting.popleft()))
+        return expired
+
+
+class Follower:
+    """Задача ведомого: получает поток топиков лидера и применяет его к брокеру."""
+
+    HANDSHAKE_ID = 1
+
+    def __init__(self, broker, host: str, port: int, retry_interval: float = 1.0):
+        self.broker = broker
+        self.host = host
+        self.port = port
+        self.retry_interval = retry_interval
+        self.connected = False
+        self._topics: dict[int, str] = {}
+        self._dirty: dict[str, int] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._flush_scheduled = False
+
+    @property
+    def address(self) -> str:
+        return f'{self.host}:{self.port}'
+
+    async def run(self):
+        while True:
+            try:
+                await self._replicate()
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncio.IncompleteReadError, ConnectionError) as exc:
+                if self.connected:
+                    print(f"Связь с лидером {self.address} потеряна: {exc}")
+            finally:
+                self.connected = False
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+            await asyncio.sleep(self.retry_interval)
+
+    async def _replicate(self):
+        reader, writer = await asyncio.open_connection(
+            self.host, self.port, limit=self.broker.max_frame_size)
+        self._writer = writer
+        writer.write(framing.PREFACE)
+        preface = await reader.readexactly(len(framing.PREFACE))
+        if preface != framing.PREFACE:
+            raise ConnectionError(f'Leader rejected binary framing: {preface!r}')
+
+        positions = self.broker.replication_positions()
+        writer.write(framing.encode_frame(framing.REPLICATE, 0, json.dumps(positions).encode(),
+                                          self.HANDSHAKE_ID))
+        self._topics.clear()
+        self._dirty.clear()
+
+        while True:
+            action, topic_id, request_id, payload = await framing.read_frame(
+                reader, self.broker.max_frame_size)
+            if action == framing.REPLY:
+                self._handle_reply(request_id, json.loads(payload))
+            elif action == framing.MESSAGE:
+                topic = self._topics.get(topic_id)
+                if topic is None:
+                    continue
+                (offset,) = framing.OFFSET.unpack_from(payload)
+                self.broker.apply_replicated(topic, offset, payload[framing.OFFSET.size:])
+                self._dirty[topic] = topic_id
+                self._schedule_flush()
+
+    def _handle_reply(self, request_id: int, reply: dict):
+        status = reply.get('status')
+        if request_id == self.HANDSHAKE_ID:
+            if status != 'replicating':
+                raise ConnectionError(f'Leader refused replication: {reply}')
+            # Хвост, которого нет у лидера, не был подтвержден издателям:
+            # отбрасываем его, чтобы не разойтись с новым лидером.
+            self.broker.truncate_to_leader(reply['offsets'])
+            self.connected = True
+            print(f"Репликация с лидера {self.address}")
+        elif status == 'bound':
+            self._topics[reply['topic_id']] = reply['topic']
+
+    def _schedule_flush(self):
+        # Подтверждения отправляются, когда прочитаны все уже пришедшие кадры.
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush_acks)
+
+    def _flush_acks(self):
+        self._flush_scheduled = False
+        if self._writer is None or self._writer.is_closing():
+            return
+        for topic, topic_id in self._dirty.items():
+            next_offset = self.broker.queues[topic].next_offset
+            self._writer.write(framing.encode_frame(framing.REPLICA_ACK, topic_id,
+                                                    framing.OFFSET.pack(next_offset)))
+        self._dirty.clear()
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+def most_caught_up(positions: dict[str, dict[str, int]]) -> str:
+    """Узел, который в каждом топике не отстает от остальных.
+
+    Смещения разных топиков не складываются: ведомый, далеко ушедший в одном
+    топике, мог отстать в другом, и его назначение отбросило бы
+    подтвержденные сообщения. Если такого узла нет, выбирается узел,
+    догнавший больше всего топиков, и отстающие топики выводятся.
+    """
+    topics = set().union(*positions.values())
+    latest = {topic: max(offsets.get(topic, 0) for offsets in positions.values())
+              for topic in topics}
+
+    def behind(address: str) -> list[str]:
+        return [topic for topic in topics if positions[address].get(topic, 0) < latest[topic]]
+
+    leader = min(positions, key=lambda address: len(behind(address)))
+    if behind(leader):
+        print(f"Ни один ведомый не догнал все топики, {leader} отстает в: "
+              f"{', '.join(sorted(behind(leader)))}")
+    return leader
+
+
+async def failover(nodes: list[str]) -> Optional[str]:
+    """Назначает лидером самого догнавшего ведомого, остальные узлы следуют за ним."""
+    from async_message_client import AsyncMessageClient
+
+    states = {}
+    for address in nodes:
+        host, port = parse_address(address)
+        client = AsyncMessageClient(host, port, request_timeout=2.0)
+        try:
+            await client.connect()
+            states[address] = (client, await client.stats())
+        except (OSError, asyncio.TimeoutError) as exc:
+            print(f"Узел {address} недоступен: {exc}")
+
+    try:
+        followers = {address: stats for address, (_, stats) in states.items()
+                     if stats.get('role') == 'follower'}
+        if not followers:
+            print("Нет доступных ведомых")
+            return None
+
+        leader = most_caught_up({address: stats['offsets']
+                                 for address, stats in followers.items()})
+        print(f"Новый лидер: {leader} -> {await states[leader][0].promote()}")
+        for address, (client, _) in states.items():
+            if address != leader:
+                print(f"{address} -> {await client.follow(*parse_address(leader))}")
+        return leader
+    finally:
+        for client, _ in states.values():
+            await client.disconnect()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Переключение лидера репликации')
+    parser.add_argument('--nodes', required=True,
+                        help='адреса узлов через запятую: host:port,host:port')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    asyncio.run(failover(arguments.nodes.split(',')))
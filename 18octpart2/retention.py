@@ -0,0 +1,46 @@
+"""Ограничения хранения сообщений в топиках брокера и счетчики по топикам."""
+from typing import Optional
+
+
+class RetentionPolicy:
+    """Лимиты хранения: число сообщений, байты данных и возраст в секундах.
+
+    None означает отсутствие ограничения. Политика применяется как к одному
+    топику, так и ко всему брокеру целиком.
+    """
+
+    def __init__(self, max_messages: Optional[int] = None, max_bytes: Optional[int] = None,
+                 max_age: Optional[float] = None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    @property
+    def unlimited(self) -> bool:
+        return self.max_messages is None and self.max_bytes is None and self.max_age is None
+
+    def exceeded(self, messages: int, size: int) -> bool:
+        return ((self.max_messages is not None and messages > self.max_messages)
+                or (self.max_bytes is not None and size > self.max_bytes))
+
+    def expired(self, created: float, now: float) -> bool:
+        return self.max_age is not None and now - created > self.max_age
+
+
+class TopicStats:
+    """Текущий объем топика, отложенные публикации и вытесненные или истекшие сообщения."""
+
+    __slots__ = ('messages', 'bytes', 'evicted', 'evicted_bytes', 'expired', 'delayed')
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.evicted = 0
+        self.evicted_bytes = 0
+        # Удалено по истечении срока жизни (ttl) сообщения.
+        self.expired = 0
+        # Ждут срока отложенной доставки и в топик еще не попали.
+        self.delayed = 0
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
@@ -0,0 +1,445 @@
+"""Многопроцессный брокер: топики распределены по шардам между рабочими процессами.
+
+Каждый из N рабочих процессов запускает свой AsyncMessageBroker и слушает общий
+TCP-порт (SO_REUSEPORT), так что ядро само распределяет подключения клиентов.
+Топик принадлежит шарду crc32(имя) % N. Запрос к чужому топику процесс
+пересылает владельцу через unix-сокет, а ответы и рассылки владельца
+передает клиенту как есть, поэтому клиенту не нужно знать о шардах.
+Действия без топика, в том числе stats, выполняет процесс, принявший
+соединение, поэтому stats описывает только этот шард.
+
+    python sharded_broker.py --workers 4 --port 8888 [--data-dir ./data]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import struct
+import tempfile
+import zlib
+from typing import Optional
+
+import framing
+from async_broker_server import (AsyncMessageBroker, ClientOutbox, add_broker_arguments,
+                                 broker_options)
+from topic_trie import is_pattern
+from transport import STREAMS, TRANSPORTS, run, start_server
+
+# Начало строки рассылки в JSON-протоколе (см. StoredMessage.json_frame).
+JSON_PUSH_PREFIX = b'{"type": "message"'
+# Служебные запросы процесса к владельцу шарда используют id из верхней
+# половины диапазона, чтобы не пересекаться с id запросов клиента.
+INTERNAL_REQUEST_IDS = 2 ** 31
+
+
+def shard_for(topic: str, shards: int) -> int:
+    """Шард-владелец топика; crc32, а не hash(), одинаков во всех процессах."""
+    return zlib.crc32(topic.encode()) % shards
+
+
+def socket_path(ipc_dir: str, index: int) -> str:
+    return os.path.join(ipc_dir, f'shard-{index}.sock')
+
+
+class ShardLink:
+    """Соединение с владельцем шарда от имени одного клиентского соединения.
+
+    Ссылка работает в формате клиента: запросы уходят владельцу без изменений,
+    а все его кадры ставятся в очередь клиента. Поэтому подписки, курсоры и
+    группы потребителей на владельце принадлежат этому клиенту.
+    """
+
+    def __init__(self, shard: int, outbox: ClientOutbox, max_frame_size: int):
+        self.shard = shard
+        self.outbox = outbox
+        self.binary = outbox.binary
+        self.max_frame_size = max_frame_size
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        # Id шаблонов подписки, привязанных на владельце (только бинарный режим).
+        self.pattern_ids: dict[str, int] = {}
+        self._internal: dict[int, asyncio.Future] = {}
+        self._internal_ids = itertools.count(INTERNAL_REQUEST_IDS)
+        self._task: Optional[asyncio.Task] = None
+
+    async def open(self, path: str):
+        self.reader, self.writer = await asyncio.open_unix_connection(
+            path, limit=self.max_frame_size)
+        if self.binary:
+            self.writer.write(framing.PREFACE)
+            preface = await self.reader.readexactly(len(framing.PREFACE))
+            if preface != framing.PREFACE:
+                raise ConnectionError(f'Shard {self.shard} rejected binary framing')
+        self._task = asyncio.create_task(self._relay())
+
+    async def send(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def negotiate_compression(self) -> dict:
+        """Согласует с владельцем сжатие, которое клиент согласовал с этим процессом."""
+        return await self.request(framing.COMPRESS, 0, framing.COMPRESSION_ZLIB.encode())
+
+    async def request(self, action: int, topic_id: int, payload: bytes = b'') -> dict:
+        """Служебный бинарный запрос; ответ не пересылается клиенту."""
+        request_id = next(self._internal_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._internal[request_id] = future
+        try:
+            await self.send(framing.encode_frame(action, topic_id, payload, request_id))
+            return await future
+        finally:
+            self._internal.pop(request_id, None)
+
+    async def _relay(self):
+        try:
+            if self.binary:
+                await self._relay_binary()
+            else:
+                await self._relay_json()
+        except asyncio.CancelledError:
+            raise
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        # Владелец шарда недоступен: клиент переподключится и попадет
+        # в рабочее состояние, вместо того чтобы ждать ответов вечно.
+        for future in self._internal.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f'Shard {self.shard} disconnected'))
+        self.outbox.writer.close()
+
+    async def _relay_binary(self):
+        while True:
+            action, topic_id, request_id, payload = await framing.read_frame(
+                self.reader, self.max_frame_size)
+            future = self._internal.get(request_id)
+            if future is not None:
+                if not future.done():
+                    future.set_result(json.loads(payload))
+                continue
+            self.outbox.put(framing.encode_frame(action, topic_id, payload, request_id),
+                            droppable=action == framing.MESSAGE)
+
+    async def _relay_json(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            self.outbox.put(line, droppable=line.startswith(JSON_PUSH_PREFIX))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.close()
+
+
+class ShardedBroker(AsyncMessageBroker):
+    """Брокер одного шарда, который пересылает запросы к чужим топикам владельцам.
+
+    Id топика выдает только его владелец, и остаток (id - 1) % shards равен
+    номеру владельца, поэтому бинарные кадры маршрутизируются без имени топика.
+    Шаблоны подписок привязываются локально и рассылаются всем шардам.
+    """
+
+    def __init__(self, index: int, shards: int, ipc_dir: str, **options):
+        super().__init__(**options)
+        self.index = index
+        self.shards = shards
+        self.ipc_dir = ipc_dir
+        self.links: dict[asyncio.StreamWriter, dict[int, ShardLink]] = {}
+        # Запросы соединений других процессов (self.peers) всегда
+        # обслуживаются локально.
+        self._peer_tasks: set[asyncio.Task] = set()
+
+    def _next_topic_id(self) -> int:
+        return len(self.topic_ids) * self.shards + self.index + 1
+
+    def owner_of(self, topic: str) -> int:
+        return self.index if is_pattern(topic) else shard_for(topic, self.shards)
+
+    async def handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.peers.add(writer)
+        task = asyncio.current_task()
+        self._peer_tasks.add(task)
+        try:
+            await self.handle_client(reader, writer)
+        finally:
+            self.peers.discard(writer)
+            self._peer_tasks.discard(task)
+
+    async def stop(self):
+        # Соседний шард может не успеть закрыть свои ссылки до остановки:
+        # их соединения закрываются здесь, иначе обработчики отменил бы asyncio.run.
+        for writer in list(self.peers):
+            writer.close()
+        if self._peer_tasks:
+            await asyncio.wait(set(self._peer_tasks), timeout=1.0)
+        await super().stop()
+
+    async def process_message(self, message: dict, writer: asyncio.StreamWriter,
+                              received: float | None = None):
+        topic = message.get('topic')
+        if writer in self.peers or not isinstance(topic, str):
+            await super().process_message(message, writer, received)
+            return
+
+        if message.get('action') in ('subscribe', 'unsubscribe') and is_pattern(topic):
+            await super().process_message(message, writer, received)
+            # Копии без id: ответы шардов клиент не сопоставит ни с одним запросом.
+            broadcast = {key: value for key, value in message.items() if key != 'id'}
+            data = self._encode(broadcast)
+            for shard in self._remote_shards():
+                link = await self._link(writer, shard)
+                if link is not None:
+                    await link.send(data)
+            return
+
+        owner = self.owner_of(topic)
+        if owner == self.index:
+            await super().process_message(message, writer, received)
+            return
+
+        request_id = message.get('id')
+        items = None
+        if self.rate_limited and message.get('action') == 'publish':
+            items = [json.dumps(message.get('message')).encode()]
+        elif (self.rate_limited and message.get('action') == 'publish_batch'
+              and isinstance(message.get('messages'), list)):
+            items = [json.dumps(item).encode() for item in message['messages']]
+        if not self._admit_forwarded(topic, items, writer, request_id):
+            return
+        link = await self._link(writer, owner, request_id)
+        if link is not None:
+            await link.send(self._encode(message))
+
+    async def process_frame(self, action: int, topic_id: int, request_id: int,
+                            payload: bytes, writer: asyncio.StreamWriter):
+        # Действия без топика (stats, compress и другие) относятся к процессу,
+        # к которому подключен клиент.
+        if writer in self.peers or (topic_id == 0 and action != framing.BIND):
+            await super().process_frame(action, topic_id, request_id, payload, writer)
+            if action == framing.COMPRESS and writer not in self.peers:
+                await self._negotiate_compression(writer)
+            return
+
+        if action == framing.BIND:
+            owner = self.owner_of(payload.decode())
+        else:
+            owner = (topic_id - 1) % self.shards
+
+        if owner != self.index:
+            items = self._forwarded_items(action, payload) if self.rate_limited else None
+            if not self._admit_forwarded(self.topic_names.get(topic_id), items, writer,
+                                         request_id):
+                return
+            link = await self._link(writer, owner, request_id)
+            if link is not None:
+                await link.send(framing.encode_frame(action, topic_id, payload, request_id))
+            return
+
+        await super().process_frame(action, topic_id, request_id, payload, writer)
+        pattern = self.topic_names.get(topic_id)
+        if action in (framing.SUBSCRIBE, framing.UNSUBSCRIBE) and pattern and is_pattern(pattern):
+            for shard in self._remote_shards():
+                link = await self._link(writer, shard)
+                if link is not None:
+                    await self._forward_pattern(link, action, pattern, payload)
+
+    def _admit_forwarded(self, topic: Optional[str], items: Optional[list[bytes]],
+                         writer: asyncio.StreamWriter, request_id: int | None) -> bool:
+        """Контроль допуска запроса, который обслужит другой шард.
+
+        Соединения шардов от допуска освобождены, поэтому лимиты клиента
+        проверяет процесс, к которому он подключен. items - данные
+        публикации или None, если запрос - не публикация.
+        """
+        if self.max_client_in_flight is not None and not self._admit_request(writer,
+                                                                              request_id):
+            return False
+        return items is None or self._admit_publish(topic, len(items), sum(map(len, items)),
+                                                    writer, request_id)
+
+    def _forwarded_items(self, action: int, payload: bytes) -> Optional[list[bytes]]:
+        """Данные бинарной публикации для маркерных корзин или None.
+
+        Неразборный кадр пересылается как есть: ошибку вернет владелец.
+        """
+        if action & ~(framing.COMPRESSED | framing.OPTIONS) not in (framing.PUBLISH,
+                                                                    framing.PUBLISH_BATCH):
+            return None
+        try:
+            if action & framing.COMPRESSED:
+                payload = framing.decompress(payload, self.max_frame_size)
+            if action & framing.OPTIONS:
+                payload = payload[framing.PUBLISH_OPTIONS.size:]
+            if action & ~(framing.COMPRESSED | framing.OPTIONS) == framing.PUBLISH:
+                return [payload]
+            return framing.unpack_items(payload)
+        except (struct.error, ValueError):
+            return None
+
+    async def _forward_pattern(self, link: ShardLink, action: int, pattern: str,
+                               payload: bytes):
+        pattern_id = link.pattern_ids.get(pattern)
+        if pattern_id is None:
+            if action == framing.UNSUBSCRIBE:
+                return
+            response = await link.request(framing.BIND, 0, pattern.encode())
+            pattern_id = link.pattern_ids[pattern] = response['topic_id']
+        await link.request(action, pattern_id, payload)
+
+    async def _negotiate_compression(self, writer: asyncio.StreamWriter):
+        """Переносит согласованное клиентом сжатие на уже открытые ссылки."""
+        outbox = self.outboxes.get(writer)
+        if outbox is None or not outbox.compression:
+            return
+        for link in self.links.get(writer, {}).values():
+            await link.negotiate_compression()
+
+    def _remote_shards(self) -> list[int]:
+        return [shard for shard in range(self.shards) if shard != self.index]
+
+    async def _link(self, writer: asyncio.StreamWriter, shard: int,
+                    request_id: int | None = None) -> Optional[ShardLink]:
+        links = self.links.setdefault(writer, {})
+        link = links.get(shard)
+        if link is not None:
+            return link
+
+        outbox = self.outboxes.get(writer)
+        if outbox is None:
+            return None
+        link = ShardLink(shard, outbox, self.max_frame_size)
+        try:
+            await link.open(socket_path(self.ipc_dir, shard))
+            if outbox.compression:
+                # Иначе владелец отклонит сжатые публикации клиента.
+                await link.negotiate_compression()
+        except (OSError, asyncio.IncompleteReadError, ConnectionError) as exc:
+            self._send(writer, {
+                'status': 'error',
+                'message': f"Shard {shard} unavailable: {exc}"
+            }, request_id)
+            return None
+        links[shard] = link
+        return link
+
+    async def _cleanup_writer(self, writer: asyncio.StreamWriter):
+        for link in self.links.pop(writer, {}).values():
+            await link.close()
+        await super()._cleanup_writer(writer)
+
+
+async def _wait_for_peers(ipc_dir: str, shards: int, timeout: float = 10.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not all(os.path.exists(socket_path(ipc_dir, index)) for index in range(shards)):
+        if loop.time() > deadline:
+            raise RuntimeError('Shard workers did not start in time')
+        await asyncio.sleep(0.05)
+
+
+async def serve_shard(index: int, shards: int, host: str, port: int, ipc_dir: str,
+                      args: argparse.Namespace):
+    """Запускает шард index с параметрами брокера из args (см. add_broker_arguments)."""
+    shard_args = argparse.Namespace(**vars(args))
+    if args.data_dir:
+        shard_args.data_dir = os.path.join(args.data_dir, f'shard-{index}')
+    broker = ShardedBroker(index, shards, ipc_dir, **broker_options(shard_args))
+    await broker.start()
+
+    peer_server = await asyncio.start_unix_server(broker.handle_peer,
+                                                  socket_path(ipc_dir, index))
+    await _wait_for_peers(ipc_dir, shards)
+    server = await start_server(broker, host, port, args.transport, reuse_port=True)
+    print(f"Шард {index}/{shards} запущен на {server.sockets[0].getsockname()}, pid {os.getpid()}")
+
+    # Шард останавливает родительский процесс сигналом SIGTERM: брокер при
+    # этом закрывается штатно и сбрасывает журнал.
+    stopped = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    try:
+        async with peer_server, server:
+            await stopped.wait()
+    finally:
+        await broker.stop()
+
+
+def run_shard(*args):
+    # Ctrl+C получает вся группа процессов, а шарды останавливает родитель.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run(serve_shard(*args))
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _stop_shards(processes: list[multiprocessing.Process], timeout: float = 5.0):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+
+def run_workers(args: argparse.Namespace):
+    """Запускает args.workers процессов (по умолчанию - по числу ядер) и ждет их завершения.
+
+    По SIGINT и SIGTERM шарды останавливаются, а каталог их сокетов удаляется.
+    """
+    workers = args.workers or os.cpu_count() or 1
+    ipc_dir = tempfile.mkdtemp(prefix='mq-shards-')
+    started = []
+    previous = {signal.SIGINT: signal.getsignal(signal.SIGINT),
+                signal.SIGTERM: signal.signal(signal.SIGTERM, _interrupt)}
+    try:
+        for index in range(workers):
+            process = multiprocessing.Process(
+                target=run_shard, daemon=True,
+                args=(index, workers, args.host, args.port, ipc_dir, args))
+            process.start()
+            started.append(process)
+        for process in started:
+            process.join()
+    except KeyboardInterrupt:
+        print("\nОстановка шардов")
+    finally:
+        # Повторный сигнал не должен прервать остановку и оставить каталог.
+        for signum in previous:
+            signal.signal(signum, signal.SIG_IGN)
+        try:
+            _stop_shards(started)
+            shutil.rmtree(ipc_dir, ignore_errors=True)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Многопроцессный брокер сообщений')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='число рабочих процессов (по умолчанию - число ядер)')
+    parser.add_argument('--transport', choices=TRANSPORTS, default=STREAMS,
+                        help='сетевой слой: потоки asyncio или asyncio.Protocol')
+    add_broker_arguments(parser)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    run_workers(parse_args())
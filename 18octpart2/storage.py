@@ -0,0 +1,372 @@
+"""Журнал сегментов: долговременное хранение сообщений топиков на диске.
+
+Каждый топик хранится в своем каталоге в виде сегментов:
+
+    <каталог топика>/<первый номер>.log  - записи RECORD + данные сообщения
+    <каталог топика>/<первый номер>.idx  - по записи INDEX_ENTRY на сообщение
+    <каталог топика>/head                - номер первого непрочитанного сообщения
+
+Публикация только дописывает данные в буферы файлов, fsync выполняется
+групповым коммитом раз в fsync_interval секунд в пуле потоков, поэтому
+скорость публикации остается как у хранения в памяти. При запуске брокер
+читает только индексы сегментов, а данные сообщений потом читаются лениво
+через mmap, без повторного разбора JSON.
+"""
+import asyncio
+import heapq
+import mmap
+import os
+import struct
+import time
+from typing import Iterator, Optional
+from urllib.parse import quote, unquote
+
+# Заголовок записи: длина данных и время публикации (unix time).
+RECORD = struct.Struct('!Id')
+# Запись индекса: смещение записи в .log и длина данных.
+INDEX_ENTRY = struct.Struct('!QI')
+HEAD = struct.Struct('!Q')
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+
+
+class Segment:
+    """Один сегмент топика: файл данных, индекс и отображение в память для чтения."""
+
+    def __init__(self, directory: str, base: int):
+        self.base = base
+        self.count = 0
+        self.size = 0
+        self.log_path = os.path.join(directory, f'{base:020d}.log')
+        self.idx_path = os.path.join(directory, f'{base:020d}.idx')
+        self._log = None
+        self._idx = None
+        self._map: Optional[mmap.mmap] = None
+
+    @property
+    def writable(self) -> bool:
+        return self._log is not None
+
+    def open_for_append(self):
+        self._log = open(self.log_path, 'ab')
+        self._idx = open(self.idx_path, 'ab')
+
+    def append(self, data: bytes, timestamp: float) -> int:
+        position = self.size
+        self._log.write(RECORD.pack(len(data), timestamp))
+        self._log.write(data)
+        self._idx.write(INDEX_ENTRY.pack(position, len(data)))
+        self.size += RECORD.size + len(data)
+        self.count += 1
+        return position
+
+    def flush(self) -> list[int]:
+        """Сбрасывает буферы Python в ОС и возвращает копии дескрипторов для fsync.
+
+        fsync выполняется в пуле потоков, а сегмент тем временем может быть
+        закрыт; копии закрывает тот, кто выполнил fsync.
+        """
+        if self._log is None:
+            return []
+        self._log.flush()
+        self._idx.flush()
+        return [os.dup(self._log.fileno()), os.dup(self._idx.fileno())]
+
+    def read(self, position: int, length: int) -> bytes:
+        start = position + RECORD.size
+        if self._map is None or len(self._map) < start + length:
+            self._remap()
+        return self._map[start:start + length]
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _remap(self):
+        if self._log is not None:
+            self._log.flush()
+        if self._map is not None:
+            self._map.close()
+        with open(self.log_path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def entries(self) -> Iterator[tuple[int, int, float]]:
+        """Читает индекс и отбрасывает записи, не полностью дошедшие до диска."""
+        log_size = os.path.getsize(self.log_path)
+        with open(self.idx_path, 'rb') as file:
+            index = file.read()
+
+        valid = len(index) - len(index) % INDEX_ENTRY.size
+        if log_size:
+            self._remap()
+        for offset in range(0, valid, INDEX_ENTRY.size):
+            position, length = INDEX_ENTRY.unpack_from(index, offset)
+            if position + RECORD.size + length > log_size:
+                break
+            _, timestamp = RECORD.unpack_from(self._map, position)
+            self.count += 1
+            self.size = position + RECORD.size + length
+            yield position, length, timestamp
+
+    def truncate_tail(self):
+        """Обрезает файлы по последней целой записи после аварийного завершения."""
+        for path, size in ((self.log_path, self.size),
+                           (self.idx_path, self.count * INDEX_ENTRY.size)):
+            if os.path.getsize(path) != size:
+                self._unmap()
+                with open(path, 'r+b') as file:
+                    file.truncate(size)
+
+    def truncate_to(self, count: int) -> list[int]:
+        """Оставляет в сегменте только первые count записей.
+
+        Возвращает дескрипторы для fsync оставшейся части, как seal.
+        """
+        if count >= self.count:
+            return []
+        descriptors = self.seal()
+        with open(self.idx_path, 'rb') as file:
+            file.seek(count * INDEX_ENTRY.size)
+            position, _ = INDEX_ENTRY.unpack(file.read(INDEX_ENTRY.size))
+        self.count = count
+        self.size = position
+        self.truncate_tail()
+        return descriptors
+
+    def seal(self) -> list[int]:
+        """Закрывает сегмент для записи и возвращает дескрипторы для fsync.
+
+        Данные остаются доступны для чтения.
+        """
+        descriptors = self.flush()
+        for file in (self._log, self._idx):
+            if file is not None:
+                file.close()
+        self._log = self._idx = None
+        return descriptors
+
+    def close(self):
+        _fsync_all(self.seal())
+        self._unmap()
+
+    def remove(self):
+        # Удаляемые данные синхронизировать незачем.
+        for descriptor in self.seal():
+            os.close(descriptor)
+        self._unmap()
+        for path in (self.log_path, self.idx_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class TopicLog:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.segments: list[Segment] = []
+        self.head = 0
+        self.next_seq = 0
+        self.head_dirty = False
+
+    @property
+    def active(self) -> Segment:
+        return self.segments[-1]
+
+    def roll(self) -> list[int]:
+        """Начинает новый сегмент и возвращает дескрипторы заполненного для fsync.
+
+        Заполненный сегмент синхронизирует ближайший групповой коммит, а не
+        цикл событий, в котором идет публикация.
+        """
+        descriptors = self.active.seal() if self.segments else []
+        segment = Segment(self.directory, self.next_seq)
+        segment.open_for_append()
+        self.segments.append(segment)
+        return descriptors
+
+
+class RecoveredMessage:
+    __slots__ = ('topic', 'offset', 'segment', 'position', 'size', 'timestamp')
+
+    def __init__(self, topic: str, offset: int, segment: Segment, position: int, size: int,
+                 timestamp: float):
+        self.topic = topic
+        self.offset = offset
+        self.segment = segment
+        self.position = position
+        self.size = size
+        self.timestamp = timestamp
+
+
+class SegmentLog:
+    def __init__(self, directory: str, segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+                 fsync_interval: float = 0.05):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.topics: dict[str, TopicLog] = {}
+        self._dirty: set[str] = set()
+        # Дескрипторы закрытых при смене сегмента файлов, ждущие группового коммита.
+        self._sealed: list[int] = []
+        os.makedirs(directory, exist_ok=True)
+
+    def recover(self) -> list[RecoveredMessage]:
+        """Восстанавливает топики по индексам сегментов; данные не читаются.
+
+        Сообщения каждого топика идут в порядке номеров (сегмент, позиция в
+        нем), даже если часы при записи шли назад. Топики между собой сливаются
+        по времени публикации, чтобы глобальный лимит хранения вытеснял самые
+        старые сообщения.
+        """
+        by_topic = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(path):
+                continue
+
+            topic = unquote(name)
+            messages = []
+            topic_log = TopicLog(path)
+            topic_log.head = self._read_head(path)
+            bases = sorted(int(file[:-4]) for file in os.listdir(path) if file.endswith('.log'))
+            for base in bases:
+                segment = Segment(path, base)
+                if not os.path.exists(segment.idx_path):
+                    open(segment.idx_path, 'wb').close()
+                for index, (position, length, timestamp) in enumerate(segment.entries()):
+                    if base + index >= topic_log.head:
+                        messages.append(RecoveredMessage(topic, base + index, segment,
+                                                         position, length, timestamp))
+                segment.truncate_tail()
+                topic_log.segments.append(segment)
+                topic_log.next_seq = base + segment.count
+
+            if topic_log.segments:
+                topic_log.head = max(topic_log.head, topic_log.segments[0].base)
+            # Файл head мог дойти до диска раньше хвоста данных: новые сообщения
+            # должны получить номера после него.
+            topic_log.next_seq = max(topic_log.next_seq, topic_log.head)
+            if topic_log.segments:
+                topic_log.active.open_for_append()
+            self.topics[topic] = topic_log
+            by_topic.append(messages)
+
+        return list(heapq.merge(*by_topic, key=lambda message: message.timestamp))
+
+    def next_offsets(self) -> dict[str, int]:
+        return {topic: topic_log.next_seq for topic, topic_log in self.topics.items()}
+
+    def append(self, topic: str, data: bytes, offset: Optional[int] = None) -> None:
+        """Дописывает сообщение; offset - его номер в топике (по умолчанию следующий)."""
+        topic_log = self.topics.get(topic)
+        if topic_log is None:
+            path = os.path.join(self.directory, quote(topic, safe=''))
+            os.makedirs(path, exist_ok=True)
+            topic_log = self.topics[topic] = TopicLog(path)
+
+        if offset is not None:
+            topic_log.next_seq = offset
+        if (not topic_log.segments or topic_log.active.size >= self.segment_bytes
+                or topic_log.active.base + topic_log.active.count != topic_log.next_seq):
+            self._sealed.extend(topic_log.roll())
+        topic_log.active.append(data, time.time())
+        topic_log.next_seq += 1
+        self._dirty.add(topic)
+
+    def truncate(self, topic: str, offset: int) -> None:
+        """Удаляет с диска сообщения топика со смещением offset и больше."""
+        topic_log = self.topics.get(topic)
+        if topic_log is None:
+            return
+
+        while topic_log.segments and topic_log.active.base >= offset:
+            topic_log.segments.pop().remove()
+        if topic_log.segments:
+            self._sealed.extend(topic_log.active.truncate_to(offset - topic_log.active.base))
+            if not topic_log.active.writable:
+                topic_log.active.open_for_append()
+        topic_log.next_seq = offset
+        if topic_log.head > offset:
+            topic_log.head = offset
+            topic_log.head_dirty = True
+        self._dirty.add(topic)
+
+    def advance_head(self, topic: str, count: int = 1) -> None:
+        """Отмечает, что count самых старых сообщений топика удалены из очереди."""
+        topic_log = self.topics.get(topic)
+        if topic_log is None:
+            return
+        topic_log.head += count
+        topic_log.head_dirty = True
+        self._dirty.add(topic)
+
+    async def run(self):
+        """Групповой коммит: раз в fsync_interval сбрасывает на диск все изменения."""
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                await self.commit()
+            except OSError as exc:
+                # Остановка коммита означала бы, что fsync больше не выполняется.
+                print(f"Ошибка группового коммита журнала: {exc}")
+
+    async def commit(self):
+        descriptors = self._flush()
+        if descriptors:
+            await asyncio.get_running_loop().run_in_executor(None, _fsync_all, descriptors)
+
+    def _flush(self) -> list[int]:
+        descriptors, self._sealed = self._sealed, []
+        for topic in self._dirty:
+            topic_log = self.topics[topic]
+            if topic_log.segments:
+                descriptors.extend(topic_log.active.flush())
+            if topic_log.head_dirty:
+                self._write_head(topic_log)
+                self._drop_consumed_segments(topic_log)
+        self._dirty.clear()
+        return descriptors
+
+    def _drop_consumed_segments(self, topic_log: TopicLog):
+        while len(topic_log.segments) > 1:
+            oldest, following = topic_log.segments[0], topic_log.segments[1]
+            if following.base > topic_log.head:
+                break
+            oldest.remove()
+            topic_log.segments.pop(0)
+
+    @staticmethod
+    def _read_head(path: str) -> int:
+        try:
+            with open(os.path.join(path, 'head'), 'rb') as file:
+                return HEAD.unpack(file.read(HEAD.size))[0]
+        except (FileNotFoundError, struct.error):
+            return 0
+
+    @staticmethod
+    def _write_head(topic_log: TopicLog):
+        path = os.path.join(topic_log.directory, 'head')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(HEAD.pack(topic_log.head))
+        os.replace(tmp_path, path)
+        topic_log.head_dirty = False
+
+    def close(self):
+        descriptors = self._flush()
+        _fsync_all(descriptors)
+        for topic_log in self.topics.values():
+            for segment in topic_log.segments:
+                segment.close()
+
+
+def _fsync_all(descriptors: list[int]):
+    """Синхронизирует копии дескрипторов из Segment.flush и закрывает их."""
+    try:
+        for descriptor in descriptors:
+            os.fsync(descriptor)
+    finally:
+        for descriptor in descriptors:
+            os.close(descriptor)
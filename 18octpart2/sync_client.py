@@ -0,0 +1,289 @@
+"""Синхронный клиент брокера для многопоточного кода.
+
+SyncMessageClient запускает AsyncMessageClient в отдельном потоке с
+собственным циклом событий. Методы клиента можно вызывать из любых потоков:
+они блокируются до ответа брокера, как put и get у queue.Queue в
+tasks/task_2_3.py.
+
+Публикации всех потоков копятся в общем списке, и цикл событий забирает их
+пачкой за одно пробуждение: публикации в один топик уходят одним
+publish_batch (не больше batch_size сообщений), а каждая публикация
+получает свою копию ответа на пакет. Сообщение, которое не сериализуется в
+JSON, отправляется отдельно, и ошибку получает только его поток. Поэтому
+32 потока, каждый из которых публикует по сообщению и ждет подтверждения,
+нагружают брокер как один асинхронный издатель пакетами.
+
+Рассылки подписок складываются во входящую очередь. Ее разбирает либо поток
+обработчиков add_handler, либо сам код через messages() и receive():
+
+    with SyncMessageClient(port=8888) as client:
+        client.subscribe('orders')
+        threads = [threading.Thread(target=client.publish, args=('orders', {'n': i}))
+                   for i in range(32)]
+        ...
+        for message in client.messages(timeout=1.0):
+            print(message['data'])
+"""
+import asyncio
+import concurrent.futures
+import queue
+import threading
+from collections import defaultdict
+from typing import Callable, Iterator, Optional, Union
+
+from async_message_client import AsyncMessageClient
+
+
+class SyncMessageClient:
+    Handler = Callable[[dict], None]
+
+    # Конец входящей очереди: клиент отключен.
+    _CLOSED = object()
+
+    def __init__(self, host: str = 'localhost', port: int = 8888, batch_size: int = 500,
+                 max_pending: int = 10000, **client_options):
+        self.batch_size = batch_size
+        self.client = AsyncMessageClient(host, port, **client_options)
+        self.client.add_handler(self._receive)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name='mq-client-loop',
+                                        daemon=True)
+        # Публикации, еще не забранные циклом: (топик и параметры, сообщение, future).
+        self._outgoing: list[tuple] = []
+        self._outgoing_lock = threading.Lock()
+        self._flush_scheduled = False
+        self._closing = False
+        # Отправленные пакеты, которые ждут подтверждения (живут в потоке цикла).
+        self._batches: set[asyncio.Task] = set()
+        # Неподтвержденных публикаций не больше max_pending: дальше
+        # publish_async ждет, пока брокер не подтвердит предыдущие.
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._inbox: queue.Queue = queue.Queue()
+        self._handlers: list[SyncMessageClient.Handler] = []
+        self._dispatcher: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disconnect()
+
+    def connect(self, timeout: Optional[float] = None):
+        self._thread.start()
+        self._call(self.client.connect(), timeout)
+
+    def disconnect(self, timeout: Optional[float] = None):
+        """Дожидается подтверждения отправленных публикаций и останавливает поток цикла."""
+        if not self._thread.is_alive():
+            return
+        with self._outgoing_lock:
+            self._closing = True
+        try:
+            self._call(self._close(), timeout)
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._inbox.put(self._CLOSED)
+            if self._dispatcher is not None and self._dispatcher is not threading.current_thread():
+                self._dispatcher.join()
+
+    def add_handler(self, handler: Handler) -> None:
+        """Добавляет обработчик рассылок; обработчики вызываются в отдельном потоке по порядку."""
+        self._handlers.append(handler)
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch, name='mq-client-dispatch',
+                                                daemon=True)
+            self._dispatcher.start()
+
+    def messages(self, timeout: Optional[float] = None) -> Iterator[dict]:
+        """Рассылки по мере поступления; заканчивается после disconnect или паузы в timeout."""
+        while True:
+            message = self.receive(timeout)
+            if message is None:
+                return
+            yield message
+
+    def receive(self, timeout: Optional[float] = None) -> Optional[dict]:
+        """Следующая рассылка или None, если за timeout ничего не пришло или клиент отключен."""
+        try:
+            message = self._inbox.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if message is self._CLOSED:
+            # Сигнал остается в очереди для других читающих потоков.
+            self._inbox.put(message)
+            return None
+        return message
+
+    def publish(self, topic: str, message, timeout: Optional[float] = None,
+                delay: Optional[float] = None, ttl: Optional[float] = None,
+                priority: Optional[int] = None, trace: bool = False) -> dict:
+        """Публикует сообщение и ждет подтверждения пакета, в который оно попало."""
+        return self.publish_async(topic, message, delay, ttl, priority, trace).result(timeout)
+
+    def publish_async(self, topic: str, message, delay: Optional[float] = None,
+                      ttl: Optional[float] = None, priority: Optional[int] = None,
+                      trace: bool = False) -> concurrent.futures.Future:
+        """Ставит публикацию в пакет и сразу возвращает future ответа брокера.
+
+        Публикации одного потока в один топик уходят в порядке вызова.
+        Отмененная до отправки публикация не отправляется.
+        """
+        self._pending.acquire()
+        future = concurrent.futures.Future()
+        future.add_done_callback(lambda _: self._pending.release())
+        with self._outgoing_lock:
+            if self._closing:
+                future.cancel()
+                raise ConnectionError('Client is disconnected')
+            self._outgoing.append(((topic, delay, ttl, priority, trace), message, future))
+            if self._flush_scheduled:
+                return future
+            self._flush_scheduled = True
+        self._loop.call_soon_threadsafe(self._flush_publishes)
+        return future
+
+    def subscribe(self, topic: str, offset: Union[int, str] = 'earliest',
+                  timeout: Optional[float] = None, credit: Optional[int] = None,
+                  credit_bytes: Optional[int] = None, filter: Optional[dict] = None) -> dict:
+        return self._call(self.client.subscribe(topic, offset, timeout, credit, credit_bytes,
+                                                filter))
+
+    def unsubscribe(self, topic: str, timeout: Optional[float] = None) -> dict:
+        return self._call(self.client.unsubscribe(topic, timeout))
+
+    def credit(self, topic: str, messages: int, max_bytes: Optional[int] = None,
+               timeout: Optional[float] = None) -> dict:
+        return self._call(self.client.credit(topic, messages, max_bytes, timeout))
+
+    def get(self, topic: str, offset: Optional[int] = None,
+            timeout: Optional[float] = None) -> dict:
+        return self._call(self.client.get(topic, offset, timeout))
+
+    def get_batch(self, topic: str, max_messages: int = 100, max_bytes: Optional[int] = None,
+                  offset: Optional[int] = None, timeout: Optional[float] = None) -> dict:
+        return self._call(self.client.get_batch(topic, max_messages, max_bytes, offset, timeout))
+
+    def join(self, topic: str, group: str, visibility_timeout: Optional[float] = None,
+             max_in_flight: Optional[int] = None, offset: Union[int, str] = 'earliest',
+             timeout: Optional[float] = None) -> dict:
+        return self._call(self.client.join(topic, group, visibility_timeout, max_in_flight,
+                                           offset, timeout))
+
+    def leave(self, topic: str, timeout: Optional[float] = None) -> dict:
+        return self._call(self.client.leave(topic, timeout))
+
+    def ack(self, topic: str, offsets: Union[int, list[int]],
+            timeout: Optional[float] = None) -> dict:
+        return self._call(self.client.ack(topic, offsets, timeout))
+
+    def nack(self, topic: str, offsets: Union[int, list[int]],
+             timeout: Optional[float] = None) -> dict:
+        return self._call(self.client.nack(topic, offsets, timeout))
+
+    def stats(self, timeout: Optional[float] = None) -> dict:
+        return self._call(self.client.stats(timeout))
+
+    def trace(self, topic: str, offset: int, timeout: Optional[float] = None) -> dict:
+        return self._call(self.client.trace(topic, offset, timeout))
+
+    def profile(self, seconds: float, interval: Optional[float] = None,
+                timeout: Optional[float] = None) -> dict:
+        return self._call(self.client.profile(seconds, interval, timeout))
+
+    def _call(self, coroutine, timeout: Optional[float] = None):
+        """Выполняет корутину в потоке цикла и ждет результат в вызывающем потоке.
+
+        Вызывать из потока цикла нельзя - он ждал бы сам себя; обработчики
+        рассылок работают в своем потоке, поэтому им это можно.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def _receive(self, message: dict):
+        self._inbox.put(message)
+
+    def _dispatch(self):
+        while True:
+            message = self._inbox.get()
+            if message is self._CLOSED:
+                return
+            for handler in self._handlers:
+                try:
+                    handler(message)
+                except Exception as exc:
+                    print(f"Ошибка обработчика сообщения: {exc!r}")
+
+    def _flush_publishes(self):
+        """Забирает накопленные публикации и отправляет их пакетами по топикам."""
+        with self._outgoing_lock:
+            outgoing, self._outgoing = self._outgoing, []
+            self._flush_scheduled = False
+
+        batches = defaultdict(list)
+        for key, message, future in outgoing:
+            if future.set_running_or_notify_cancel():
+                batches[key].append((message, future))
+        for key, items in batches.items():
+            for start in range(0, len(items), self.batch_size):
+                # Задачи начинают отправку в порядке создания, поэтому пакеты
+                # одного топика уходят в порядке публикаций.
+                task = self._loop.create_task(
+                    self._send_batch(key, items[start:start + self.batch_size]))
+                self._batches.add(task)
+                task.add_done_callback(self._batches.discard)
+
+    async def _send_batch(self, key: tuple, items: list[tuple]):
+        """Отправляет пакет и отдает каждой публикации ее собственный ответ.
+
+        Если пакет не удалось закодировать (сообщение не сериализуется в
+        JSON), публикации отправляются по одной, и ошибку получает только
+        виноватая.
+        """
+        topic, delay, ttl, priority, trace = key
+        options = {'delay': delay, 'ttl': ttl, 'priority': priority, 'trace': trace}
+        try:
+            if len(items) == 1:
+                response = await self.client.publish(topic, items[0][0], **options)
+            else:
+                response = await self.client.publish_batch(
+                    topic, [message for message, _ in items], **options)
+        except (TypeError, ValueError) as exc:
+            if len(items) == 1:
+                items[0][1].set_exception(exc)
+                return
+            await asyncio.gather(*(self._send_batch(key, [item]) for item in items))
+            return
+        except Exception as exc:
+            # Обрыв или таймаут: неизвестно, записан ли пакет, - ошибка у всех.
+            for _, future in items:
+                future.set_exception(exc)
+            return
+        for index, (_, future) in enumerate(items):
+            future.set_result(self._item_reply(response, index))
+
+    @staticmethod
+    def _item_reply(response: dict, index: int) -> dict:
+        """Ответ index-й публикации пакета: без полей, которые описывают весь пакет.
+
+        Из трасс пакета (traces) публикация получает только свою - trace, как
+        в ответе на одиночную публикацию.
+        """
+        reply = dict(response)
+        reply.pop('count', None)
+        reply.pop('id', None)
+        traces = reply.pop('traces', None)
+        if traces is not None and index < len(traces):
+            reply['trace'] = traces[index]
+        return reply
+
+    async def _close(self):
+        self._flush_publishes()
+        if self._batches:
+            await asyncio.wait(list(self._batches))
+        await self.client.disconnect()
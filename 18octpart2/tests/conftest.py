@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# Модули брокера лежат в родительском каталоге и импортируются по имени.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transport import PROTOCOL, STREAMS  # noqa: E402
+
+
+@pytest.fixture(params=[STREAMS, PROTOCOL])
+def transport(request):
+    """Сетевой слой брокера и клиентов: потоки asyncio или asyncio.Protocol."""
+    return request.param
@@ -0,0 +1,85 @@
+"""Брокер на свободном порту loopback, подключенные к нему клиенты и сырые соединения.
+
+Тесты синхронные и запускают сценарий через asyncio.run, поэтому плагины
+pytest для asyncio не нужны.
+"""
+import asyncio
+import contextlib
+import json
+
+import framing
+from async_broker_server import AsyncMessageBroker
+from async_message_client import AsyncMessageClient
+from transport import STREAMS, start_server
+
+HOST = '127.0.0.1'
+
+
+class Loopback:
+    """Запущенный брокер и его адрес; клиенты отключаются при остановке."""
+
+    def __init__(self, broker: AsyncMessageBroker, server):
+        self.broker = broker
+        self.server = server
+        self.port = server.sockets[0].getsockname()[1]
+        self.clients: list[AsyncMessageClient] = []
+        self.sockets: list[asyncio.StreamWriter] = []
+
+    async def client(self, **options) -> AsyncMessageClient:
+        options.setdefault('request_timeout', 5.0)
+        client = AsyncMessageClient(HOST, self.port, **options)
+        await client.connect()
+        self.clients.append(client)
+        return client
+
+    async def raw(self, binary: bool = False):
+        """Соединение без клиента: для запросов, которые клиент не отправит."""
+        reader, writer = await asyncio.open_connection(HOST, self.port)
+        self.sockets.append(writer)
+        if binary:
+            writer.write(framing.PREFACE)
+            assert await reader.readexactly(len(framing.PREFACE)) == framing.PREFACE
+        return reader, writer
+
+    async def close(self):
+        for client in self.clients:
+            await client.disconnect()
+        for writer in self.sockets:
+            writer.close()
+        self.server.close()
+        await self.broker.stop()
+
+
+@contextlib.asynccontextmanager
+async def running_broker(transport: str = STREAMS, **options):
+    broker = AsyncMessageBroker(**options)
+    await broker.start()
+    loopback = Loopback(broker, await start_server(broker, HOST, 0, transport))
+    try:
+        yield loopback
+    finally:
+        await loopback.close()
+
+
+async def request(reader, writer, message: dict) -> dict:
+    """Запрос JSON по сырому соединению и ответ на него."""
+    writer.write(json.dumps(message).encode() + b'\n')
+    return json.loads(await asyncio.wait_for(reader.readline(), 5))
+
+
+async def frame_request(reader, writer, action: int, topic_id: int, payload: bytes,
+                        request_id: int = 1) -> dict:
+    """Бинарный запрос по сырому соединению и ответ REPLY на него."""
+    writer.write(framing.encode_frame(action, topic_id, payload, request_id))
+    reply_action, _, reply_id, body = await asyncio.wait_for(framing.read_frame(reader), 5)
+    assert (reply_action, reply_id) == (framing.REPLY, request_id)
+    return json.loads(body)
+
+
+async def wait_for(predicate, timeout: float = 5.0):
+    """Ждет, пока predicate() не станет истинным."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        assert loop.time() < deadline, 'condition not met in time'
+        await asyncio.sleep(0.01)
@@ -0,0 +1,121 @@
+import asyncio
+import contextlib
+
+import pytest
+
+from async_message_client import AsyncMessageClient
+from loopback import HOST, Loopback, running_broker
+from sharded_broker import ShardedBroker, shard_for, socket_path
+from transport import STREAMS, start_server
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_connection_limit(transport, binary):
+    async def scenario():
+        async with running_broker(transport, max_connections=1) as loopback:
+            await loopback.client(binary=binary, transport=transport)
+            extra = AsyncMessageClient(HOST, loopback.port, binary=binary, transport=transport,
+                                       request_timeout=5)
+            if binary:
+                # Бинарный клиент получает отказ вместо PREFACE.
+                with pytest.raises(ConnectionError, match='Too many connections'):
+                    await extra.connect()
+            else:
+                await extra.connect()
+                reply = await extra.stats()
+                assert reply['message'] == 'Too many connections'
+                await extra.disconnect()
+
+            # Освободившееся место снова доступно.
+            await loopback.clients.pop().disconnect()
+            await asyncio.sleep(0.05)
+            client = await loopback.client(binary=binary, transport=transport)
+            assert (await client.stats())['admission']['max_connections'] == 1
+
+    asyncio.run(scenario())
+
+
+def test_publish_rate_limit():
+    async def scenario():
+        async with running_broker(publish_rate=50, publish_burst=5) as loopback:
+            client = await loopback.client()
+            replies = [await client.publish('t', index) for index in range(8)]
+            assert [reply['status'] for reply in replies[:5]] == ['published'] * 5
+            refused = replies[5]
+            assert refused['message'] == 'Publish rate limit exceeded'
+            assert 0 < refused['retry_after'] <= 0.02
+
+            await asyncio.sleep(refused['retry_after'] + 0.01)
+            assert (await client.publish('t', 'again'))['status'] == 'published'
+            stats = await client.stats()
+            assert stats['admission']['throttled_messages'] >= 3
+
+    asyncio.run(scenario())
+
+
+def test_publish_bytes_limit():
+    async def scenario():
+        async with running_broker(publish_bytes_rate=1000, publish_bytes_burst=1000) as loopback:
+            client = await loopback.client(binary=True)
+            assert (await client.publish_batch('t', ['x' * 400] * 2))['status'] == 'published'
+            reply = await client.publish('t', 'x' * 400)
+            assert reply['message'] == 'Publish byte rate limit exceeded'
+
+    asyncio.run(scenario())
+
+
+def test_requests_in_flight_limit(transport):
+    async def scenario():
+        async with running_broker(transport, max_client_in_flight=10) as loopback:
+            client = await loopback.client(transport=transport)
+            replies = await asyncio.gather(*(client.get('empty') for _ in range(200)))
+            refused = [reply for reply in replies
+                       if reply.get('message') == 'Too many requests in flight']
+            assert refused and all(reply['limit'] == 10 for reply in refused)
+            assert len(refused) < len(replies)
+            # Каждый запрос получил ответ, и соединение продолжает работать.
+            assert (await client.stats())['status'] == 'ok'
+
+    asyncio.run(scenario())
+
+
+@contextlib.asynccontextmanager
+async def running_shards(ipc_dir: str, shards: int = 2, **options):
+    """Шарды в одном процессе: соединения между ними идут через unix-сокеты, как у воркеров."""
+    loopbacks, peer_servers = [], []
+    for index in range(shards):
+        broker = ShardedBroker(index, shards, ipc_dir, **options)
+        await broker.start()
+        peer_servers.append(await asyncio.start_unix_server(broker.handle_peer,
+                                                            socket_path(ipc_dir, index)))
+        loopbacks.append(Loopback(broker, await start_server(broker, HOST, 0, STREAMS)))
+    try:
+        yield loopbacks
+    finally:
+        for loopback in loopbacks:
+            await loopback.close()
+        for server in peer_servers:
+            server.close()
+
+
+def test_shard_links_are_exempt_from_admission(tmp_path):
+    async def scenario():
+        async with running_shards(str(tmp_path), max_connections=2, max_client_in_flight=10,
+                                  publish_rate=50, publish_burst=5) as (first, second):
+            remote = next(f't{n}' for n in range(100) if shard_for(f't{n}', 2) == 1)
+            reader = await second.client()
+            await second.client()
+            # Публикации в топик второго шарда идут по ссылкам первого шарда на
+            # него: ссылки не занимают места клиентов и не делят их лимиты.
+            publishers = [await first.client() for _ in range(2)]
+            for publisher in publishers:
+                replies = [await publisher.publish(remote, index) for index in range(6)]
+                assert [reply['status'] for reply in replies[:5]] == ['published'] * 5
+                # Лимит скорости клиента проверил шард, к которому он подключен.
+                assert replies[5]['message'] == 'Publish rate limit exceeded'
+
+            assert len((await reader.get_batch(remote, 20, offset=0))['data']) == 10
+            assert first.broker.metrics.throttled_messages == 2
+            assert not second.broker.metrics.throttled
+
+    asyncio.run(scenario())
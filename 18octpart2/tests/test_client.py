@@ -0,0 +1,53 @@
+import asyncio
+import json
+
+import pytest
+
+from async_message_client import AsyncMessageClient
+from loopback import HOST, request, running_broker
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_pipelined_replies_match_requests(binary):
+    async def scenario():
+        async with running_broker() as loopback:
+            client = await loopback.client(binary=binary)
+            await asyncio.gather(*(client.publish('t', index) for index in range(50)))
+            replies = await asyncio.gather(*(client.get('t') for _ in range(50)))
+            assert sorted(reply['data'] for reply in replies) == list(range(50))
+            assert not client._pending
+
+    asyncio.run(scenario())
+
+
+def test_malformed_json_request_keeps_connection():
+    async def scenario():
+        async with running_broker() as loopback:
+            reader, writer = await loopback.raw()
+            writer.write(b'not json\n')
+            assert json.loads(await reader.readline())['status'] == 'error'
+            reply = await request(reader, writer, {'action': 'publish', 'topic': 't',
+                                                   'message': 1, 'id': 7})
+            assert reply == {'status': 'published', 'topic': 't', 'id': 7}
+
+    asyncio.run(scenario())
+
+
+def test_corrupt_reply_stream_fails_pending_requests(transport):
+    async def answer_garbage(reader, writer):
+        await reader.readline()
+        writer.write(b'not json\n')
+
+    async def scenario():
+        server = await asyncio.start_server(answer_garbage, HOST, 0)
+        port = server.sockets[0].getsockname()[1]
+        client = AsyncMessageClient(HOST, port, transport=transport, request_timeout=5)
+        await client.connect()
+        with pytest.raises(ValueError):
+            await client.publish('t', 1)
+        # После ошибки разбора соединение закрыто, новые запросы не ждут ответа.
+        assert await client.publish('t', 2) == AsyncMessageClient.DISCONNECTED
+        await client.disconnect()
+        server.close()
+
+    asyncio.run(scenario())
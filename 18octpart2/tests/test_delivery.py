@@ -0,0 +1,263 @@
+import asyncio
+import json
+
+import pytest
+
+import framing
+from async_broker_server import OVERFLOW_DISCONNECT, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST
+from loopback import frame_request, request, running_broker, wait_for
+
+# Рассылки такого размера быстро заполняют буферы сокета медленного подписчика.
+PADDING = 'x' * 16000
+MESSAGES = 1000
+
+
+def test_offsets_and_cursors(transport):
+    async def scenario():
+        async with running_broker(transport) as loopback:
+            client = await loopback.client(binary=True, transport=transport)
+            await client.publish_batch('log', list(range(5)))
+
+            # Чтение по смещению не удаляет сообщения.
+            assert (await client.get('log', offset=3))['data'] == 3
+            assert (await client.get_batch('log', 2, offset=1))['data'] == [1, 2]
+            assert (await client.get('log'))['data'] == 0
+            # Забранное сообщение пропускается: отдается следующее за ним.
+            assert (await client.get('log', offset=0))['offset'] == 1
+
+            pushed = []
+            subscriber = await loopback.client(transport=transport)
+            subscriber.add_handler(pushed.append)
+            await subscriber.subscribe('log', offset=2)
+            await wait_for(lambda: len(pushed) == 3)
+            assert [message['offset'] for message in pushed] == [2, 3, 4]
+            assert subscriber.positions['log'] == 5
+
+            # После переподключения подписка продолжается с сохраненной позиции.
+            await subscriber.disconnect()
+            await client.publish('log', 5)
+            await subscriber.connect()
+            await subscriber.subscribe('log', offset=subscriber.positions['log'])
+            await wait_for(lambda: len(pushed) == 4)
+            assert pushed[-1]['data'] == 5
+
+            latest = []
+            tail = await loopback.client(transport=transport)
+            tail.add_handler(latest.append)
+            await tail.subscribe('log', offset='latest')
+            await client.publish('log', 6)
+            await wait_for(lambda: latest)
+            assert [message['offset'] for message in latest] == [6]
+
+    asyncio.run(scenario())
+
+
+def test_replay_shares_one_budget_per_connection():
+    async def scenario():
+        async with running_broker(outbox_size=10, replay_chunk=8) as loopback:
+            publisher = await loopback.client(binary=True)
+            topics = [f't{index}' for index in range(5)]
+            for topic in topics:
+                await publisher.publish_batch(topic, list(range(20)))
+
+            pushed = []
+            subscriber = await loopback.client()
+            subscriber.add_handler(pushed.append)
+            for topic in topics:
+                await subscriber.subscribe(topic)
+            # Пять отстающих топиков не переполняют очередь из десяти кадров.
+            await wait_for(lambda: len(pushed) == 100)
+            assert next(iter(loopback.broker.outboxes.values())).dropped == 0
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize('message', [
+    {'action': 'get', 'topic': 't', 'offset': 'abc'},
+    {'action': 'get', 'topic': 't', 'offset': -1},
+    {'action': 'get', 'topic': 't', 'offset': True},
+    {'action': 'get_batch', 'topic': 't', 'offset': 1.5},
+    {'action': 'subscribe', 'topic': 't', 'offset': [1]},
+    {'action': 'join', 'topic': 't', 'group': 'g', 'offset': 'first'},
+])
+def test_malformed_offset_gets_error_reply(message):
+    async def scenario():
+        async with running_broker() as loopback:
+            reader, writer = await loopback.raw()
+            reply = await request(reader, writer, {**message, 'id': 1})
+            assert reply['status'] == 'error'
+            assert reply['id'] == 1
+            reply = await request(reader, writer, {'action': 'stats', 'id': 2})
+            assert reply['status'] == 'ok'
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize('action, payload', [
+    (framing.GET, b'\x00\x01'),
+    (framing.GET_BATCH, b'\x00'),
+    (framing.SUBSCRIBE, b'\x00' * 3),
+    (framing.PUBLISH_BATCH, framing.ITEM_LENGTH.pack(10) + b'1'),
+    (framing.BIND, b'\xff\xfe'),
+])
+def test_malformed_frame_payload_gets_error_reply(action, payload):
+    async def scenario():
+        async with running_broker() as loopback:
+            reader, writer = await loopback.raw(binary=True)
+            topic_id = (await frame_request(reader, writer, framing.BIND, 0, b't'))['topic_id']
+            reply = await frame_request(reader, writer, action, topic_id, payload, 2)
+            assert reply['message'].startswith('Malformed frame payload')
+            reply = await frame_request(reader, writer, framing.STATS, 0, b'', 3)
+            assert reply['status'] == 'ok'
+
+    asyncio.run(scenario())
+
+
+async def overflow_scenario(overflow: str) -> tuple[list[int], int, bool]:
+    """Рассылки подписчику, который не читает, пока издатель не закончит.
+
+    Возвращает номера дошедших сообщений, число отброшенных и был ли
+    подписчик отключен.
+    """
+    async with running_broker(outbox_size=5, overflow=overflow) as loopback:
+        reader, writer = await loopback.raw()
+        await request(reader, writer, {'action': 'subscribe', 'topic': 't'})
+        outbox = next(outbox for outbox in loopback.broker.outboxes.values())
+        publisher = await loopback.raw()
+        for index in range(MESSAGES):
+            await request(*publisher, {'action': 'publish', 'topic': 't',
+                                       'message': {'i': index, 'pad': PADDING}})
+        dropped = outbox.dropped
+
+        received = []
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 1)
+                if not line.endswith(b'\n'):
+                    # Конец потока или строка, оборванная отключением.
+                    break
+                received.append(json.loads(line)['data']['i'])
+                if received[-1] == MESSAGES - 1:
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        return received, dropped, writer not in loopback.broker.outboxes and outbox._closed
+
+
+def test_overflow_drop_oldest_keeps_newest():
+    received, dropped, disconnected = asyncio.run(overflow_scenario(OVERFLOW_DROP_OLDEST))
+    assert dropped > 0 and not disconnected
+    assert received == sorted(received)
+    assert received[-1] == MESSAGES - 1
+    assert len(received) + dropped == MESSAGES
+
+
+def test_overflow_drop_newest_keeps_oldest():
+    received, dropped, disconnected = asyncio.run(overflow_scenario(OVERFLOW_DROP_NEWEST))
+    assert dropped > 0 and not disconnected
+    assert received[0] == 0
+    assert received == list(range(len(received)))
+    assert len(received) + dropped == MESSAGES
+
+
+def test_overflow_disconnect_closes_slow_subscriber():
+    received, dropped, disconnected = asyncio.run(overflow_scenario(OVERFLOW_DISCONNECT))
+    assert dropped == 1
+    assert disconnected
+    assert len(received) < MESSAGES
+
+
+def test_credit_limits_pushes(transport):
+    async def scenario():
+        async with running_broker(transport) as loopback:
+            publisher = await loopback.client(transport=transport)
+            await publisher.publish_batch('jobs', list(range(10)))
+
+            pushed = []
+            subscriber = await loopback.client(binary=True, transport=transport)
+            subscriber.add_handler(pushed.append)
+            assert (await subscriber.subscribe('jobs', credit=3))['status'] == 'subscribed'
+            await wait_for(lambda: len(pushed) == 3)
+            await asyncio.sleep(0.05)
+            assert len(pushed) == 3
+
+            await subscriber.credit('jobs', 4)
+            await wait_for(lambda: len(pushed) == 7)
+            await publisher.publish('jobs', 10)
+            await subscriber.credit('jobs', 100)
+            await wait_for(lambda: len(pushed) == 11)
+            assert [message['data'] for message in pushed] == list(range(11))
+
+            reply = await publisher.credit('jobs', -1)
+            assert reply['message'] == 'Credit must be a non-negative number of messages and bytes'
+
+    asyncio.run(scenario())
+
+
+def test_delay_and_ttl():
+    async def scenario():
+        async with running_broker() as loopback:
+            client = await loopback.client()
+            assert (await client.publish('t', 'later', delay=0.2))['status'] == 'scheduled'
+            await client.publish('t', 'short', ttl=0.1)
+            await client.publish('t', 'kept')
+            await asyncio.sleep(0.15)
+
+            # Истекшее сообщение не выдается, отложенное еще не в топике.
+            assert (await client.get('t', offset=0))['data'] == 'kept'
+            assert (await client.get('t'))['data'] == 'kept'
+            assert (await client.get('t'))['data'] is None
+            await asyncio.sleep(0.15)
+            reply = await client.get('t')
+            assert (reply['data'], reply['offset']) == ('later', 2)
+
+    asyncio.run(scenario())
+
+
+def test_priority_topic_order():
+    async def scenario():
+        async with running_broker(priority_topics=['jobs'], priority_step=60) as loopback:
+            client = await loopback.client(binary=True)
+            for priority in (5, 0, 3, 0):
+                await client.publish('jobs', priority, priority=priority)
+            await client.publish_batch('jobs', ['batch', 'batch'], priority=1)
+            taken = [(await client.get('jobs'))['data'] for _ in range(6)]
+            assert taken == [0, 0, 'batch', 'batch', 3, 5]
+
+            # Приоритет принимают только приоритетные топики.
+            assert (await client.publish('plain', 1, priority=1))['status'] == 'error'
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_filtered_subscription(binary):
+    async def scenario():
+        async with running_broker() as loopback:
+            publisher = await loopback.client()
+            await publisher.publish_batch('shop', [
+                {'category': 'clothing', 'price': 5},
+                {'category': 'clothing', 'item': {'price': 50}},
+                {'category': 'food', 'item': {'price': 50}},
+                'not an object'])
+
+            received = []
+            subscriber = await loopback.client(binary=binary)
+            subscriber.add_handler(received.append)
+            reply = await subscriber.subscribe('shop', filter={
+                'category': {'in': ['clothing', 'shoes']}, 'item.price': {'gte': 10, 'lt': 100}})
+            assert reply['status'] == 'subscribed'
+            # Бэклог досылается уже отфильтрованным.
+            await wait_for(lambda: len(received) == 1)
+            assert received[0]['offset'] == 1
+
+            await publisher.publish_batch('shop', [{'category': 'shoes', 'item': {'price': 100}},
+                                                   {'category': 'shoes', 'item': {'price': 99}}])
+            await wait_for(lambda: len(received) == 2)
+            await asyncio.sleep(0.05)
+            assert [message['offset'] for message in received] == [1, 5]
+
+            reply = await subscriber.subscribe('other', filter={'price': {'near': 1}})
+            assert reply['message'].startswith('Invalid filter')
+
+    asyncio.run(scenario())
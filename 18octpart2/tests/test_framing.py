@@ -0,0 +1,112 @@
+import asyncio
+import zlib
+
+import framing
+from loopback import frame_request, running_broker, wait_for
+
+
+def compressed(data: bytes) -> bytes:
+    return framing.COMPRESSED_MARK + framing.RAW_LENGTH.pack(len(data)) + zlib.compress(data)
+
+
+def test_binary_and_json_clients_share_topics(transport):
+    async def scenario():
+        async with running_broker(transport) as loopback:
+            binary = await loopback.client(binary=True, transport=transport)
+            plain = await loopback.client(transport=transport)
+            pushed = []
+            plain.add_handler(pushed.append)
+            assert (await plain.subscribe('orders'))['status'] == 'subscribed'
+
+            assert (await binary.publish('orders', {'id': 1}))['status'] == 'published'
+            assert (await plain.publish('orders', 'two'))['status'] == 'published'
+            await wait_for(lambda: len(pushed) == 2)
+            assert [message['data'] for message in pushed] == [{'id': 1}, 'two']
+
+            reply = await binary.publish_batch('orders', [{'id': 3}, 'four', [5]])
+            assert reply['count'] == 3
+            await wait_for(lambda: len(pushed) == 5)
+            assert [message['data'] for message in pushed[2:]] == [{'id': 3}, 'four', [5]]
+
+            assert (await plain.get('orders'))['data'] == {'id': 1}
+            assert (await binary.get('orders'))['data'] == 'two'
+            batch = await binary.get_batch('orders', 10)
+            assert batch['data'] == [{'id': 3}, 'four', [5]]
+
+    asyncio.run(scenario())
+
+
+def test_binary_publish_must_be_json():
+    async def scenario():
+        async with running_broker() as loopback:
+            reader, writer = await loopback.raw(binary=True)
+            topic_id = (await frame_request(reader, writer, framing.BIND, 0, b't'))['topic_id']
+
+            for request_id, data in enumerate((b'hello', b'', b'  \n'), 2):
+                reply = await frame_request(reader, writer, framing.PUBLISH, topic_id, data,
+                                            request_id)
+                assert reply['message'] == 'Message payload must be a JSON document'
+            reply = await frame_request(reader, writer, framing.PUBLISH_BATCH, topic_id,
+                                        framing.pack_items([b'1', b'oops']), 5)
+            assert reply['status'] == 'error'
+            # Перевод строки внутри документа не рвет строки рассылки JSON-подписчиков.
+            reply = await frame_request(reader, writer, framing.PUBLISH, topic_id, b'{"a":\n1}',
+                                        6)
+            assert reply['status'] == 'published'
+
+            client = await loopback.client()
+            assert (await client.get('t'))['data'] == {'a': 1}
+            assert (await client.get('t'))['data'] is None
+
+    asyncio.run(scenario())
+
+
+def test_compressed_messages_round_trip(transport):
+    async def scenario():
+        async with running_broker(transport, compress_min_size=64) as loopback:
+            publisher = await loopback.client(binary=True, compression=True, transport=transport)
+            reader = await loopback.client(transport=transport)
+            large = {'text': 'x' * 1000}
+            await publisher.publish('docs', large)
+            await publisher.publish_batch('docs', [large, 'small'])
+            assert loopback.broker.queues['docs'].read_from(0, 1)[0].size < 1000
+            batch = await reader.get_batch('docs', 10, offset=0)
+            assert batch['data'] == [large, large, 'small']
+            batch = await publisher.get_batch('docs', 10, offset=0)
+            assert batch['data'] == [large, large, 'small']
+
+    asyncio.run(scenario())
+
+
+def test_compressed_publish_is_stored_without_decompressing():
+    async def scenario():
+        async with running_broker(compress_min_size=64) as loopback:
+            reader, writer = await loopback.raw(binary=True)
+            topic_id = (await frame_request(reader, writer, framing.BIND, 0, b't'))['topic_id']
+
+            reply = await frame_request(reader, writer, framing.PUBLISH, topic_id,
+                                        compressed(b'[1]'), 2)
+            assert reply['message'] == 'Compressed data requires negotiated compression'
+
+            reply = await frame_request(reader, writer, framing.COMPRESS, 0,
+                                        framing.COMPRESSION_ZLIB.encode(), 3)
+            assert reply['status'] == 'ok'
+            # Проверяется только заголовок: обрезанный и с размером больше кадра.
+            for request_id, data in enumerate([b'\x00z', b'\x00zjunkjunk'], 4):
+                reply = await frame_request(reader, writer, framing.PUBLISH, topic_id, data,
+                                            request_id)
+                assert reply['message'].startswith('Invalid compressed data')
+
+            for request_id, data in enumerate([compressed(b'hello'), compressed(b'[1]')], 6):
+                reply = await frame_request(reader, writer, framing.PUBLISH, topic_id, data,
+                                            request_id)
+                assert reply['status'] == 'published'
+            stored = loopback.broker.queues['t'].read_from(0, 2)
+            assert [message.data for message in stored] == [compressed(b'hello'),
+                                                            compressed(b'[1]')]
+
+            # Клиент без сжатия получает распакованные данные, а нераспакуемые - null.
+            client = await loopback.client()
+            assert (await client.get_batch('t', 10, offset=0))['data'] == [None, [1]]
+
+    asyncio.run(scenario())
@@ -0,0 +1,62 @@
+import asyncio
+
+from loopback import running_broker, wait_for
+
+
+def test_group_leases_ack_and_redelivery(transport):
+    async def scenario():
+        async with running_broker(transport) as loopback:
+            publisher = await loopback.client(transport=transport)
+            await publisher.publish_batch('tasks', list(range(6)))
+
+            first, second = [], []
+            members = []
+            for received, binary in ((first, False), (second, True)):
+                member = await loopback.client(binary=binary, transport=transport)
+                member.add_handler(received.append)
+                reply = await member.join('tasks', 'workers', visibility_timeout=0.3,
+                                          max_in_flight=2)
+                assert reply['status'] == 'joined'
+                members.append(member)
+
+            # Каждому участнику выдается не больше max_in_flight сообщений.
+            await wait_for(lambda: len(first) + len(second) == 4)
+            await asyncio.sleep(0.05)
+            assert len(first) == len(second) == 2
+            assert {m['offset'] for m in first} | {m['offset'] for m in second} == {0, 1, 2, 3}
+
+            # Подтверждение освобождает место для следующего сообщения.
+            reply = await members[0].ack('tasks', [m['offset'] for m in first])
+            assert reply == {'status': 'acked', 'topic': 'tasks', 'group': 'workers',
+                             'count': 2, 'id': reply['id']}
+            await wait_for(lambda: len(first) == 4)
+
+            # Неподтвержденные вторым участником сообщения после срока аренды
+            # выдаются снова.
+            unacked = {m['offset'] for m in second}
+            await members[0].ack('tasks', [m['offset'] for m in first[2:]])
+            await wait_for(lambda: unacked <= {m['offset'] for m in first[4:] + second[2:]}, 3)
+
+    asyncio.run(scenario())
+
+
+def test_nack_returns_message_and_ack_errors():
+    async def scenario():
+        async with running_broker() as loopback:
+            publisher = await loopback.client()
+            await publisher.publish('tasks', 'only')
+
+            received = []
+            member = await loopback.client()
+            member.add_handler(received.append)
+            await member.join('tasks', 'workers', visibility_timeout=30)
+            await wait_for(lambda: len(received) == 1)
+            assert (await member.nack('tasks', 0))['status'] == 'nacked'
+            await wait_for(lambda: len(received) == 2)
+            assert received[1]['offset'] == 0
+
+            assert (await publisher.ack('tasks', 0))['status'] == 'error'
+            assert (await member.leave('tasks'))['status'] == 'left'
+            assert (await member.leave('tasks'))['status'] == 'error'
+
+    asyncio.run(scenario())
@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from loopback import HOST, running_broker, wait_for
+from pooled_client import PooledMessageClient
+
+
+async def drop_connections(loopback, pool: PooledMessageClient):
+    """Закрывает сервер и все соединения брокера: пул остается без связи."""
+    loopback.server.close()
+    for writer in list(loopback.broker.outboxes):
+        writer.close()
+    await wait_for(lambda: not any(member.ready.is_set() for member in pool.members))
+
+
+def test_buffered_publish_times_out_and_pool_recovers():
+    async def scenario():
+        async with running_broker() as loopback:
+            pool = PooledMessageClient(HOST, loopback.port, size=1, reconnect_delay=0.01,
+                                       max_reconnect_delay=0.05)
+            await pool.connect()
+            member = pool.members[0]
+            try:
+                assert (await pool.publish('t', 0))['status'] == 'published'
+                await drop_connections(loopback, pool)
+
+                with pytest.raises(asyncio.TimeoutError):
+                    await pool.publish('t', 'lost', timeout=0.1)
+                cancelled = asyncio.ensure_future(pool.publish('t', 'cancelled'))
+                kept = asyncio.ensure_future(pool.publish('t', 1))
+                await wait_for(lambda: len(member.buffered) == 2)
+                cancelled.cancel()
+                await asyncio.sleep(0)
+                # Прерванные публикации не занимают буфер.
+                assert len(member.buffered) == 1
+
+                loopback.server = await asyncio.start_server(
+                    loopback.broker.handle_client, HOST, loopback.port)
+                assert (await kept)['status'] == 'published'
+                assert member.resending == 0
+                assert (await pool.publish('t', 2))['status'] == 'published'
+                reply = await pool.get_batch('t', 10, offset=0)
+                assert reply['data'] == [0, 1, 2]
+            finally:
+                await pool.disconnect()
+
+    asyncio.run(scenario())
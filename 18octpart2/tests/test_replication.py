@@ -0,0 +1,61 @@
+import asyncio
+
+from loopback import HOST, running_broker, wait_for
+from replication import most_caught_up
+
+
+def test_admin_actions_disabled_by_default():
+    async def scenario():
+        async with running_broker() as loopback:
+            client = await loopback.client()
+            for reply in (await client.promote(), await client.follow(HOST, loopback.port)):
+                assert reply['message'] == 'Admin actions are disabled on this broker'
+            assert loopback.broker.role == 'leader'
+
+    asyncio.run(scenario())
+
+
+def test_replication_refused_from_unlisted_address():
+    async def scenario():
+        async with running_broker(replica_hosts=['192.0.2.1']) as leader:
+            async with running_broker(leader=(HOST, leader.port)) as follower:
+                publisher = await leader.client()
+                await publisher.publish('t', 1)
+                await asyncio.sleep(0.1)
+                assert not follower.broker.follower.connected
+                assert not leader.broker.replicas
+                assert 't' not in follower.broker.queues
+
+    asyncio.run(scenario())
+
+
+def test_follower_replicates_and_promotes():
+    async def scenario():
+        async with running_broker(min_replicas=1, replica_hosts=[HOST]) as leader:
+            async with running_broker(leader=(HOST, leader.port), allow_admin=True) as follower:
+                publisher = await leader.client(binary=True)
+                assert (await publisher.publish('t', 1))['status'] == 'published'
+                await publisher.publish_batch('t', [2, 3])
+
+                # Забор сообщения ведомым не передается, поэтому лидер его отклоняет.
+                reply = await publisher.get('t')
+                assert reply['message'].startswith('Destructive get is not replicated')
+                assert (await publisher.get_batch('t', 10, offset=0))['data'] == [1, 2, 3]
+
+                reader = await follower.client()
+                await wait_for(lambda: follower.broker.queues['t'].next_offset == 3)
+                assert (await reader.get_batch('t', 10, offset=0))['data'] == [1, 2, 3]
+                assert (await reader.publish('t', 4))['status'] == 'error'
+
+                assert (await reader.promote())['status'] == 'promoted'
+                assert (await reader.publish('t', 4))['status'] == 'published'
+                assert (await reader.get('t'))['data'] == 1
+
+    asyncio.run(scenario())
+
+
+def test_failover_compares_each_topic():
+    # По сумме смещений победил бы b, хотя в топике y он отстал от a.
+    positions = {'a': {'x': 10, 'y': 5}, 'b': {'x': 100, 'y': 4}, 'c': {'x': 100, 'y': 5}}
+    assert most_caught_up(positions) == 'c'
+    assert most_caught_up({'a': {'x': 1}, 'b': {}}) == 'a'
@@ -0,0 +1,47 @@
+import asyncio
+
+from async_broker_server import broker_options, parse_args
+from loopback import running_broker
+from retention import RetentionPolicy
+
+
+def test_count_and_byte_limits_evict_oldest():
+    async def scenario():
+        options = {'retention': RetentionPolicy(max_messages=3),
+                   'topic_retention': {'big': RetentionPolicy(max_bytes=10)}}
+        async with running_broker(**options) as loopback:
+            client = await loopback.client()
+            for index in range(5):
+                await client.publish('t', index)
+                await client.publish('big', 'xxxx')
+
+            assert (await client.get_batch('t', 10))['data'] == [2, 3, 4]
+            stats = await client.stats()
+            assert stats['topics']['t']['evicted'] == 2
+            # Сообщение '"xxxx"' занимает 6 байт: в 10 байт помещается одно.
+            assert stats['topics']['big']['messages'] == 1
+            assert stats['topics']['big']['evicted'] == 4
+
+    asyncio.run(scenario())
+
+
+def test_age_limit_is_enforced_in_background():
+    async def scenario():
+        async with running_broker(retention=RetentionPolicy(max_age=0.05),
+                                  retention_interval=0.02) as loopback:
+            client = await loopback.client()
+            await client.publish('t', 'old')
+            await asyncio.sleep(0.2)
+            assert loopback.broker.topic_stats['t'].messages == 0
+            assert (await client.get('t'))['data'] is None
+
+    asyncio.run(scenario())
+
+
+def test_retention_limits_from_command_line():
+    options = broker_options(parse_args(['--retention-messages', '10', '--retention-age', '60',
+                                         '--retention-global-bytes', '4096']))
+    assert (options['retention'].max_messages, options['retention'].max_age) == (10, 60)
+    assert options['retention'].max_bytes is None
+    assert options['global_retention'].max_bytes == 4096
+    assert options['retention_interval'] == 1.0
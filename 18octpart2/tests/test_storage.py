@@ -0,0 +1,88 @@
+import asyncio
+import os
+
+import storage
+from loopback import running_broker
+from storage import INDEX_ENTRY, SegmentLog
+
+
+def test_broker_recovers_unconsumed_messages(tmp_path):
+    async def scenario():
+        async with running_broker(storage=SegmentLog(str(tmp_path))) as loopback:
+            client = await loopback.client()
+            for index in range(3):
+                await client.publish('a', index)
+                await client.publish('b/c', f'b{index}')
+            assert (await client.get('a'))['data'] == 0
+
+        async with running_broker(storage=SegmentLog(str(tmp_path))) as loopback:
+            client = await loopback.client()
+            reply = await client.get_batch('a', 10)
+            assert (reply['data'], reply['offset']) == ([1, 2], 1)
+            assert (await client.get_batch('b/c', 10))['data'] == ['b0', 'b1', 'b2']
+            # Нумерация продолжается после восстановленных сообщений.
+            await client.publish('a', 3)
+            assert (await client.get('a', offset=3))['data'] == 3
+
+    asyncio.run(scenario())
+
+
+def test_recovery_keeps_topic_order_when_clock_goes_back(tmp_path, monkeypatch):
+    clock = iter([100.0, 50.0, 10.0, 75.0])
+    monkeypatch.setattr(storage.time, 'time', lambda: next(clock))
+    log = SegmentLog(str(tmp_path))
+    for topic, data in (('a', b'1'), ('a', b'2'), ('a', b'3'), ('b', b'4')):
+        log.append(topic, data)
+    log.close()
+
+    recovered = SegmentLog(str(tmp_path)).recover()
+    by_topic = {}
+    for message in recovered:
+        by_topic.setdefault(message.topic, []).append(message.segment.read(message.position,
+                                                                           message.size))
+    assert by_topic == {'a': [b'1', b'2', b'3'], 'b': [b'4']}
+
+
+def test_truncated_tail_is_dropped(tmp_path):
+    log = SegmentLog(str(tmp_path))
+    for data in (b'"one"', b'"two"'):
+        log.append('t', data)
+    log.close()
+
+    segment = log.topics['t'].active
+    # Сбой посреди записи: заголовок и индекс третьей записи дошли до диска
+    # не полностью.
+    with open(segment.log_path, 'ab') as file:
+        file.write(b'\x00\x00\x00\x10partial')
+    with open(segment.idx_path, 'ab') as file:
+        file.write(INDEX_ENTRY.pack(segment.size, 16)[:5])
+
+    log = SegmentLog(str(tmp_path))
+    assert [message.size for message in log.recover()] == [5, 5]
+    assert os.path.getsize(segment.idx_path) == 2 * INDEX_ENTRY.size
+    log.append('t', b'"three"')
+    log.close()
+
+    recovered = SegmentLog(str(tmp_path)).recover()
+    assert [message.segment.read(message.position, message.size)
+            for message in recovered] == [b'"one"', b'"two"', b'"three"']
+
+
+def test_group_commit_survives_segment_rolls(tmp_path):
+    async def scenario():
+        log = SegmentLog(str(tmp_path), segment_bytes=64)
+        for index in range(20):
+            log.append('t', b'%d' % index)
+            if index % 3 == 0:
+                # fsync идет в пуле потоков, пока публикации закрывают сегменты.
+                commit = asyncio.create_task(log.commit())
+                await asyncio.sleep(0)
+                log.append('t', b'"roll"')
+                await commit
+        await log.commit()
+        assert not log._sealed
+        log.close()
+        return len(log.topics['t'].segments)
+
+    assert asyncio.run(scenario()) > 1
+    assert len(SegmentLog(str(tmp_path)).recover()) == 27
@@ -0,0 +1,28 @@
+import asyncio
+
+import pytest
+
+from loopback import HOST, running_broker
+from sync_client import SyncMessageClient
+
+
+def test_batched_publishes_get_their_own_replies():
+    def publish_from_threads(port):
+        with SyncMessageClient(HOST, port, request_timeout=5) as client:
+            futures = [client.publish_async('t', value) for value in (1, object(), 3)]
+            futures += [client.publish_async('t', 4, delay=0.01)]
+            assert futures[0].result(5) == {'status': 'published', 'topic': 't'}
+            # Несериализуемое сообщение не роняет публикации других потоков.
+            with pytest.raises(TypeError):
+                futures[1].result(5)
+            assert futures[2].result(5) == {'status': 'published', 'topic': 't'}
+            assert futures[3].result(5)['status'] == 'scheduled'
+            assert futures[0].result() is not futures[2].result()
+            return client.get_batch('t', 10, offset=0)['data']
+
+    async def scenario():
+        async with running_broker() as loopback:
+            data = await asyncio.to_thread(publish_from_threads, loopback.port)
+            assert data == [1, 3]
+
+    asyncio.run(scenario())
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from loopback import HOST, request, running_broker, wait_for
+from sync_client import SyncMessageClient
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_traced_publish_records_deliveries(binary):
+    async def scenario():
+        async with running_broker(max_traces=10) as loopback:
+            received = []
+            subscriber = await loopback.client()
+            subscriber.add_handler(received.append)
+            await subscriber.subscribe('t')
+            publisher = await loopback.client(binary=binary)
+
+            reply = await publisher.publish('t', 1, trace=True)
+            assert (reply['trace']['offset'], reply['trace']['deliveries']) == (0, [])
+            reply = await publisher.publish_batch('t', [2, 3], trace=True)
+            assert [trace['offset'] for trace in reply['traces']] == [1, 2]
+            await publisher.publish('t', 4)
+            await wait_for(lambda: len(received) == 4)
+
+            trace = (await publisher.trace('t', 0))['trace']
+            [delivery] = trace['deliveries']
+            assert 0 <= trace['enqueued'] <= delivery['queued']
+            assert (await publisher.trace('t', 3))['message'] == 'No trace for this message'
+
+    asyncio.run(scenario())
+
+
+def test_delayed_publish_keeps_trace_flag():
+    async def scenario():
+        async with running_broker(max_traces=10) as loopback:
+            client = await loopback.client()
+            reply = await client.publish('t', 'later', delay=0.1, trace=True)
+            assert reply['status'] == 'scheduled'
+            await wait_for(lambda: len(loopback.broker.queues['t']) == 1)
+            # Трасса отсчитывается от приема отложенной публикации.
+            assert (await client.trace('t', 0))['trace']['enqueued'] >= 0.1
+
+    asyncio.run(scenario())
+
+
+def test_trace_rejects_malformed_offsets():
+    async def scenario():
+        async with running_broker(max_traces=10) as loopback:
+            await (await loopback.client()).publish('t', 1, trace=True)
+            reader, writer = await loopback.raw()
+            for request_id, offset in enumerate([True, -1, '0', None], 1):
+                reply = await request(reader, writer, {'action': 'trace', 'topic': 't',
+                                                       'offset': offset, 'id': request_id})
+                assert reply['message'].startswith('Trace requires a topic')
+
+    asyncio.run(scenario())
+
+
+def test_batched_sync_publishes_get_their_own_traces():
+    def publish(port):
+        with SyncMessageClient(HOST, port, request_timeout=5) as client:
+            futures = [client.publish_async('t', value, trace=True) for value in range(3)]
+            return [future.result(5) for future in futures]
+
+    async def scenario():
+        async with running_broker(max_traces=10) as loopback:
+            replies = await asyncio.to_thread(publish, loopback.port)
+            assert [reply['trace']['offset'] for reply in replies] == [0, 1, 2]
+            assert not any('traces' in reply for reply in replies)
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_profile_requires_admin(binary):
+    async def scenario():
+        async with running_broker() as loopback:
+            client = await loopback.client(binary=binary)
+            reply = await client.profile(0.05)
+            assert reply['message'] == 'Admin actions are disabled on this broker'
+            assert loopback.broker.profiler is None
+
+        async with running_broker(allow_admin=True) as loopback:
+            client = await loopback.client(binary=binary)
+            reply = await client.profile(0.05, interval=0.001)
+            assert reply['status'] == 'ok' and reply['profile']['samples'] > 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,108 @@
+"""Иерархические топики и подписки по шаблонам.
+
+Топик состоит из слов через точку: orders.eu.created. В шаблоне подписки
+'*' заменяет ровно одно слово, '#' - любое число слов, в том числе ноль:
+orders.*.created, orders.#. Шаблоны хранятся в префиксном дереве по словам,
+поэтому поиск подписок нового топика стоит O(глубины топика), а не O(числа
+шаблонов).
+"""
+from typing import Hashable
+
+SEPARATOR = '.'
+ONE_WORD = '*'
+ANY_WORDS = '#'
+
+
+def is_pattern(topic: str) -> bool:
+    return any(word in (ONE_WORD, ANY_WORDS) for word in topic.split(SEPARATOR))
+
+
+def matches(pattern: str, topic: str) -> bool:
+    """Проверяет один топик по одному шаблону без построения дерева."""
+    return _matches(pattern.split(SEPARATOR), topic.split(SEPARATOR))
+
+
+def _matches(pattern: list[str], words: list[str]) -> bool:
+    if not pattern:
+        return not words
+    head, rest = pattern[0], pattern[1:]
+    if head == ANY_WORDS:
+        return any(_matches(rest, words[index:]) for index in range(len(words) + 1))
+    if not words:
+        return False
+    return (head == ONE_WORD or head == words[0]) and _matches(rest, words[1:])
+
+
+class _Node:
+    __slots__ = ('children', 'pattern', 'values')
+
+    def __init__(self):
+        self.children: dict[str, _Node] = {}
+        # Шаблон, который заканчивается в этом узле, и его подписчики.
+        self.pattern = None
+        self.values: set = set()
+
+
+class TopicTrie:
+    def __init__(self):
+        self._root = _Node()
+        self._patterns = 0
+
+    def __len__(self):
+        return self._patterns
+
+    def add(self, pattern: str, value: Hashable):
+        node = self._root
+        for word in pattern.split(SEPARATOR):
+            node = node.children.setdefault(word, _Node())
+        if not node.values:
+            self._patterns += 1
+        node.pattern = pattern
+        node.values.add(value)
+
+    def remove(self, pattern: str, value: Hashable):
+        path = [self._root]
+        words = pattern.split(SEPARATOR)
+        for word in words:
+            node = path[-1].children.get(word)
+            if node is None:
+                return
+            path.append(node)
+
+        node = path[-1]
+        if value not in node.values:
+            return
+        node.values.discard(value)
+        if node.values:
+            return
+
+        self._patterns -= 1
+        node.pattern = None
+        # Удаляем опустевшие узлы снизу вверх.
+        for word, parent, child in zip(reversed(words), reversed(path[:-1]), reversed(path)):
+            if child.values or child.children:
+                break
+            del parent.children[word]
+
+    def match(self, topic: str) -> set[tuple[str, Hashable]]:
+        """Все пары (шаблон, подписчик), шаблон которых подходит к топику."""
+        found = set()
+        self._match(self._root, topic.split(SEPARATOR), 0, found)
+        return found
+
+    def _match(self, node: _Node, words: list[str], index: int, found: set):
+        any_words = node.children.get(ANY_WORDS)
+        if any_words is not None:
+            for rest in range(index, len(words) + 1):
+                self._match(any_words, words, rest, found)
+
+        if index == len(words):
+            found.update((node.pattern, value) for value in node.values)
+            return
+
+        exact = node.children.get(words[index])
+        if exact is not None:
+            self._match(exact, words, index + 1, found)
+        one_word = node.children.get(ONE_WORD)
+        if one_word is not None:
+            self._match(one_word, words, index + 1, found)
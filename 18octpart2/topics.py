@@ -0,0 +1,312 @@
+"""Хранение сообщений топика: смещения, журнал в памяти и курсоры подписчиков."""
+import heapq
+import itertools
+import json
+import time
+from typing import Iterator, Optional
+
+import framing
+from message_filters import MessageFilter, message_fields
+from storage import Segment
+
+# Первый значащий байт документа JSON: объект, массив, строка, число, true/false/null.
+JSON_START = frozenset(b'{["-0123456789tfn')
+JSON_WHITESPACE = b' \t\r\n'
+# Подставляется клиентам без сжатия вместо сжатых данных, которые не распаковались.
+UNREADABLE_DATA = b'null'
+# Приоритеты сообщений приоритетных топиков: 0 - самый срочный (как в
+# PriorityQueue), MAX_PRIORITY - наименее срочный.
+MAX_PRIORITY = 9
+DEFAULT_PRIORITY = 5
+
+
+class StoredMessage:
+    """Сообщение топика: сырые JSON-байты данных и лениво собранные кадры рассылки.
+
+    Кадр для каждого формата собирается не более одного раза и затем
+    переиспользуется для всех подписчиков и повторов бэклога. Сжатые
+    издателем данные хранятся как есть: соединения, согласовавшие сжатие,
+    получают их без перепаковки, остальным один раз собирается кадр с
+    распакованными данными.
+    """
+
+    __slots__ = ('topic', 'topic_id', 'offset', 'size', 'created', 'removed', 'expires',
+                 'priority', 'trace', '_data', '_location', '_compressed', '_json_frame',
+                 '_binary_frame', '_plain_frame')
+
+    def __init__(self, topic: str, topic_id: int, offset: int, data: Optional[bytes],
+                 size: Optional[int] = None, created: Optional[float] = None,
+                 location: Optional[tuple[Segment, int]] = None):
+        self.topic = topic
+        self.topic_id = topic_id
+        self.offset = offset
+        self.size = len(data) if size is None else size
+        self.created = time.monotonic() if created is None else created
+        # Сообщение уже забрано get или вытеснено политикой хранения.
+        self.removed = False
+        # Срок жизни по time.monotonic; после него сообщение не доставляется.
+        self.expires: Optional[float] = None
+        self.priority = DEFAULT_PRIORITY
+        # Трасса сообщения (tracing.MessageTrace), если издатель ее запросил.
+        self.trace = None
+        # Восстановленные с диска сообщения не держат данные в памяти:
+        # они читаются из сегмента через mmap при первой отправке.
+        self._data = data
+        self._location = location
+        self._compressed = None if data is None else framing.is_compressed(data)
+        self._json_frame = None
+        self._binary_frame = None
+        self._plain_frame = None
+
+    @property
+    def data(self) -> bytes:
+        if self._data is not None:
+            return self._data
+        segment, position = self._location
+        return segment.read(position, self.size)
+
+    def expired(self, now: float) -> bool:
+        return self.expires is not None and self.expires <= now
+
+    @property
+    def compressed(self) -> bool:
+        if self._compressed is None:
+            self._compressed = framing.is_compressed(self.data)
+        return self._compressed
+
+    @property
+    def plain(self) -> bytes:
+        """Данные сообщения в исходном (несжатом) виде.
+
+        Сжатые данные брокер при публикации не распаковывает, поэтому
+        поврежденный поток или не-JSON внутри обнаруживается только здесь:
+        такие данные заменяются на null, чтобы не порвать кадры рассылки.
+        """
+        if not self.compressed:
+            return self.data
+        try:
+            data = framing.decompress(self.data)
+        except (ValueError, framing.FrameTooLarge):
+            return UNREADABLE_DATA
+        return data if starts_json(data) else UNREADABLE_DATA
+
+    @property
+    def json_frame(self) -> bytes:
+        if self._json_frame is None:
+            self._json_frame = splice_data(
+                {'type': 'message', 'topic': self.topic, 'offset': self.offset}, self.plain)
+        return self._json_frame
+
+    @property
+    def binary_frame(self) -> bytes:
+        if self._binary_frame is None:
+            self._binary_frame = framing.encode_frame(
+                framing.MESSAGE, self.topic_id, framing.OFFSET.pack(self.offset) + self.data)
+        return self._binary_frame
+
+    @property
+    def plain_frame(self) -> bytes:
+        """Бинарный кадр для соединений без сжатия."""
+        if not self.compressed:
+            return self.binary_frame
+        if self._plain_frame is None:
+            self._plain_frame = framing.encode_frame(
+                framing.MESSAGE, self.topic_id, framing.OFFSET.pack(self.offset) + self.plain)
+        return self._plain_frame
+
+    def frame(self, binary: bool, compression: bool = False) -> bytes:
+        if not binary:
+            return self.json_frame
+        return self.binary_frame if compression else self.plain_frame
+
+
+def starts_json(data: bytes) -> bool:
+    """Дешевая проверка данных: с первого значащего байта может начинаться JSON."""
+    start = next((byte for byte in data if byte not in JSON_WHITESPACE), None)
+    return start in JSON_START
+
+
+def splice_data(head: dict, data: bytes) -> bytes:
+    """Собирает JSON-строку head + {"data": data}, не разбирая data повторно."""
+    if b"\n" in data:
+        # Переводы строк допустимы в JSON только как пробельные символы.
+        data = data.replace(b"\n", b" ")
+    return json.dumps(head).encode()[:-1] + b', "data": ' + data + b"}\n"
+
+
+def splice_items(head: dict, items: list[bytes]) -> bytes:
+    """Как splice_data, но data - JSON-массив из уже закодированных элементов."""
+    return splice_data(head, b"[" + b", ".join(items) + b"]")
+
+
+class MessageLog:
+    """Сообщения топика с непрерывными монотонно растущими смещениями.
+
+    Удаление идет только с головы, поэтому сообщение находится по смещению
+    за O(1): его индекс равен разнице со смещением первого сообщения.
+    """
+
+    def __init__(self):
+        self._items: list = []
+        self._head = 0
+        self.next_offset = 0
+
+    def __len__(self):
+        return len(self._items) - self._head
+
+    def __iter__(self) -> Iterator[StoredMessage]:
+        return itertools.islice(self._items, self._head, None)
+
+    def __getitem__(self, index: int) -> StoredMessage:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('message log index out of range')
+        return self._items[self._head + index]
+
+    @property
+    def first_offset(self) -> int:
+        return self._items[self._head].offset if len(self) else self.next_offset
+
+    def append(self, message: StoredMessage):
+        if len(self) and message.offset != self.next_offset:
+            raise ValueError(f"Offset {message.offset} does not follow {self.next_offset - 1}")
+        self._items.append(message)
+        self.next_offset = message.offset + 1
+
+    def popleft(self) -> StoredMessage:
+        if not len(self):
+            raise IndexError('pop from an empty message log')
+        message = self._items[self._head]
+        self._items[self._head] = None
+        self._head += 1
+        if self._head >= 1024 and self._head * 2 >= len(self._items):
+            del self._items[:self._head]
+            self._head = 0
+        return message
+
+    def truncate(self, offset: int) -> list[StoredMessage]:
+        """Удаляет хвост: сообщения со смещением offset и больше."""
+        if offset >= self.next_offset:
+            return []
+        start = self._head + max(offset - self.first_offset, 0)
+        removed = self._items[start:]
+        del self._items[start:]
+        self.next_offset = offset
+        return removed
+
+    def read_from(self, offset: int, limit: int) -> list[StoredMessage]:
+        """До limit сообщений начиная со смещения offset (или с первого доступного)."""
+        start = self._head + max(offset - self.first_offset, 0)
+        return self._items[start:start + limit]
+
+    def iter_from(self, offset: int) -> Iterator[StoredMessage]:
+        """Как read_from, но без копии: сообщения читаются по мере перебора."""
+        return itertools.islice(self._items, self._head + max(offset - self.first_offset, 0),
+                                None)
+
+
+class PriorityIndex:
+    """Сообщения приоритетного топика в порядке выдачи.
+
+    Ключ сообщения - время публикации плюс priority * step секунд. Из
+    ожидающих раньше выдается более срочное, внутри уровня - более раннее, а
+    сообщение, прождавшее дольше разницы уровней, обгоняет новые более
+    срочные. Поэтому поток срочных сообщений задерживает остальные не больше
+    чем на priority * step секунд. Вставка и выдача - O(log n); забранные
+    другим путем сообщения удаляются из кучи лениво.
+    """
+
+    __slots__ = ('step', '_heap', '_compact_at')
+
+    def __init__(self, step: float):
+        self.step = step
+        self._heap: list[tuple[float, int, StoredMessage]] = []
+        self._compact_at = 1024
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, message: StoredMessage):
+        heap = self._heap
+        if len(heap) >= self._compact_at:
+            heap[:] = [entry for entry in heap if not entry[2].removed]
+            heapq.heapify(heap)
+            self._compact_at = max(2 * len(heap), 1024)
+        heapq.heappush(heap, (message.created + message.priority * self.step,
+                              message.offset, message))
+
+    def peek(self) -> Optional[StoredMessage]:
+        heap = self._heap
+        while heap and heap[0][2].removed:
+            heapq.heappop(heap)
+        return heap[0][2] if heap else None
+
+    def pop(self) -> Optional[StoredMessage]:
+        message = self.peek()
+        if message is not None:
+            heapq.heappop(self._heap)
+        return message
+
+
+class Subscription:
+    """Курсор подписчика: смещение следующего сообщения, которое он должен получить.
+
+    sources - то, чем подписка создана: сам топик и/или шаблоны, под которые
+    он подходит. Подписка живет, пока остается хотя бы один источник.
+
+    Подписка с кредитом (credit_messages не None) получает рассылки, только
+    пока подписчик разрешает: каждое сообщение тратит единицу кредита и свой
+    размер из credit_bytes. Остальное ждет в топике за курсором.
+
+    Подписка с фильтром получает только сообщения, которые он пропускает.
+    Пока такая подписка догнала топик (live), ее курсор не двигается на
+    каждой публикации: рассылку ей находит индекс фильтров топика.
+    """
+
+    __slots__ = ('writer', 'topic', 'next_offset', 'sources', 'credit_messages', 'credit_bytes',
+                 'pending', 'filter', 'live')
+
+    def __init__(self, writer, topic: str, next_offset: int, source: Optional[str] = None):
+        self.writer = writer
+        self.topic = topic
+        self.next_offset = next_offset
+        self.sources = {topic if source is None else source}
+        self.credit_messages: Optional[int] = None
+        self.credit_bytes: Optional[int] = None
+        # Приоритетный топик: прочитанные за курсором, но еще не разосланные
+        # сообщения; отстающая подписка получает их в порядке приоритета.
+        self.pending: Optional[PriorityIndex] = None
+        self.filter: Optional[MessageFilter] = None
+        self.live = False
+
+    def accepts(self, message: StoredMessage) -> bool:
+        return self.filter is None or self.filter.matches(message_fields(message))
+
+    @property
+    def has_credit(self) -> bool:
+        if self.credit_messages is None:
+            return True
+        return self.credit_messages > 0 and (self.credit_bytes is None or self.credit_bytes > 0)
+
+    def grant(self, messages: int, max_bytes: Optional[int] = None):
+        """Добавляет кредит; первая выдача включает управление потоком подписки.
+
+        Лимит по байтам появляется с первой выдачей байт. Сообщение отправляется,
+        пока остаток байт положителен, даже если оно само больше остатка, иначе
+        такое сообщение не дошло бы никогда; перерасход вычитается из следующих выдач.
+        """
+        self.credit_messages = (self.credit_messages or 0) + messages
+        if max_bytes:
+            self.credit_bytes = (self.credit_bytes or 0) + max_bytes
+
+    def take(self, size: int) -> bool:
+        """Тратит кредит на сообщение размером size; False - кредита нет."""
+        if self.credit_messages is None:
+            return True
+        if not self.has_credit:
+            return False
+        self.credit_messages -= 1
+        if self.credit_bytes is not None:
+            self.credit_bytes -= size
+        return True
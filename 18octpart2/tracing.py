@@ -0,0 +1,88 @@
+"""Трассировка сообщений: отметки времени от приема публикации до записи подписчикам.
+
+Издатель помечает публикацию флагом trace, и брокер, запущенный с
+max_traces, записывает для каждого ее сообщения моменты:
+
+- received - запрос взят из соединения, до разбора JSON или кадра;
+- enqueued - сообщение добавлено в топик (и в журнал на диске);
+- для каждого получателя queued - кадр поставлен в очередь соединения
+  (ClientOutbox) и written - кадр отдан сокету.
+
+enqueued - received - это разбор и обработка запроса, queued - enqueued -
+рассылка подписчикам, written - queued - очередь соединения и ожидание
+drain(). У сообщения без флага трассы нет, и горячий путь платит только
+проверкой message.trace is None; брокер без max_traces не берет даже
+отметки приема.
+"""
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+def _peer(writer) -> str:
+    peer = writer.get_extra_info('peername')
+    if isinstance(peer, tuple):
+        return f'{peer[0]}:{peer[1]}'
+    return str(peer)
+
+
+class MessageTrace:
+    """Отметки time.monotonic одного сообщения."""
+
+    __slots__ = ('topic', 'offset', 'received', 'received_at', 'enqueued', 'deliveries')
+
+    def __init__(self, topic: str, offset: int, received: float, enqueued: float):
+        self.topic = topic
+        self.offset = offset
+        self.received = received
+        # Время приема по часам брокера - для сопоставления с часами клиентов.
+        self.received_at = time.time() - (time.monotonic() - received)
+        self.enqueued = enqueued
+        # Соединение -> [адрес, queued, written]; written - None, пока кадр в очереди
+        # (и навсегда, если кадр отброшен политикой переполнения).
+        self.deliveries: dict[object, list] = {}
+
+    def queued(self, writer, now: float):
+        self.deliveries[writer] = [_peer(writer), now, None]
+
+    def written(self, writer, now: float):
+        delivery = self.deliveries.get(writer)
+        if delivery is not None and delivery[2] is None:
+            delivery[2] = now
+
+    def as_dict(self) -> dict:
+        """Трасса для клиента: время приема по часам брокера, этапы - в секундах от приема."""
+        def since(moment: Optional[float]) -> Optional[float]:
+            return None if moment is None else round(moment - self.received, 6)
+
+        return {
+            'topic': self.topic,
+            'offset': self.offset,
+            'received': round(self.received_at, 6),
+            'enqueued': since(self.enqueued),
+            'deliveries': [{'client': peer, 'queued': since(queued), 'written': since(written)}
+                           for peer, queued, written in self.deliveries.values()]
+        }
+
+
+class TraceStore:
+    """Трассы последних max_traces трассированных сообщений по (топик, смещение)."""
+
+    def __init__(self, max_traces: int):
+        self.max_traces = max_traces
+        self._traces: OrderedDict[tuple[str, int], MessageTrace] = OrderedDict()
+
+    def __len__(self):
+        return len(self._traces)
+
+    def start(self, message, received: float, now: float) -> MessageTrace:
+        """Заводит трассу только что добавленного в топик сообщения."""
+        trace = MessageTrace(message.topic, message.offset, received, now)
+        message.trace = trace
+        self._traces[(message.topic, message.offset)] = trace
+        if len(self._traces) > self.max_traces:
+            self._traces.popitem(last=False)
+        return trace
+
+    def get(self, topic: str, offset: int) -> Optional[MessageTrace]:
+        return self._traces.get((topic, offset))
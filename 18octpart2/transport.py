@@ -0,0 +1,351 @@
+"""Транспорт на asyncio.Protocol: разбор сообщений прямо из буфера data_received.
+
+На потоках (StreamReader) каждое сообщение стоит вызова readline() или
+readexactly() с переключением корутины и копированием буфера. Протокол
+копит входящие байты в одном bytearray, за один вызов data_received разбирает
+все целые строки JSON или кадры и передает их задаче обработки соединения
+одной пачкой. Логика брокера и клиента при этом та же, что и на потоках:
+протокол вызывает их обработчики строк и кадров.
+
+Если установлен uvloop, run() запускает цикл событий на нем, иначе - на
+стандартном цикле asyncio.
+"""
+import asyncio
+from collections import deque
+from typing import Optional
+
+import framing
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+STREAMS = 'streams'
+PROTOCOL = 'protocol'
+TRANSPORTS = (STREAMS, PROTOCOL)
+
+# Сколько разобранных, но не обработанных сообщений держать до паузы чтения.
+READ_HIGH_WATER = 1000
+READ_LOW_WATER = 250
+
+
+def run(main):
+    """asyncio.run на uvloop, если он установлен, иначе на стандартном цикле."""
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(main)
+
+
+class FrameParser:
+    """Режет поток байт на строки JSON или кадры (action, topic_id, request_id, payload).
+
+    Заголовки кадров читаются из буфера без копирования; копируется только
+    нагрузка, которую брокер все равно сохраняет в топике.
+    """
+
+    def __init__(self, binary: bool, max_size: int = framing.DEFAULT_MAX_FRAME_SIZE):
+        self.binary = binary
+        self.max_size = max_size
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        # Пока хвоста нет, разбираем прямо полученные байты, без копии в буфер.
+        if self._buffer:
+            self._buffer += data
+            source = self._buffer
+        else:
+            source = data
+
+        items = []
+        position = 0
+        if self.binary:
+            header = framing.HEADER.size
+            while len(source) - position >= header:
+                length, action, topic_id, request_id = framing.HEADER.unpack_from(source, position)
+                if length > self.max_size:
+                    raise framing.FrameTooLarge(
+                        f"Frame of {length} bytes exceeds limit {self.max_size}")
+                end = position + header + length
+                if end > len(source):
+                    break
+                items.append((action, topic_id, request_id,
+                              bytes(source[position + header:end])))
+                position = end
+        else:
+            while True:
+                end = source.find(b'\n', position)
+                if end < 0:
+                    if len(source) - position > self.max_size:
+                        raise framing.FrameTooLarge(
+                            f"Line exceeds limit of {self.max_size} bytes")
+                    break
+                items.append(bytes(source[position:end + 1]))
+                position = end + 1
+
+        if source is self._buffer:
+            del self._buffer[:position]
+        elif position < len(source):
+            self._buffer = bytearray(source[position:])
+        return items
+
+
+class ProtocolWriter:
+    """Часть интерфейса StreamWriter, которой пользуются брокер и клиент."""
+
+    def __init__(self, transport: asyncio.Transport, protocol: 'FramedProtocol'):
+        self.transport = transport
+        self._protocol = protocol
+
+    def write(self, data: bytes):
+        self.transport.write(data)
+
+    def writelines(self, data):
+        self.transport.writelines(data)
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await self._protocol.closed
+
+    async def drain(self):
+        await self._protocol.writable()
+
+    def get_extra_info(self, name: str, default=None):
+        return self.transport.get_extra_info(name, default)
+
+
+class FramedProtocol(asyncio.Protocol):
+    """Общая часть протоколов брокера и клиента.
+
+    Разобранные сообщения копятся в очереди, их по порядку обрабатывает одна
+    задача соединения. Если очередь растет быстрее обработки, чтение из
+    сокета приостанавливается. pause_writing/resume_writing транспорта
+    превращаются в ожидание drain(), как у StreamWriter.
+    """
+
+    def __init__(self, binary: bool = False, max_size: int = framing.DEFAULT_MAX_FRAME_SIZE):
+        self.parser = FrameParser(binary, max_size)
+        self.writer: Optional[ProtocolWriter] = None
+        self.closed = asyncio.get_running_loop().create_future()
+        self.task: Optional[asyncio.Task] = None
+        self._items: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._reading_paused = False
+        self._write_paused = False
+        self._drain_waiters: list[asyncio.Future] = []
+        self._error: Optional[Exception] = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.writer = ProtocolWriter(transport, self)
+        self.task = asyncio.create_task(self._process())
+
+    def data_received(self, data: bytes):
+        try:
+            items = self.parse(data)
+        except Exception as exc:
+            self._fail(exc)
+            return
+        if items:
+            self._items.extend(items)
+            self._wakeup.set()
+            if len(self._items) > READ_HIGH_WATER and not self._reading_paused:
+                self._reading_paused = True
+                self.writer.transport.pause_reading()
+
+    def parse(self, data: bytes) -> list:
+        return self.parser.feed(data)
+
+    def eof_received(self):
+        self._wakeup.set()
+        return False
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if not self.closed.done():
+            self.closed.set_result(None)
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(ConnectionResetError('Connection lost'))
+        self._drain_waiters.clear()
+        self._wakeup.set()
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._drain_waiters.clear()
+
+    async def writable(self):
+        if self.closed.done():
+            raise ConnectionResetError('Connection lost')
+        if self._write_paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+    def _fail(self, exc: Exception):
+        self._error = exc
+        self._wakeup.set()
+        self.writer.transport.abort()
+
+    async def _process(self):
+        transport = self.writer.transport
+        try:
+            while self._error is None:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._items:
+                    await self.handle(self._items.popleft())
+                    if self._reading_paused and len(self._items) < READ_LOW_WATER:
+                        self._reading_paused = False
+                        transport.resume_reading()
+                if self.closed.done() or transport.is_closing():
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            self._fail(exc)
+        finally:
+            await self.finish()
+
+    async def handle(self, item):
+        raise NotImplementedError
+
+    async def finish(self):
+        pass
+
+
+class BrokerProtocol(FramedProtocol):
+    """Соединение брокера: режим (JSON или бинарный) определяется по первому байту."""
+
+    def __init__(self, broker):
+        super().__init__(max_size=broker.max_frame_size)
+        self.broker = broker
+        # Начало потока, пока по нему не ясен режим соединения.
+        self._head: Optional[bytes] = b''
+        self._peer = None
+        # Соединение сверх лимита брокера: ответ с ошибкой по таймеру или по началу запроса.
+        self._reject_timer: Optional[asyncio.TimerHandle] = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        super().connection_made(transport)
+        self._peer = transport.get_extra_info('peername')
+        if not self.broker.admit_connection():
+            self._reject_timer = asyncio.get_running_loop().call_later(
+                self.broker.REJECT_TIMEOUT, self._reject)
+            return
+        print(f"Клиент подключен: {self._peer}")
+        self.broker.add_connection(self.writer)
+
+    def _reject(self):
+        """Отвечает ошибкой: клиенту JSON - на первый запрос (с его id), бинарному - сразу."""
+        self._reject_timer.cancel()
+        if not self.writer.is_closing():
+            self.writer.write(self.broker.rejection(self._head))
+            self.writer.close()
+
+    def parse(self, data: bytes) -> list:
+        if self._reject_timer is not None:
+            self._head += data
+            if (self._head[:1] != b'{' or b'\n' in self._head
+                    or len(self._head) > self.parser.max_size):
+                self._reject()
+            return []
+        if self._head is not None:
+            data = self._head + data
+            if data[:1] == framing.PREFACE[:1]:
+                if len(data) < len(framing.PREFACE):
+                    self._head = data
+                    return []
+                preface, data = data[:len(framing.PREFACE)], data[len(framing.PREFACE):]
+                if preface != framing.PREFACE:
+                    raise ValueError(f"Unsupported protocol preface: {preface!r}")
+                self.parser.binary = True
+                self.broker.start_binary(self.writer)
+            self._head = None
+        return self.parser.feed(data)
+
+    async def handle(self, item):
+        if self.parser.binary:
+            await self.broker.process_frame(*item, self.writer)
+        else:
+            await self.broker.handle_line(item, self.writer)
+
+    async def finish(self):
+        if self._reject_timer is not None:
+            self._reject_timer.cancel()
+            print(f"Отказано в подключении {self._peer}: достигнут лимит соединений")
+            return
+        if self._error is not None:
+            print(f"Ошибка обработки клиента {self._peer}: {self._error}")
+        await self.broker._cleanup_writer(self.writer)
+        print(f"Клиент отключен: {self._peer}")
+
+
+class ClientProtocol(FramedProtocol):
+    """Соединение AsyncMessageClient; в бинарном режиме сначала ждет PREFACE брокера."""
+
+    def __init__(self, client):
+        super().__init__(client.binary, client.max_frame_size)
+        self.client = client
+        self.ready = asyncio.get_running_loop().create_future()
+        self._head = b''
+        if not client.binary:
+            self.ready.set_result(None)
+
+    def connection_made(self, transport: asyncio.Transport):
+        super().connection_made(transport)
+        if self.client.binary:
+            transport.write(framing.PREFACE)
+
+    def parse(self, data: bytes) -> list:
+        if not self.ready.done():
+            data = self._head + data
+            if len(data) < len(framing.PREFACE):
+                self._head = data
+                return []
+            if data[:1] == b'{':
+                # Брокер отказал в подключении строкой JSON с ошибкой.
+                if b'\n' not in data:
+                    self._head = data
+                    return []
+                error = self.client._refusal(data.split(b'\n', 1)[0])
+                self.ready.set_exception(error)
+                raise error
+            preface, data = data[:len(framing.PREFACE)], data[len(framing.PREFACE):]
+            if preface != framing.PREFACE:
+                error = ConnectionError(f'Broker rejected binary framing: {preface!r}')
+                self.ready.set_exception(error)
+                raise error
+            self.ready.set_result(None)
+        return self.parser.feed(data)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if not self.ready.done():
+            self.ready.set_exception(ConnectionError('Connection closed during handshake'))
+        super().connection_lost(exc)
+
+    async def handle(self, item):
+        if self.parser.binary:
+            await self.client._handle_frame(*item)
+        else:
+            await self.client._handle_line(item)
+
+    async def finish(self):
+        self.client._connection_lost(self._error)
+
+
+async def start_server(broker, host: str, port: int, kind: str = STREAMS, **kwargs):
+    """Сервер брокера на потоках (handle_client) или на BrokerProtocol."""
+    if kind == PROTOCOL:
+        loop = asyncio.get_running_loop()
+        return await loop.create_server(lambda: BrokerProtocol(broker), host, port, **kwargs)
+    return await asyncio.start_server(broker.handle_client, host, port, **kwargs)